@@ -0,0 +1,712 @@
+from collections import deque, OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+import hashlib
+import io
+import json
+import os
+import shutil
+import struct
+import tarfile
+
+import chunking
+import encrypt
+import huffman
+from progress import stage_timer
+
+ARCHIVE_MAGIC = b'LPA\x01'  # start and end of every archive, the last byte is the format version
+TRAILER = struct.Struct('>QQB4s')  # offset of the central directory, its size, flags, magic
+ENCRYPTED = 1  # trailer flag: every member and the directory are encrypted
+# starts of file types that are already compressed, as (offset, bytes), so they are stored instead of compressed again
+COMPRESSED_SIGNATURES = [(0, b'\xff\xd8\xff'), (0, b'\x89PNG'), (0, b'GIF8'), (0, b'PK\x03\x04'), (0, b'\x1f\x8b'),
+                         (0, b'BZh'), (0, b'\xfd7zXZ\x00'), (0, b'7z\xbc\xaf\x27\x1c'), (0, b'\x28\xb5\x2f\xfd'),
+                         (0, b'Rar!'), (0, b'ID3'), (0, b'OggS'), (0, b'fLaC'), (4, b'ftyp'), (8, b'WEBP'),
+                         (0, b'LPZ'), (0, b'LPA'), (0, b'LPE')]
+CHUNK_INDEX_LIMIT = 1 << 18  # chunks remembered for deduplication, about 16 GiB of unique data at the average size
+
+
+class SegmentReader(io.RawIOBase):
+    """Readable file object covering length bytes of file starting at offset, so a member can be decompressed
+    without reading anything else in the archive"""
+    def __init__(self, file, offset, length):
+        super().__init__()
+        self.file = file
+        self.position = offset
+        self.end = offset + length
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        count = min(len(buffer), self.end - self.position)
+        if count <= 0:
+            return 0
+        self.file.seek(self.position)
+        data = self.file.read(count)
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+
+class ChunkReader(io.RawIOBase):
+    """Readable file object joining the chunks of a deduplicated member, each read from wherever in the archive it
+    was first written"""
+    def __init__(self, archive, chunks):
+        super().__init__()
+        self.archive = archive
+        self.chunks = iter(chunks)
+        self.pending = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.pending:
+            entry = next(self.chunks, None)
+            if entry is None:
+                return 0
+            self.pending = memoryview(self.archive.read_chunk(entry))
+        count = min(len(buffer), len(self.pending))
+        buffer[:count] = self.pending[:count]
+        self.pending = self.pending[count:]
+        return count
+
+
+def compress_chunk(data, block_size, sample_size, level, codec, dictionary, progress=None):  # also runs in workers
+    return huffman.compress(data, block_size, 1, progress, sample_size, level, codec, dictionary=dictionary)
+
+
+def file_digest(path):  # sha256 of a file's contents, kept in the directory so updates can tell if it changed
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for data in iter(lambda: f.read(huffman.FRAME_SIZE), b''):
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def valid_trailer(file, position):  # checks for a trailer at position pointing at a directory that ends right before it
+    if position < len(ARCHIVE_MAGIC):
+        return False
+    file.seek(position)
+    offset, size, flags, magic = TRAILER.unpack(file.read(TRAILER.size))
+    return magic == ARCHIVE_MAGIC and offset >= len(ARCHIVE_MAGIC) and offset + size == position
+
+
+def find_trailer(file, end):
+    """Searches back from end for the last valid trailer, returning its position or None. An update that was
+    interrupted before writing its directory leaves members after the trailer of the update before it, which still
+    describes everything that was there"""
+    while end > len(ARCHIVE_MAGIC):
+        start = max(0, end - huffman.FRAME_SIZE)
+        file.seek(start)
+        data = file.read(end - start)
+        found = data.rfind(ARCHIVE_MAGIC)
+        while found != -1:
+            position = start + found + len(ARCHIVE_MAGIC) - TRAILER.size
+            if valid_trailer(file, position):
+                return position
+            found = data.rfind(ARCHIVE_MAGIC, 0, found + len(ARCHIVE_MAGIC) - 1)
+        if start == 0:
+            return None
+        end = start + len(ARCHIVE_MAGIC) - 1  # overlaps the next read, so a magic split between them is found
+    return None
+
+
+def read_trailer(file):
+    """Returns the position of the trailer of an open archive, and the offset of the directory, its size and the flags
+    it holds. If the end of the file is not a valid trailer, the last one before it is used (see find_trailer).
+    Raises ValueError if the file is not an archive"""
+    end = file.seek(0, os.SEEK_END)
+    if end < len(ARCHIVE_MAGIC) + TRAILER.size:
+        raise ValueError('not an archive')
+    position = end - TRAILER.size
+    if not valid_trailer(file, position):
+        position = find_trailer(file, end)
+        if position is None:
+            raise ValueError('not an archive')
+    file.seek(position)
+    return (position,) + TRAILER.unpack(file.read(TRAILER.size))[:3]
+
+
+def read_directory(file, password):
+    """Reads the trailer and central directory at the end of an open archive, returning every member (superseded
+    ones included), the trailer flags and the offset where the archive ends, after its trailer. Raises ValueError if
+    the file is not an archive or the password is wrong"""
+    position, offset, size, flags = read_trailer(file)
+    if flags & ENCRYPTED and password == '':
+        raise ValueError('archive is encrypted')
+    file.seek(offset)
+    directory = file.read(size)
+    if flags & ENCRYPTED:
+        directory = encrypt.decrypt(directory, password)
+    return json.loads(directory), flags, position + TRAILER.size  # a wrong password gives data that is not valid json
+
+
+def write_directory(file, members, password):  # writes the central directory and trailer at the end of file
+    directory = json.dumps(members).encode()
+    flags = 0
+    if password != '':
+        directory = encrypt.encrypt(directory, password)
+        flags |= ENCRYPTED
+    offset = file.tell()
+    file.write(directory)
+    file.write(TRAILER.pack(offset, len(directory), flags, ARCHIVE_MAGIC))
+
+
+def should_store(path):
+    """Checks the start of a file for the signature of an already compressed format, or for data that looks random
+    enough that compressing it would not make it smaller"""
+    with open(path, 'rb') as f:
+        prefix = f.read(huffman.STORE_SAMPLE)
+    for offset, signature in COMPRESSED_SIGNATURES:
+        if prefix[offset:offset + len(signature)] == signature:
+            return True
+    return huffman.incompressible(prefix)
+
+
+class ArchiveWriter:
+    """Writes each member as its own compressed stream, followed by a central directory holding the name, size,
+    modification time, mode, method and position of every member. Members that should_store picks out are copied in
+    as they are, with method 'store', instead of being compressed. The directory is found through a fixed size
+    trailer at the end of the file, so a reader can go straight to any member. sample_size, level, codec and
+    dictionary are passed on to huffman.CompressWriter. A trained dictionary saves every small member from carrying
+    its own codebook, but the archive can then only be extracted where the dictionary is saved.
+
+    With dedup=True, files are cut into content defined chunks (see chunking.chunk_ends) and each chunk is looked up
+    by its sha256 hash. Only chunks not seen before are compressed and written, as streams of their own, and members
+    get method 'chunks' with a list of [offset, length, size, method, sha256] for their chunks in order, and no offset
+    of their own. Chunks are written in the order they are first seen whatever jobs is, so the archive is the same
+    with or without a pool. The index keeps the index_limit most recently seen chunks, so memory stays bounded
+    however many files are added, and a repeat of a chunk that was dropped is just written again.
+
+    With append=True an existing archive is updated instead of replaced. Files whose size and modification time are
+    unchanged are skipped, as are files whose contents still match the sha256 kept for them. Anything else is
+    appended after the old data, and the member it replaces, or one that was deleted from a folder being added, is
+    marked superseded. The new directory is written after the old one, which is left in place until
+    compact_archive is used to reclaim the space. If an update fails, the archive is truncated back to where it
+    ended, and anything left after the last directory by an update that never finished is dropped.
+
+    With jobs above 1, one pool of processes is started for the whole archive and shared by every member, so adding
+    many small files does not start a pool for each. Members that fit in one frame are compressed without it"""
+    def __init__(self, path, password='', block_size=huffman.BLOCK_SIZE, jobs=1, progress=None, sample_size=0,
+                 level=0, codec='huffman', dictionary=None, dedup=False, index_limit=CHUNK_INDEX_LIMIT, append=False):
+        self.password = password
+        self.block_size = block_size
+        self.jobs = jobs
+        self.progress = progress
+        self.sample_size = sample_size
+        self.level = level
+        self.codec = codec
+        self.dictionary = dictionary
+        self.dedup = dedup
+        self.index_limit = index_limit
+        self.chunk_index = OrderedDict()  # sha256 of a chunk: its entry, least recently seen first
+        self.in_flight = deque()  # (entry, future) of chunks being compressed, oldest first
+        self.members = []
+        self.previous = {}  # name: member of the archive being updated, for members not yet added again
+        self.folders = []  # names of the folders added while updating, whose missing members are superseded
+        self.original = None  # directory of the archive being updated, so it is not written again if nothing changed
+        self.end = None  # size of the archive being updated, which it is truncated back to if the update fails
+        if append and os.path.exists(path) and os.path.getsize(path) > 0:
+            self.file = open(path, 'r+b')
+            try:
+                self.members, flags, self.end = read_directory(self.file, password)
+                if bool(flags & ENCRYPTED) != (password != ''):
+                    raise ValueError('archive is not encrypted')
+            except ValueError:
+                self.file.close()
+                raise
+            self.original = json.dumps(self.members)
+            self.previous = {member['name']: member for member in self.members if not member.get('superseded')}
+            for member in self.previous.values():  # chunks already in the archive can be reused too
+                for entry in member.get('chunks', []):
+                    if len(entry) > 4:
+                        self.chunk_index[bytes.fromhex(entry[4])] = entry
+            while len(self.chunk_index) > index_limit:
+                self.chunk_index.popitem(last=False)
+            self.file.seek(self.end)
+            self.file.truncate()
+        else:
+            self.file = open(path, 'wb')
+            self.file.write(ARCHIVE_MAGIC)
+        self.executor = ProcessPoolExecutor(jobs) if jobs > 1 else None  # shared by every member and chunk
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, *args):
+        if kind is not None and self.end is not None:  # a failed update is undone
+            self.abort()
+        else:
+            self.close()
+
+    def add(self, path, arcname=None):  # adds a file, or a folder and everything in it
+        if arcname is None:  # the name of the folder itself, so '.' is stored under the current folder's name
+            arcname = os.path.basename(os.path.abspath(path))
+        if arcname in ('', os.curdir, os.pardir):
+            raise ValueError(f'no name to store {path} under')
+        stat = os.stat(path)
+        member = {'name': arcname.replace(os.sep, '/'), 'type': 'file', 'size': stat.st_size,
+                  'mtime': stat.st_mtime, 'mode': stat.st_mode & 0o7777, 'method': 'huffman', 'length': 0}
+        previous = self.previous.pop(member['name'], None)
+        if os.path.isdir(path):
+            member['type'] = 'dir'
+            member['size'] = 0
+            if previous is not None and previous['type'] == 'dir':  # nothing is stored for a folder but its details
+                previous.update(mtime=member['mtime'], mode=member['mode'])
+            else:
+                self.supersede(previous)
+                self.members.append(member)
+            if self.previous:
+                self.folders.append(member['name'])
+            for name in sorted(os.listdir(path)):
+                self.add(os.path.join(path, name), arcname + '/' + name)
+            return
+        if previous is not None and previous['type'] == 'file':
+            unchanged = previous['size'] == member['size'] and previous['mtime'] == member['mtime']
+            if not unchanged:  # otherwise assumed unchanged, without reading it
+                member['sha256'] = file_digest(path)
+                unchanged = previous.get('sha256') == member['sha256']
+                if unchanged:  # only touched, so the stored data is still right
+                    previous.update(mtime=member['mtime'], mode=member['mode'])
+            if unchanged:
+                if self.progress is not None:
+                    self.progress.advance(member['size'])
+                return
+        self.supersede(previous)
+        if self.dedup:
+            self.add_chunks(path, member)
+            self.members.append(member)
+            return
+        digest = None if 'sha256' in member else hashlib.sha256()  # already known if an update had to compare it
+        member['offset'] = self.file.tell()  # only members with a stream of their own have one
+        with open(path, 'rb') as source:
+            target = self.file
+            if self.password != '':
+                target = encrypt.EncryptWriter(self.file, self.password, self.progress)
+            if should_store(path):
+                member['method'] = 'store'
+                with stage_timer(self.progress)('read'):
+                    for data in iter(lambda: source.read(huffman.FRAME_SIZE), b''):
+                        target.write(data)
+                        if digest is not None:
+                            digest.update(data)
+                        if self.progress is not None:
+                            self.progress.advance(len(data), 1)
+            else:
+                executor = self.executor if member['size'] > huffman.FRAME_SIZE else None  # one frame gains nothing
+                writer = huffman.CompressWriter(target, self.block_size, jobs=self.jobs if executor else 1,
+                                                progress=self.progress, sample_size=self.sample_size,
+                                                level=self.level, codec=self.codec, dictionary=self.dictionary,
+                                                executor=executor)
+                writer.write_file(path, digest)  # read from a memory map rather than copied in
+                writer.close()
+            if target is not self.file:
+                target.close()
+        if digest is not None:
+            member['sha256'] = digest.hexdigest()
+        member['length'] = self.file.tell() - member['offset']
+        self.members.append(member)
+
+    def supersede(self, member):  # marks a member of the archive being updated as replaced
+        if member is not None:
+            member['superseded'] = True
+
+    def add_chunks(self, path, member):  # writes the chunks of a file that are not in the index yet
+        member['method'] = 'chunks'
+        member['chunks'] = []
+        file_hash = hashlib.sha256()
+        if member['size'] == 0:  # empty files can't be mapped
+            member['sha256'] = file_hash.hexdigest()
+            return
+        method = 'store' if should_store(path) else 'huffman'
+        stage = stage_timer(self.progress)
+        with open(path, 'rb') as f:
+            mapped = huffman.map_file(f)
+        view = memoryview(mapped)
+        start = 0
+        with stage('chunk'):
+            ends = list(chunking.chunk_ends(view))
+        for end in ends:
+            with stage('chunk'):
+                data = bytes(view[start:end])
+                digest = hashlib.sha256(data).digest()
+                file_hash.update(data)
+            entry = self.chunk_index.get(digest)
+            if entry is None:
+                entry = [0, 0, len(data), method, digest.hex()]  # offset and length are filled in once it is written
+                self.chunk_index[digest] = entry
+                if len(self.chunk_index) > self.index_limit:
+                    self.chunk_index.popitem(last=False)
+                self.write_chunk(entry, data)
+            else:
+                self.chunk_index.move_to_end(digest)
+                if self.progress is not None:
+                    self.progress.advance(len(data))
+            member['chunks'].append(entry)
+            start = end
+        view.release()
+        mapped.close()
+        member['sha256'] = file_hash.hexdigest()
+
+    def write_chunk(self, entry, data):
+        if entry[3] == 'store' and not self.in_flight:
+            self.write_payload(entry, data)
+            if self.progress is not None:
+                self.progress.advance(entry[2], 1)
+            return
+        if entry[3] == 'store':  # waits behind the chunks still being compressed, so the order does not depend on jobs
+            future = Future()
+            future.set_result((data, {}))
+        else:
+            arguments = (data, self.block_size, self.sample_size, self.level, self.codec, self.dictionary)
+            if self.executor is None:  # progress is advanced by the compressor
+                self.write_payload(entry, compress_chunk(*arguments, self.progress))
+                return
+            future = self.executor.submit(huffman.run_measured, compress_chunk, *arguments)
+        self.in_flight.append((entry, future))
+        while len(self.in_flight) > 2 * self.jobs:  # keeps every process busy without holding every chunk
+            self.write_oldest()
+
+    def write_oldest(self):
+        entry, future = self.in_flight.popleft()
+        payload, stages = future.result()
+        self.write_payload(entry, payload)
+        if self.progress is not None:
+            self.progress.add_stages(stages)
+            self.progress.advance(entry[2], 1)
+
+    def write_payload(self, entry, payload):  # writes a chunk (encrypted if there is a password) and fills in its entry
+        entry[0] = self.file.tell()
+        with stage_timer(self.progress)('write'):
+            if self.password != '':
+                with encrypt.EncryptWriter(self.file, self.password, self.progress) as target:
+                    target.write(payload)
+            else:
+                self.file.write(payload)
+        entry[1] = self.file.tell() - entry[0]
+
+    def abort(self):  # closes without writing a directory, undoing an update
+        if self.file.closed:
+            return
+        for entry, future in self.in_flight:
+            future.cancel()
+        self.in_flight.clear()
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+        if self.end is not None:
+            self.file.truncate(self.end)
+        self.file.close()
+
+    def close(self):
+        if self.file.closed:
+            return
+        try:
+            self.finish()
+        except BaseException:
+            self.abort()
+            raise
+        self.file.close()
+
+    def finish(self):  # writes what is still being compressed and the directory
+        try:
+            while self.in_flight:
+                self.write_oldest()
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown()
+        for name, member in self.previous.items():  # left over members that were deleted from an updated folder
+            if any(name.startswith(folder + '/') for folder in self.folders):
+                self.supersede(member)
+        for member in self.members:
+            if member.get('method') == 'chunks':  # the compressed bytes of every chunk it uses, wherever they are
+                member['length'] = sum(entry[1] for entry in member['chunks'])
+        if json.dumps(self.members) != self.original:
+            write_directory(self.file, self.members, self.password)
+
+
+class ArchiveReader:
+    """Reads the central directory of an archive written by ArchiveWriter. Listing only reads the trailer and the
+    directory, and extracting a member only reads that member's compressed data. As in ArchiveWriter, with jobs above
+    1 one pool of processes is shared by every member. Raises ValueError if the archive is corrupted or the password
+    is wrong"""
+    def __init__(self, path, password='', jobs=1, progress=None):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.password = password
+        self.jobs = jobs
+        self.progress = progress
+        try:
+            members, self.flags = read_directory(self.file, password)[:2]
+        except ValueError:
+            self.file.close()
+            raise
+        self.members = [member for member in members if not member.get('superseded')]
+        self.index = {member['name']: member for member in self.members}
+        self.executor = ProcessPoolExecutor(jobs) if jobs > 1 else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+        self.file.close()
+
+    def names(self):
+        return [member['name'] for member in self.members]
+
+    def open(self, name):  # returns a readable file object of the decompressed member
+        member = self.index[name]
+        if member['type'] == 'dir':
+            raise IsADirectoryError(name)
+        if member.get('method') == 'chunks':
+            return ChunkReader(self, member['chunks'])
+        source = SegmentReader(self.file, member['offset'], member['length'])
+        if self.flags & ENCRYPTED:
+            source = encrypt.DecryptReader(source, self.password, self.progress)
+        if member.get('method', 'huffman') == 'store':  # archives from before stored members have no method
+            return source
+        executor = self.executor if member['size'] > huffman.FRAME_SIZE else None  # one frame gains nothing from it
+        return huffman.DecompressReader(source, jobs=self.jobs if executor else 1, progress=self.progress,
+                                        executor=executor)
+
+    def read_chunk(self, entry):  # returns the data of one chunk of a deduplicated member
+        offset, length, size, method = entry[:4]
+        source = SegmentReader(self.file, offset, length)
+        if self.flags & ENCRYPTED:
+            source = encrypt.DecryptReader(source, self.password)
+        if method == 'huffman':
+            source = huffman.DecompressReader(source)
+        data = source.read()
+        if len(data) != size:
+            raise ValueError('corrupted chunk')
+        return data
+
+    def extract(self, name, path):  # writes one member into the folder path
+        member = self.index[name]
+        destination = member_path(path, member['name'])
+        if member['type'] == 'dir':
+            os.makedirs(destination, exist_ok=True)
+        else:
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            if not self.flags & ENCRYPTED and member.get('method', 'huffman') == 'huffman':
+                # decoded from a map of the archive straight into a map of the output file
+                huffman.decompress_file(self.path, destination, jobs=self.jobs, progress=self.progress,
+                                        offset=member['offset'], length=member['length'], executor=self.executor)
+            else:
+                with self.open(name) as reader, open(destination, 'wb') as f:
+                    with stage_timer(self.progress)('write'):
+                        shutil.copyfileobj(reader, f, huffman.FRAME_SIZE)
+                if member.get('method') in ('store', 'chunks') and self.progress is not None:  # not advanced yet
+                    self.progress.advance(member['length'], 1)
+        try:
+            os.chmod(destination, member['mode'])
+            os.utime(destination, (member['mtime'], member['mtime']))
+        except OSError:
+            pass  # permissions and times are restored where the file system allows it
+
+    def verify(self, names=None):
+        """Checks members without writing anything, raising ValueError with the name of the first bad one. Compressed
+        members of unencrypted archives are checked frame by frame on the pool (see huffman.verify_file), and the rest
+        are read through and compared with the size and sha256 kept in the directory"""
+        if names is None:
+            names = self.names()
+        if self.progress is not None and not self.progress.total:
+            self.progress.total = sum(self.index[name]['length'] for name in names)
+        for name in names:
+            member = self.index[name]
+            member_path(os.curdir, member['name'])  # an archive that can't be extracted does not pass either
+            if member['type'] == 'dir':
+                continue
+            try:
+                if not self.flags & ENCRYPTED and member.get('method', 'huffman') == 'huffman':
+                    huffman.verify_file(self.path, jobs=self.jobs, progress=self.progress, offset=member['offset'],
+                                        length=member['length'], executor=self.executor)
+                    continue
+                digest = hashlib.sha256()
+                size = 0
+                with self.open(name) as reader:
+                    for data in iter(lambda: reader.read(huffman.FRAME_SIZE), b''):
+                        digest.update(data)
+                        size += len(data)
+                if size != member['size'] or member.get('sha256', digest.hexdigest()) != digest.hexdigest():
+                    raise ValueError('contents do not match the directory')
+            except ValueError as error:
+                raise ValueError(f'{name}: {error}') from None
+            if member.get('method') in ('store', 'chunks') and self.progress is not None:  # not advanced yet
+                self.progress.advance(member['length'], 1)
+
+    def extractall(self, path, names=None):
+        if names is None:
+            names = self.names()
+        if self.progress is not None and not self.progress.total:
+            self.progress.total = sum(self.index[name]['length'] for name in names)
+        for name in names:
+            self.extract(name, path)
+        for name in reversed(names):  # folder times change while their contents are written, so set them last
+            member = self.index[name]
+            if member['type'] == 'dir':
+                try:
+                    os.utime(os.path.join(path, *name.split('/')), (member['mtime'], member['mtime']))
+                except OSError:
+                    pass
+
+
+def member_path(path, name):  # where a member is extracted to in the folder path
+    destination = os.path.join(path, *name.split('/'))
+    # names come from the archive, so make sure none of them can write outside of path
+    if not os.path.abspath(destination).startswith(os.path.join(os.path.abspath(path), '')):
+        raise ValueError(f'unsafe member name {name}')
+    return destination
+
+
+def compact_archive(path, password='', progress=None):
+    """Rewrites an archive with only its current members, leaving out superseded members and old directories. The
+    compressed (and encrypted) data of each member is copied as it is, so nothing is decompressed or compressed again.
+    progress is advanced by the bytes copied. Returns the number of bytes reclaimed. The new archive is written next to
+    the old one and only replaces it once it is complete, and is deleted if anything goes wrong before then"""
+    temporary = path + '.tmp'
+    created = False  # so a file already there is left alone if the directory can't be read
+    try:
+        with open(path, 'rb') as source:
+            members, flags = read_directory(source, password)[:2]
+            old_size = source.seek(0, os.SEEK_END)
+            members = [member for member in members if not member.get('superseded')]
+            if progress is not None and not progress.total:
+                progress.total = sum(member['length'] for member in members if member['type'] == 'file')
+            with open(temporary, 'wb') as target:
+                created = True
+                target.write(ARCHIVE_MAGIC)
+                moved = {}  # old offset of every chunk copied so far: its new offset
+
+                def copy(start, length):  # copies length bytes from start in the old archive, returning the new offset
+                    new_offset = target.tell()
+                    copyfileobj_range(source, target, start, length)
+                    if progress is not None:
+                        progress.advance(length, 1)
+                    return new_offset
+
+                with stage_timer(progress)('copy'):
+                    for member in members:
+                        if member['type'] == 'dir':
+                            continue
+                        if member.get('method') == 'chunks':  # chunks shared by several members are copied once
+                            for entry in member['chunks']:
+                                if entry[0] not in moved:
+                                    moved[entry[0]] = copy(entry[0], entry[1])
+                                entry[0] = moved[entry[0]]
+                        else:
+                            member['offset'] = copy(member['offset'], member['length'])
+                write_directory(target, members, password if flags & ENCRYPTED else '')
+                new_size = target.tell()
+        os.replace(temporary, path)
+        return old_size - new_size
+    finally:
+        if created and os.path.exists(temporary):  # left by a failure part way through
+            os.remove(temporary)
+
+
+def copyfileobj_range(source, target, start, length):  # copies length bytes of source starting at start into target
+    source.seek(start)
+    while length > 0:
+        data = source.read(min(length, huffman.FRAME_SIZE))
+        if not data:
+            raise ValueError('unexpected end of archive')
+        target.write(data)
+        length -= len(data)
+
+
+def is_archive(path):  # checks the magic number at the start of the file
+    with open(path, 'rb') as f:
+        return f.read(len(ARCHIVE_MAGIC)) == ARCHIVE_MAGIC
+
+
+def is_encrypted(path):  # checks the trailer flags without reading the directory, so no password is needed
+    with open(path, 'rb') as f:
+        return bool(read_trailer(f)[3] & ENCRYPTED)
+
+
+def total_size(paths):  # bytes in every file under paths, used as the total for progress reporting
+    total = 0
+    for path in paths:
+        if os.path.isdir(path):
+            for folder, folders, files in os.walk(path):
+                for name in files:
+                    try:
+                        total += os.path.getsize(os.path.join(folder, name))
+                    except OSError:
+                        pass
+        else:
+            total += os.path.getsize(path)
+    return total
+
+
+def tar_size(paths):
+    """Bytes of the tar stream write_tar_archive makes of paths, used as the total for its progress since that is
+    what the compressor counts. Each member's header is built the way tarfile.add builds it, so long names and links
+    are counted exactly, and its data is padded to whole blocks. No file is read"""
+    tar = tarfile.TarFile(fileobj=io.BytesIO(), mode='w')  # only used for its settings and its record of hard links
+    size = 0
+
+    def add(path):  # walks path in the same order as tarfile.add
+        nonlocal size
+        try:
+            info = tar.gettarinfo(path)
+        except OSError:
+            return
+        if info is None:  # sockets and other files tarfile leaves out
+            return
+        size += len(info.tobuf(tar.format, tar.encoding, tar.errors))
+        if info.isreg():
+            size += -(-info.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+        elif info.isdir():
+            for name in sorted(os.listdir(path)):
+                add(os.path.join(path, name))
+
+    for path in paths:
+        add(path)
+    size += 2 * tarfile.BLOCKSIZE  # end of archive marker, then padding up to a whole record
+    return -(-size // tarfile.RECORDSIZE) * tarfile.RECORDSIZE
+
+
+def write_tar_archive(paths, archive_path, password='', block_size=huffman.BLOCK_SIZE, jobs=1, progress=None,
+                      sample_size=0, level=0, codec='huffman', dictionary=None):
+    """Writes paths as a tar stream straight through the compressor (and encryptor) into archive_path, with no
+    temporary file. progress is advanced by the bytes of tar data compressed. sample_size, level, codec and
+    dictionary are passed on to huffman.CompressWriter. The stream has the huffman.TAR flag set, which is how
+    readers tell it from a compressed file that happens to be a tar"""
+    if progress is not None and not progress.total:
+        progress.total = tar_size(paths)
+    with open(archive_path, 'wb') as f:
+        target = f
+        if password != '':
+            target = encrypt.EncryptWriter(f, password, progress)
+        with huffman.CompressWriter(target, block_size, jobs=jobs, progress=progress, sample_size=sample_size,
+                                    level=level, codec=codec, dictionary=dictionary, tar=True) as writer:
+            with tarfile.open(fileobj=writer, mode='w|') as tar:
+                for path in paths:
+                    with stage_timer(progress)('tar'):
+                        tar.add(path)
+        target.close()
+
+
+def extract_tar_archive(archive_path, path, password='', jobs=1, progress=None):
+    """Decrypts, decompresses and extracts a tar stream archive as it is read. progress is advanced by the bytes of
+    compressed data read. Members are extracted with tarfile's 'data' filter, so absolute paths, '..' and links
+    pointing outside path are refused. Raises ValueError or tarfile.TarError if the password is wrong, the archive is
+    corrupted, a member is unsafe or the stream was not written by write_tar_archive"""
+    if progress is not None and not progress.total:
+        progress.total = os.path.getsize(archive_path)
+    with open(archive_path, 'rb') as f:
+        source = f
+        if password != '':
+            source = encrypt.DecryptReader(f, password, progress)
+        with huffman.DecompressReader(source, jobs=jobs, progress=progress) as reader:
+            if not reader.tar:
+                raise ValueError('not a tar stream archive')
+            with tarfile.open(fileobj=reader, mode='r|') as tar:
+                with stage_timer(progress)('extract'):
+                    tar.extractall(path=path, filter='data')  # refuses members that would write outside path
@@ -0,0 +1,353 @@
+"""Reproducible benchmarks for compression, decompression, encryption and the archive pipeline.
+
+Every corpus is generated from a fixed seed, so results from different versions can be compared. Each case runs in
+a fresh process so its peak RSS is not hidden by an earlier case.
+
+    python benchmark.py --output results.json
+    python benchmark.py --baseline results.json    # exits with 1 if anything got slower or compresses worse
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import tempfile
+from time import perf_counter
+import zlib
+
+try:  # resource only exists on unix, peak RSS is not reported elsewhere
+    import resource
+except ImportError:
+    resource = None
+
+import archive
+import encrypt
+import huffman
+
+WORDS = ['the', 'of', 'and', 'to', 'in', 'a', 'is', 'that', 'for', 'it', 'as', 'was', 'with', 'be', 'by', 'on',
+         'not', 'he', 'this', 'are', 'or', 'his', 'from', 'at', 'which', 'but', 'have', 'an', 'had', 'they',
+         'compression', 'archive', 'huffman', 'encoding', 'directory', 'file', 'block', 'table']
+
+
+def text_data(size, seed=0):  # deterministic english-like text made of common words
+    generator = random.Random(seed)
+    output = []
+    length = 0
+    while length < size:
+        word = generator.choice(WORDS)
+        if generator.random() < 0.08:
+            word += '.\n'
+        output.append(word)
+        length += len(word) + 1
+    return ' '.join(output).encode()[:size]
+
+
+def source_data(size, seed=0):  # deterministic python-like source code with indentation and repeated identifiers
+    generator = random.Random(seed)
+    names = ['data', 'index', 'block', 'reader', 'writer', 'count', 'length', 'output', 'path', 'self.parent']
+    lines = []
+    length = 0
+    while length < size:
+        indent = '    ' * generator.randint(0, 3)
+        a, b = generator.choice(names), generator.choice(names)
+        line = generator.choice([f'{indent}{a} = {b} + {generator.randint(0, 255)}',
+                                 f'{indent}if {a} is not None:',
+                                 f'{indent}for {a} in range(len({b})):',
+                                 f'{indent}return {a}[{b}:{b} + {generator.randint(1, 64)}]',
+                                 f'{indent}# updates {a} from {b}'])
+        lines.append(line)
+        length += len(line) + 1
+    return '\n'.join(lines).encode()[:size]
+
+
+def media_data(size, seed=0):  # already compressed data, like the inside of a jpg, png or zip
+    output = bytearray()
+    part = 0
+    while len(output) < size:
+        output += zlib.compress(text_data(1 << 16, seed + part), 9)
+        part += 1
+    return bytes(output[:size])
+
+
+def random_data(size, seed=0):
+    return random.Random(seed).randbytes(size)
+
+
+def zero_data(size, seed=0):
+    return bytes(size)
+
+
+def binary_data(size, seed=0):  # deterministic binary data with a skewed distribution, like an executable
+    generator = random.Random(seed)
+    weights = [1000 if i == 0 else 200 if i == 255 else 50 if i < 32 else 10 for i in range(256)]
+    return bytes(generator.choices(range(256), weights=weights, k=size))
+
+
+def mixed_data(size, seed=0):  # text, binary and source code one after another, so the statistics change part way
+    third = size // 3
+    return text_data(third, seed) + binary_data(third, seed) + source_data(size - 2 * third, seed)
+
+
+CORPORA = {'text': text_data, 'source': source_data, 'media': media_data, 'random': random_data,
+           'zeros': zero_data, 'binary': binary_data, 'mixed': mixed_data}
+
+
+def write_tiny_files(folder, size, seed=0):  # many small text and config files adding up to about size bytes
+    generator = random.Random(seed)
+    total = 0
+    index = 0
+    while total < size:
+        data = generator.choice([text_data, source_data])(generator.randint(100, 2000), seed + index)
+        with open(os.path.join(folder, f'file{index:05}.txt'), 'wb') as f:
+            f.write(data)
+        total += len(data)
+        index += 1
+    return total
+
+
+def write_duplicated_files(folder, size, seed=0):  # copies of the same files, one shifted by a line, like backups
+    data = text_data(size // 4, seed)
+    for index in range(3):
+        with open(os.path.join(folder, f'copy{index}.txt'), 'wb') as f:
+            f.write(data)
+    with open(os.path.join(folder, 'edited.txt'), 'wb') as f:
+        f.write(b'a new first line\n' + data)
+    return 4 * len(data) + 17
+
+
+def peak_rss():  # peak resident memory of this process in MB, None where it can't be measured
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1e6 if platform.system() == 'Darwin' else peak / 1e3  # bytes on mac, kilobytes on linux
+
+
+def best_time(function, repeats):  # the fastest of several runs is the least disturbed by other processes
+    best = float('inf')
+    for _ in range(repeats):
+        start = perf_counter()
+        function()
+        best = min(best, perf_counter() - start)
+    return best
+
+
+def check_round_trip(output, expected, operation):  # a fast result is only worth reporting if it is also correct
+    if output != expected:
+        raise ValueError(f'{operation} did not give back its input')
+
+
+def check_extracted(source, output, operation):  # every file under source must come back with the same contents
+    for root, _, files in os.walk(source):
+        for name in files:
+            path = os.path.join(root, name)
+            with open(path, 'rb') as original, open(os.path.join(output, os.path.relpath(path, source)), 'rb') as copy:
+                check_round_trip(copy.read(), original.read(), operation)
+
+
+def run_case(corpus, operation, size, repeats):
+    """Runs one operation on one corpus, returning MB/s of uncompressed data, the compression ratio and peak RSS.
+    Sampled compression also reports how much larger its output is than a full count's. The output of each operation
+    is checked against its input once, outside the timed runs, raising ValueError if they differ"""
+    data = CORPORA[corpus](size)
+    compressed = huffman.compress(data)
+    ratio = len(compressed) / max(len(data), 1)
+    extra = {}
+    check_round_trip(huffman.decompress(compressed), data, operation)
+    if operation == 'huffman.compress':
+        seconds = best_time(lambda: huffman.compress(data), repeats)
+    elif operation == 'huffman.compress sampled':
+        sampled = huffman.compress(data, sample_size=huffman.SAMPLE_SIZE)
+        check_round_trip(huffman.decompress(sampled), data, operation)
+        extra['ratio_penalty'] = len(sampled) / len(compressed) - 1
+        ratio = len(sampled) / max(len(data), 1)
+        seconds = best_time(lambda: huffman.compress(data, sample_size=huffman.SAMPLE_SIZE), repeats)
+    elif operation in ('huffman.compress level=1', 'huffman.compress level=2'):
+        level = int(operation[-1])
+        output = huffman.compress(data, level=level)
+        check_round_trip(huffman.decompress(output), data, operation)
+        ratio = len(output) / max(len(data), 1)
+        seconds = best_time(lambda: huffman.compress(data, level=level), repeats)
+    elif operation == 'huffman.compress bwt':
+        output = huffman.compress(data, codec='bwt')
+        check_round_trip(huffman.decompress(output), data, operation)
+        ratio = len(output) / max(len(data), 1)
+        seconds = best_time(lambda: huffman.compress(data, codec='bwt'), repeats)
+    elif operation == 'huffman.decompress bwt':
+        compressed = huffman.compress(data, codec='bwt')
+        check_round_trip(huffman.decompress(compressed), data, operation)
+        ratio = len(compressed) / max(len(data), 1)
+        seconds = best_time(lambda: huffman.decompress(compressed), repeats)
+    elif operation == 'huffman.decompress level=2':
+        compressed = huffman.compress(data, level=2)
+        check_round_trip(huffman.decompress(compressed), data, operation)
+        ratio = len(compressed) / max(len(data), 1)
+        seconds = best_time(lambda: huffman.decompress(compressed), repeats)
+    elif operation in ('huffman.compress 1k pieces', 'huffman.compress 1k pieces dictionary'):
+        dictionary = None
+        if operation.endswith('dictionary'):  # trained on the start of the corpus, like a sample of similar files
+            with tempfile.NamedTemporaryFile(delete=False) as f:
+                f.write(data[:1 << 16])
+            dictionary = huffman.train_dictionary([f.name])
+            os.remove(f.name)
+        pieces = list(huffman.chunks(data, 1024))
+        outputs = [huffman.compress(piece, dictionary=dictionary) for piece in pieces]
+        check_round_trip(b''.join(huffman.decompress(output) for output in outputs), data, operation)
+        ratio = sum(len(output) for output in outputs) / max(len(data), 1)
+        seconds = best_time(lambda: [huffman.compress(piece, dictionary=dictionary) for piece in pieces], repeats)
+    elif operation == 'huffman.compress jobs=4':
+        check_round_trip(huffman.decompress(huffman.compress(data, jobs=4)), data, operation)
+        seconds = best_time(lambda: huffman.compress(data, jobs=4), repeats)
+    elif operation == 'huffman.decompress':
+        seconds = best_time(lambda: huffman.decompress(compressed), repeats)
+    elif operation == 'huffman.verify':  # decodes from a map of the file and checks checksums, writing nothing
+        with tempfile.NamedTemporaryFile(delete=False) as f:
+            f.write(compressed)
+        huffman.verify_file(f.name)  # raises ValueError at the first frame that does not match its checksum
+        seconds = best_time(lambda: huffman.verify_file(f.name), repeats)
+        os.remove(f.name)
+    elif operation == 'huffman.decompress tree':
+        check_round_trip(huffman.decompress(compressed, use_table=False), data, operation)
+        seconds = best_time(lambda: huffman.decompress(compressed, use_table=False), repeats)
+    elif operation == 'encrypt.encrypt':
+        check_round_trip(encrypt.decrypt(encrypt.encrypt(compressed, 'password'), 'password'), compressed, operation)
+        seconds = best_time(lambda: encrypt.encrypt(compressed, 'password'), repeats)
+        ratio = None
+    elif operation == 'encrypt.decrypt':
+        ciphertext = encrypt.encrypt(compressed, 'password')
+        check_round_trip(encrypt.decrypt(ciphertext, 'password'), compressed, operation)
+        seconds = best_time(lambda: encrypt.decrypt(ciphertext, 'password'), repeats)
+        ratio = None
+    else:
+        raise ValueError(f'unknown operation {operation}')
+    return {'mb_per_s': len(data) / 1e6 / seconds, 'ratio': ratio, 'peak_rss_mb': peak_rss(), **extra}
+
+
+def run_archive_case(corpus, operation, size, repeats):
+    """Times the full pipeline used by main.CreateArchive and DecompressArchive on a folder of files. The archive is
+    extracted and compared with the folder once before the timed runs"""
+    folder = tempfile.mkdtemp()
+    try:
+        source = os.path.join(folder, 'source')
+        os.mkdir(source)
+        if corpus == 'tiny files':
+            total = write_tiny_files(source, size)
+        elif corpus == 'duplicated files':
+            total = write_duplicated_files(source, size)
+        else:
+            with open(os.path.join(source, corpus), 'wb') as f:
+                total = f.write(CORPORA[corpus](size))
+        archive_path = os.path.join(folder, 'archive.z')
+        password = 'password' if 'encrypted' in operation else ''
+
+        def create():
+            if 'dedup' in operation:
+                with archive.ArchiveWriter(archive_path, password, dedup=True) as writer:
+                    writer.add(source)
+            else:
+                archive.write_tar_archive([source], archive_path, password)
+
+        def extract():
+            shutil.rmtree(os.path.join(folder, 'output'), ignore_errors=True)
+            if 'dedup' in operation:
+                with archive.ArchiveReader(archive_path, password) as reader:
+                    reader.extractall(os.path.join(folder, 'output'))
+            else:
+                archive.extract_tar_archive(archive_path, os.path.join(folder, 'output'), password)
+
+        create()
+        extract()
+        if 'dedup' in operation:
+            extracted = os.path.join(folder, 'output', 'source')
+        else:  # tarfile keeps the whole path, without the drive and leading separator
+            extracted = os.path.join(folder, 'output', os.path.splitdrive(source)[1].lstrip(os.sep))
+        check_extracted(source, extracted, operation)
+        seconds = best_time(extract if operation.startswith('extract') else create, repeats)
+        return {'mb_per_s': total / 1e6 / seconds, 'ratio': os.path.getsize(archive_path) / total,
+                'peak_rss_mb': peak_rss()}
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+OPERATIONS = ['huffman.compress', 'huffman.compress sampled', 'huffman.compress level=1', 'huffman.compress level=2',
+              'huffman.decompress level=2', 'huffman.compress bwt', 'huffman.decompress bwt',
+              'huffman.compress 1k pieces', 'huffman.compress 1k pieces dictionary', 'huffman.compress jobs=4',
+              'huffman.decompress', 'huffman.verify', 'huffman.decompress tree', 'encrypt.encrypt', 'encrypt.decrypt']
+ARCHIVE_OPERATIONS = ['create archive', 'create archive encrypted', 'extract archive', 'extract archive encrypted',
+                      'create archive dedup', 'extract archive dedup']
+ARCHIVE_CORPORA = ['text', 'media', 'tiny files', 'duplicated files']
+
+
+def run_isolated(function, *args):  # runs in a new process so the peak RSS belongs to this case alone
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return executor.submit(function, *args).result()
+
+
+def run_all(size, repeats, selected=None):
+    cases = [(corpus, operation, run_case) for corpus in CORPORA for operation in OPERATIONS]
+    cases += [(corpus, operation, run_archive_case) for corpus in ARCHIVE_CORPORA for operation in ARCHIVE_OPERATIONS]
+    results = {}
+    for corpus, operation, function in cases:
+        name = f'{corpus}/{operation}'
+        if selected and not any(part in name for part in selected):
+            continue
+        results[name] = run_isolated(function, corpus, operation, size, repeats)
+        print(format_result(name, results[name]), flush=True)
+    return results
+
+
+def format_result(name, result, change=''):
+    ratio = '' if result['ratio'] is None else f'{result["ratio"]:7.3f}'
+    rss = '' if result['peak_rss_mb'] is None else f'{result["peak_rss_mb"]:8.1f} MB'
+    if 'ratio_penalty' in result:
+        change = f'ratio {result["ratio_penalty"]:+.2%} vs full count  {change}'
+    return f'{name:45} {result["mb_per_s"]:9.2f} MB/s {ratio:>7} {rss:>11} {change}'
+
+
+def compare(results, baseline, tolerance):
+    """Prints each result next to the baseline and returns the names of cases that got slower by more than tolerance
+    or compress noticeably worse"""
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        old = baseline[name]
+        change = result['mb_per_s'] / old['mb_per_s'] - 1
+        worse = change < -tolerance
+        if result['ratio'] is not None and old['ratio'] is not None and result['ratio'] > old['ratio'] * 1.01:
+            worse = True
+        if worse:
+            regressions.append(name)
+        print(format_result(name, result, f'{change:+.1%}{"  REGRESSION" if worse else ""}'))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark compression, decompression, encryption and archiving')
+    parser.add_argument('--size', type=int, default=1_000_000, help='bytes in each corpus')
+    parser.add_argument('--repeats', type=int, default=3, help='runs of each case, the fastest is kept')
+    parser.add_argument('--output', help='file to write the results to as json')
+    parser.add_argument('--baseline', help='json results of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='slowdown allowed before a case is a regression')
+    parser.add_argument('cases', nargs='*', help='only run cases whose name contains one of these')
+    args = parser.parse_args()
+
+    results = run_all(args.size, args.repeats, args.cases)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'python': platform.python_version(), 'numpy': huffman.load_numpy() is not None,
+                       'size': args.size, 'results': results}, f, indent=4)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        print('\ncompared with', args.baseline)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f'{len(regressions)} regression(s): {", ".join(regressions)}')
+            raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,245 @@
+import re
+
+import huffman  # for load_numpy, numpy is optional and without it the suffix array is built with SA-IS in pure python
+
+RUN_A = 0  # zero runs are written in bijective base 2 with these two digits, like bzip2
+RUN_B = 1
+SYMBOLS = 257  # RUN_A, RUN_B, then move to front indexes 1-255 as 2-256
+
+
+def sa_is(s, upper):
+    """Suffix array of the list of ints s, whose values are 0 to upper, in linear time by induced sorting. The LMS
+    substrings are sorted by induction, named, and if any names repeat the reduced string is sorted recursively.
+    A suffix that is a prefix of another sorts first, as if s ended with a character smaller than any other"""
+    n = len(s)
+    if n == 0:
+        return []
+    if n == 1:
+        return [0]
+    if n == 2:
+        return [0, 1] if s[0] < s[1] else [1, 0]
+    sa = [0] * n
+    s_type = [False] * n  # True where the suffix is smaller than the one after it
+    for i in range(n - 2, -1, -1):
+        s_type[i] = s_type[i + 1] if s[i] == s[i + 1] else s[i] < s[i + 1]
+    bucket_l = [0] * (upper + 1)  # where the L type suffixes of each character start
+    bucket_s = [0] * (upper + 1)  # where the S type suffixes of each character start
+    for i in range(n):
+        if s_type[i]:
+            bucket_l[s[i] + 1] += 1
+        else:
+            bucket_s[s[i]] += 1
+    for i in range(upper + 1):
+        bucket_s[i] += bucket_l[i]
+        if i < upper:
+            bucket_l[i + 1] += bucket_s[i]
+
+    def induce(lms):
+        for i in range(n):
+            sa[i] = -1
+        start = bucket_s[:]
+        for i in lms:
+            sa[start[s[i]]] = i
+            start[s[i]] += 1
+        start = bucket_l[:]
+        sa[start[s[n - 1]]] = n - 1
+        start[s[n - 1]] += 1
+        for i in range(n):
+            v = sa[i]
+            if v >= 1 and not s_type[v - 1]:
+                sa[start[s[v - 1]]] = v - 1
+                start[s[v - 1]] += 1
+        start = bucket_l[:]
+        for i in range(n - 1, -1, -1):
+            v = sa[i]
+            if v >= 1 and s_type[v - 1]:
+                start[s[v - 1] + 1] -= 1
+                sa[start[s[v - 1] + 1]] = v - 1
+
+    lms_index = [-1] * n  # position of each LMS suffix in lms
+    lms = []
+    for i in range(1, n):
+        if not s_type[i - 1] and s_type[i]:
+            lms_index[i] = len(lms)
+            lms.append(i)
+    induce(lms)
+
+    if lms:
+        sorted_lms = [v for v in sa if lms_index[v] != -1]
+        reduced = [0] * len(lms)
+        name = 0
+        for i in range(1, len(sorted_lms)):
+            left, right = sorted_lms[i - 1], sorted_lms[i]
+            end_left = lms[lms_index[left] + 1] if lms_index[left] + 1 < len(lms) else n
+            end_right = lms[lms_index[right] + 1] if lms_index[right] + 1 < len(lms) else n
+            same = end_left - left == end_right - right
+            if same:
+                while left < end_left and s[left] == s[right]:
+                    left += 1
+                    right += 1
+                same = left < n and s[left] == s[right] and left == end_left
+            if not same:
+                name += 1
+            reduced[lms_index[sorted_lms[i]]] = name
+        reduced_sa = sa_is(reduced, name)
+        induce([lms[i] for i in reduced_sa])
+    return sa
+
+
+def prefix_doubling(data):
+    """NumPy suffix array by prefix doubling: suffixes are sorted by their first 2k characters using the ranks of the
+    first k, until every rank is different. Takes O(n log n) per round, but each round is a single sort"""
+    np = huffman.load_numpy()
+    n = len(data)
+    rank = np.frombuffer(data, dtype=np.uint8).astype(np.int64)
+    scale = max(n, 256) + 1
+    k = 1
+    while True:
+        second = np.zeros(n, dtype=np.int64)  # 0 past the end, so shorter suffixes sort first
+        second[:n - k] = rank[k:] + 1
+        key = rank * scale + second
+        order = np.argsort(key, kind='stable')
+        sorted_key = key[order]
+        new_rank = np.empty(n, dtype=np.int64)
+        new_rank[order[0]] = 0
+        new_rank[order[1:]] = np.cumsum(sorted_key[1:] != sorted_key[:-1])
+        rank = new_rank
+        if rank.max() == n - 1 or k >= n:
+            return order
+        k *= 2
+
+
+def suffix_array(data):
+    if huffman.load_numpy() is not None and len(data) > 1:
+        return prefix_doubling(data)
+    return sa_is(list(data), 255)
+
+
+def transform(data):
+    """Burrows-Wheeler transform of data with an end marker that sorts first. Returns the last column of the sorted
+    rotations with the end marker left out, and the row it was taken from"""
+    np = huffman.load_numpy()
+    n = len(data)
+    sa = suffix_array(data)
+    if np is not None and n > 1:
+        sa = np.asarray(sa)
+        characters = np.frombuffer(data, dtype=np.uint8)
+        primary = int(np.flatnonzero(sa == 0)[0]) + 1
+        last = characters[sa - 1]  # the row of the suffix at 0 picks up data[-1] here, and is removed below
+        return bytes(characters[-1:]) + last[:primary - 1].tobytes() + last[primary:].tobytes(), primary
+    last = bytearray(data[-1:])
+    primary = 0
+    for row, start in enumerate(sa):
+        if start == 0:
+            primary = row + 1
+        else:
+            last.append(data[start - 1])
+    return bytes(last), primary
+
+
+def inverse(last, primary):
+    """Undoes transform by following the LF mapping back from the row starting with the end marker. Each step gives
+    the character before the one already found, so the output is filled in from the end"""
+    n = len(last)
+    if n == 0:
+        return bytearray()
+    if not 1 <= primary <= n:
+        raise ValueError('invalid primary index')
+    # the end marker goes back in at primary, as 0, with every character moved up by 1
+    np = huffman.load_numpy()
+    if np is not None:
+        characters = np.frombuffer(last, dtype=np.uint8).astype(np.int16) + 1
+        column = np.concatenate((characters[:primary], [0], characters[primary:]))
+        lf = np.empty(n + 1, dtype=np.int64)
+        lf[np.argsort(column, kind='stable')] = np.arange(n + 1)
+        lf = lf.tolist()
+    else:
+        column = [character + 1 for character in last]
+        column.insert(primary, 0)
+        start = [0] * 258
+        for character in column:
+            start[character + 1] += 1
+        for character in range(1, 258):
+            start[character] += start[character - 1]
+        lf = [0] * (n + 1)
+        for row, character in enumerate(column):
+            lf[row] = start[character]
+            start[character] += 1
+    rows = [0] * n
+    row = 0
+    for i in range(n - 1, -1, -1):
+        rows[i] = row
+        row = lf[row]
+    if np is not None:
+        return bytearray((column[rows] - 1).astype(np.uint8).tobytes())
+    return bytearray(column[row] - 1 for row in rows)
+
+
+def move_to_front(data):  # replaces each character with how many different characters were seen since it last was
+    table = bytearray(range(256))
+    output = bytearray(len(data))
+    front = 0
+    for i, character in enumerate(data):
+        if character != front:
+            index = table.index(character)
+            del table[index]
+            table.insert(0, character)
+            output[i] = index
+            front = character
+    return output
+
+
+def inverse_move_to_front(indexes):
+    table = bytearray(range(256))
+    output = bytearray(len(indexes))
+    front = 0
+    for i, index in enumerate(indexes):
+        if index:
+            front = table[index]
+            del table[index]
+            table.insert(0, front)
+        output[i] = front
+    return output
+
+
+def zero_runs(indexes):
+    """Turns move to front indexes into symbols: each run of 0s becomes its length in bijective base 2 written with
+    RUN_A and RUN_B, least significant digit first, and every other index is moved up by 1"""
+    symbols = []
+    for part in re.split(b'(\x00+)', bytes(indexes)):
+        if not part:
+            continue
+        if part[0]:
+            symbols += [index + 1 for index in part]
+            continue
+        run = len(part)
+        while run:
+            if run & 1:
+                symbols.append(RUN_A)
+                run = (run - 1) >> 1
+            else:
+                symbols.append(RUN_B)
+                run = (run - 2) >> 1
+    return symbols
+
+
+def expand_runs(symbols, count):  # undoes zero_runs, raising ValueError if the result is not count indexes long
+    output = bytearray()
+    run = 0
+    weight = 1
+    for symbol in symbols:
+        if symbol <= RUN_B:
+            run += weight << symbol  # RUN_A is worth 1 in this digit, RUN_B 2
+            weight <<= 1
+            continue
+        if run:
+            if len(output) + run > count:  # checked before allocating, a few symbols can stand for a huge run
+                raise ValueError('invalid run lengths')
+            output += bytes(run)
+            run = 0
+            weight = 1
+        output.append(symbol - 1)
+    if len(output) + run != count:
+        raise ValueError('invalid run lengths')
+    output += bytes(run)
+    return output
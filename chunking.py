@@ -0,0 +1,60 @@
+import random
+import struct
+
+import huffman  # for load_numpy, numpy is optional and without it the rolling hash is worked out one byte at a time
+
+MIN_CHUNK = 1 << 14  # no cut is made closer than this to the last one
+MAX_CHUNK = 1 << 18  # a cut is forced if no content defined one is found within this many bytes
+CUT_MASK = 0xaaaaaaaa  # a cut goes after any byte where these 16 hash bits are 0, every 64 KiB on average
+SEGMENT = 1 << 23  # bytes hashed at once, so memory does not grow with the size of the file
+# random value for each byte, from a fixed seed so the same data is always cut in the same places
+GEAR = struct.unpack('>256I', random.Random(0x6c70).randbytes(1024))
+
+
+def gear_hashes(data):
+    """NumPy version of the gear rolling hash, where each byte shifts the hash left by 1 and adds its GEAR value. Only
+    the last 32 bytes can affect a 32 bit hash, so the hash at every position is the sum of 32 shifted GEAR values,
+    which is built from sums over 1, 2, 4, 8 and 16 bytes"""
+    np = huffman.load_numpy()
+    hashes = np.array(GEAR, dtype=np.uint32)[np.frombuffer(data, dtype=np.uint8)]
+    width = 1
+    while width < 32:
+        shifted = np.zeros_like(hashes)
+        shifted[width:] = hashes[:-width] << np.uint32(width)
+        hashes += shifted
+        width *= 2
+    return hashes
+
+
+def candidates(data, begin, end):  # positions from begin to end where the hash allows a cut, as the end of a chunk
+    lead = min(begin, 31)  # the bytes before begin that are still in the hash
+    np = huffman.load_numpy()
+    if np is not None:
+        hashes = gear_hashes(data[begin - lead:end])[lead:]
+        return (np.flatnonzero((hashes & np.uint32(CUT_MASK)) == 0) + begin + 1).tolist()
+    output = []
+    rolling = 0
+    for position in range(begin - lead, end):
+        rolling = ((rolling << 1) + GEAR[data[position]]) & 0xffffffff
+        if position >= begin and not rolling & CUT_MASK:
+            output.append(position + 1)
+    return output
+
+
+def chunk_ends(data):
+    """Yields where each content defined chunk of data ends. Cuts depend only on the 32 bytes before them, so a
+    region repeated anywhere, even at a different offset or in another file, is mostly cut into the same chunks"""
+    start = 0
+    for begin in range(0, len(data), SEGMENT):
+        for cut in candidates(data, begin, min(begin + SEGMENT, len(data))):
+            while cut - start > MAX_CHUNK:
+                start += MAX_CHUNK
+                yield start
+            if cut - start >= MIN_CHUNK:
+                start = cut
+                yield cut
+    while len(data) - start > MAX_CHUNK:
+        start += MAX_CHUNK
+        yield start
+    if start < len(data):
+        yield len(data)
@@ -0,0 +1,299 @@
+"""Command line interface for running without a display, such as from cron or in CI containers.
+
+    python cli.py compress report.txt logs/ --output-dir /backups --jobs 4
+    python cli.py decompress /backups/report.txt.z /backups/logs.z --output-dir restored
+    python cli.py list /backups/logs.z
+    python cli.py test /backups/*.z    # checks every frame against its checksum, writing nothing
+    python cli.py compress --batch pairs.txt --jobs 8    # one 'input<tab>output' pair per line, '-' for stdin
+
+Every input is a separate job and jobs run at the same time on a pool of up to --jobs processes. A single input uses
+the --jobs processes to compress or decompress its frames instead. Only huffman is imported at start up: encrypt is
+imported when a password is used, archive and tarfile when a folder or an archive is handled, numpy, bwt and lz77
+only by the code paths that use them, logging with --verbose, and the GUI's tkinter and pillow never are, so short
+jobs are not dominated by start up time. Exits with 1 if any job failed.
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import io
+import os
+import shutil
+import sys
+
+import huffman
+
+SUFFIX = '.z'  # added to compressed outputs and removed again when they are decompressed
+ARCHIVE_PREFIX = b'LPA'  # random access archives, see archive.ARCHIVE_MAGIC
+ENCRYPTED_PREFIX = b'LPE'  # encrypted streams, see encrypt.CHUNKED_MAGIC
+
+
+def new_progress(options, job):  # logs json progress snapshots of job with --verbose, otherwise nothing is tracked
+    if not options['verbose']:
+        return None
+    from progress import Progress, ProgressLogger
+    return Progress(callback=ProgressLogger(job=job))
+
+
+def read_magic(path):
+    with open(path, 'rb') as f:
+        return f.read(len(huffman.MAGIC))
+
+
+def is_encrypted(magic):
+    return magic.startswith(ENCRYPTED_PREFIX)
+
+
+def open_stream(file, password, jobs=1, progress=None):
+    """Returns a buffered reader of the decrypted and decompressed contents of the stream in file, which is read as
+    it goes. Closing it does not close file"""
+    source = file
+    magic = file.read(len(huffman.MAGIC))
+    file.seek(-len(magic), io.SEEK_CUR)
+    if is_encrypted(magic):
+        if password == '':
+            raise ValueError('encrypted, a password is needed')
+        import encrypt
+        source = encrypt.DecryptReader(file, password, progress)
+    return io.BufferedReader(huffman.DecompressReader(source, jobs=jobs, progress=progress), huffman.FRAME_SIZE)
+
+
+def is_tar(file, password):
+    """Whether the stream in file was written from folders by archive.write_tar_archive, from the huffman.TAR flag
+    in its header rather than from what it holds, so a compressed .tar file comes back as a file. Only the header is
+    read (after decrypting the first chunk), then file is rewound so the stream can be read by whatever suits it"""
+    with open_stream(file, password) as stream:
+        tar = stream.raw.tar
+    file.seek(0)
+    return tar
+
+
+def stream_size(file):  # characters in an unencrypted stream, from the frame headers alone
+    huffman.read_header(file)
+    total = 0
+    while True:
+        size, payload_size = huffman.FRAME_HEADER.unpack(huffman.read_exact(file, huffman.FRAME_HEADER.size))
+        if size == 0:
+            return total
+        total += size
+        file.seek(payload_size, io.SEEK_CUR)
+
+
+def compress_job(source, destination, options, jobs):
+    """Compresses a file into a stream, or a folder into a tar stream archive, or a random access archive with
+    --random-access. Encrypted if a password is given"""
+    progress = new_progress(options, source)
+    settings = {'sample_size': options['sample_size'], 'level': options['level'], 'codec': options['codec'],
+                'dictionary': options['dictionary']}
+    password = options['password']
+    if options['random_access']:
+        import archive
+        with archive.ArchiveWriter(destination, password, jobs=jobs, progress=progress, **settings) as writer:
+            writer.add(source)
+    elif os.path.isdir(source):
+        import archive
+        archive.write_tar_archive([source], destination, password, jobs=jobs, progress=progress, **settings)
+    elif password == '':
+        huffman.compress_file(source, destination, jobs=jobs, progress=progress, **settings)
+    else:
+        import encrypt
+        with open(destination, 'wb') as f:
+            target = encrypt.EncryptWriter(f, password, progress)
+            with huffman.CompressWriter(target, jobs=jobs, progress=progress, **settings) as writer:
+                writer.write_file(source)
+            target.close()
+    if progress is not None:
+        progress.finish()
+    ratio = os.path.getsize(destination) / max(archive_size(source), 1)
+    return [f'{source} -> {destination} ({"%.3f" % ratio})']
+
+
+def archive_size(path):  # bytes of input a job compressed, for the ratio it reports
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    import archive
+    return archive.total_size([path])
+
+
+def decompress_job(source, destination, options, jobs):
+    """Extracts a random access archive or a tar stream archive into the folder destination, or decompresses any
+    other stream into the file destination"""
+    progress = new_progress(options, source)
+    password = options['password']
+    magic = read_magic(source)
+    if magic.startswith(ARCHIVE_PREFIX):
+        import archive
+        with archive.ArchiveReader(source, password, jobs, progress) as reader:
+            reader.extractall(destination)
+    else:
+        with open(source, 'rb') as f:
+            if is_tar(f, password):
+                import tarfile
+                from progress import stage_timer
+                with open_stream(f, password, jobs, progress) as stream:
+                    with tarfile.open(fileobj=stream, mode='r|') as tar:
+                        with stage_timer(progress)('extract'):
+                            tar.extractall(path=destination, filter='data')  # nothing outside destination
+            elif not is_encrypted(magic):  # the file can be mapped instead of decoded through a stream
+                huffman.decompress_file(source, destination, jobs=jobs, progress=progress)
+            else:
+                with open_stream(f, password, jobs, progress) as stream, open(destination, 'wb') as output:
+                    shutil.copyfileobj(stream, output, huffman.FRAME_SIZE)
+    if progress is not None:
+        progress.finish()
+    return [f'{source} -> {destination}']
+
+
+def list_job(source, destination, options, jobs):
+    """Lists the size and name of every member of an archive. Random access archives only need their directory read
+    and tar streams are decompressed to find their members. Any other stream is listed as one file"""
+    password = options['password']
+    lines = [f'{source}:']
+    if read_magic(source).startswith(ARCHIVE_PREFIX):
+        import archive
+        with archive.ArchiveReader(source, password) as reader:
+            for member in reader.members:
+                name = member['name'] + ('/' if member['type'] == 'dir' else '')
+                lines.append(f'{member["size"]:>14} {name}')
+        return lines
+    with open(source, 'rb') as f:
+        if is_tar(f, password):
+            import tarfile
+            with open_stream(f, password, jobs) as stream, tarfile.open(fileobj=stream, mode='r|') as tar:
+                for member in tar:
+                    lines.append(f'{member.size:>14} {member.name}' + ('/' if member.isdir() else ''))
+            return lines
+        if not is_encrypted(read_magic(source)):
+            size = stream_size(f)
+        else:
+            with open_stream(f, password, jobs) as stream:
+                size = sum(len(data) for data in iter(lambda: stream.read(huffman.FRAME_SIZE), b''))
+    return lines + [f'{size:>14} {os.path.basename(output_name(source))}']
+
+
+def test_job(source, destination, options, jobs):
+    """Decodes everything in source and checks it against its checksums without writing anything, so corruption or
+    a wrong password raises. Unencrypted streams are checked frame by frame on jobs processes and stop at the first
+    bad frame, giving its offset"""
+    progress = new_progress(options, source)
+    password = options['password']
+    if read_magic(source).startswith(ARCHIVE_PREFIX):
+        import archive
+        with archive.ArchiveReader(source, password, jobs, progress) as reader:
+            reader.verify()
+    elif not is_encrypted(read_magic(source)):
+        huffman.verify_file(source, jobs=jobs, progress=progress)
+    else:
+        with open(source, 'rb') as f:
+            with open_stream(f, password, jobs, progress) as stream:
+                while stream.read(huffman.FRAME_SIZE):
+                    pass
+    if progress is not None:
+        progress.finish()
+    return [f'{source}: OK']
+
+
+COMMANDS = {'compress': compress_job, 'decompress': decompress_job, 'list': list_job, 'test': test_job}
+
+
+def output_name(path):  # name of the decompressed output of path: without SUFFIX, or with '.out' added if it has none
+    path = os.path.normpath(path)
+    if path.endswith(SUFFIX) and len(os.path.basename(path)) > len(SUFFIX):
+        return path[:-len(SUFFIX)]
+    return path + '.out'
+
+
+def default_output(command, path, output_dir):
+    if command == 'compress':
+        output = os.path.normpath(path) + SUFFIX
+    elif command == 'decompress':
+        output = output_name(path)
+    else:
+        return None  # list and test write nothing
+    if output_dir is not None:
+        output = os.path.join(output_dir, os.path.basename(output))
+    return output
+
+
+def read_batch(path):  # (input, output or None) for each 'input<tab>output' or 'input' line of path, '-' for stdin
+    with (sys.stdin if path == '-' else open(path)) as f:
+        pairs = []
+        for line in f:
+            line = line.rstrip('\n')
+            if not line.strip() or line.startswith('#'):
+                continue
+            source, _, destination = line.partition('\t')
+            pairs.append((source, destination or None))
+        return pairs
+
+
+def run_job(command, source, destination, options, jobs):  # runs in a worker, returning (success, lines to print)
+    try:
+        return True, COMMANDS[command](source, destination, options, jobs)
+    except Exception as error:  # reported against its input, so one bad file does not stop the rest of the batch
+        return False, [f'{source}: {type(error).__name__}: {error}']
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description='Compress, decompress, list and test files and archives')
+    parser.add_argument('command', choices=list(COMMANDS))
+    parser.add_argument('inputs', nargs='*', help='files, folders or archives, each one a separate job')
+    parser.add_argument('-o', '--output', help='output path, only with a single input')
+    parser.add_argument('--output-dir', help='folder the outputs are written to, instead of next to the inputs')
+    parser.add_argument('--batch', help="file of 'input<tab>output' lines to add as jobs, '-' reads stdin")
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1, help='processes to run at once')
+    parser.add_argument('--password-env', help='environment variable holding the password, so it is not in ps')
+    parser.add_argument('--level', type=int, default=0, choices=range(4), help='0 for huffman only, 1-3 for LZ77')
+    parser.add_argument('--codec', default='huffman', choices=huffman.CODECS)
+    parser.add_argument('--sample-size', type=int, default=0, help='characters sampled to build each codebook')
+    parser.add_argument('--dictionary', help='id of a trained dictionary to compress with')
+    parser.add_argument('--random-access', action='store_true', help='compress into a random access archive')
+    parser.add_argument('-v', '--verbose', action='store_true', help='log progress of each job as json to stderr')
+    args = parser.parse_args(arguments)
+
+    pairs = [(path, None) for path in args.inputs]
+    if args.batch is not None:
+        pairs += read_batch(args.batch)
+    if not pairs:
+        parser.error('no inputs given')
+    if args.output is not None:
+        if len(pairs) != 1:
+            parser.error('--output only works with a single input, use --output-dir or --batch')
+        pairs = [(pairs[0][0], args.output)]
+    if args.jobs < 1:
+        parser.error('--jobs must be at least 1')
+    password = ''
+    if args.password_env is not None:
+        if args.password_env not in os.environ:
+            parser.error(f'environment variable {args.password_env} is not set')
+        password = os.environ[args.password_env]
+    if args.verbose:
+        import logging
+        logging.basicConfig(level=logging.INFO, format='%(message)s')
+    if args.output_dir is not None and args.command in ('compress', 'decompress'):
+        os.makedirs(args.output_dir, exist_ok=True)
+    options = {'password': password, 'level': args.level, 'codec': args.codec, 'sample_size': args.sample_size,
+               'dictionary': args.dictionary, 'random_access': args.random_access, 'verbose': args.verbose}
+    tasks = [(args.command, source, destination or default_output(args.command, source, args.output_dir), options)
+             for source, destination in pairs]
+
+    failed = 0
+    if len(tasks) == 1 or args.jobs == 1:  # frames are spread over the processes instead, or everything runs here
+        results = (run_job(*task, args.jobs if len(tasks) == 1 else 1) for task in tasks)
+        executor = None
+    else:
+        executor = ProcessPoolExecutor(min(args.jobs, len(tasks)))
+        results = (future.result() for future in as_completed([executor.submit(run_job, *task, 1) for task in tasks]))
+    try:
+        for success, lines in results:  # printed as each job finishes
+            for line in lines:
+                print(line, file=sys.stdout if success else sys.stderr, flush=True)
+            failed += not success
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    if failed:
+        print(f'{failed} of {len(tasks)} jobs failed', file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
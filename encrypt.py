@@ -1,37 +1,186 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import hashlib
+import io
 import os
-import sys
 
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 
+from progress import stage_timer
 
-def encrypt(plaintext, password):
+CHUNKED_MAGIC = b'LPE\x02'  # start of data written by EncryptWriter, followed by the chunk size and a salt
+CHUNK_BITS = 16  # each chunk holds 2 ** CHUNK_BITS bytes of plaintext, except the last which always holds fewer
+SALT_SIZE = 16
+TAG_SIZE = 16  # authentication tag added to the end of every chunk
 
-    padding = 0
-    while len(plaintext) % 16 != 0:      # ensures the plaintext is a multiple of 16 bytes, and stores by how much
-        plaintext += b'0'
-        padding += 1
-    plaintext = padding.to_bytes(16, byteorder=sys.byteorder) + plaintext
 
+def chunk_key(password, salt):  # every stream gets its own key, so chunk nonces can simply count up from 0
     key = hashlib.sha256(password.encode()).digest()  # returns 32 byte hash of password
-    iv = os.urandom(16)  # initialisation vector (random data to stop identical files returning the same ciphertext)
+    return HKDF(algorithm=hashes.SHA256(), length=32, salt=salt, info=b'LPE chunk key').derive(key)
 
-    encryptor = Cipher(algorithms.AES(key), modes.CBC(iv)).encryptor()
-    ciphertext = encryptor.update(plaintext) + encryptor.finalize()  # cipher text
-    return iv + ciphertext  # prepends iv to the ciphertext
 
+def chunk_nonce(index, last):  # the last chunk is sealed differently, so a stream cut off between chunks is detected
+    return index.to_bytes(11, 'big') + bytes([last])
 
-def decrypt(ciphertext, password):
 
-    key = hashlib.sha256(password.encode()).digest()
-    iv = ciphertext[:16]
+def seal_chunk(cipher, index, plaintext, last):
+    return cipher.encrypt(chunk_nonce(index, last), bytes(plaintext), None)
 
-    ciphertext = ciphertext[16:]
 
-    decryptor = Cipher(algorithms.AES(key), modes.CBC(iv)).decryptor()
-    plaintext = decryptor.update(ciphertext) + decryptor.finalize()  # decrypts ciphertext
-    padding = int.from_bytes(plaintext[:16], byteorder=sys.byteorder)
-    plaintext = plaintext[16:]
-    plaintext = plaintext[:len(plaintext)-padding]   # removes padding
+def open_chunk(cipher, index, ciphertext, last):
+    try:
+        return cipher.decrypt(chunk_nonce(index, last), bytes(ciphertext), None)
+    except InvalidTag:
+        raise ValueError(f'chunk {index} failed authentication, '
+                         'the password is wrong or the data is corrupted') from None
 
+
+class EncryptWriter(io.RawIOBase):
+    """Writable file object that encrypts everything written to it into file as it arrives. The plaintext is split
+    into chunks that are each encrypted and authenticated with AES-GCM, so they can be checked and decrypted on their
+    own and a wrong password is found on the first chunk. With jobs above 1, chunks are encrypted on a pool of threads
+    and written in order. close() must be called to write the last chunk, it does not close file"""
+    def __init__(self, file, password, progress=None, jobs=1):
+        super().__init__()
+        self.file = file
+        self.stage = stage_timer(progress)  # time spent encrypting is recorded in the 'encrypt' stage
+        self.chunk_size = 1 << CHUNK_BITS
+        salt = os.urandom(SALT_SIZE)  # random data to stop identical files returning the same ciphertext
+        self.cipher = AESGCM(chunk_key(password, salt))
+        self.jobs = jobs
+        self.executor = ThreadPoolExecutor(jobs) if jobs > 1 else None
+        self.in_flight = deque()  # futures of chunks being encrypted, oldest first
+        self.index = 0
+        self.buffer = bytearray()  # plaintext that does not yet fill a whole chunk
+        self.file.write(CHUNKED_MAGIC + bytes([CHUNK_BITS]) + salt)
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += data
+        start = 0
+        while len(self.buffer) - start >= self.chunk_size:
+            self.write_chunk(self.buffer[start:start + self.chunk_size], False)
+            start += self.chunk_size
+        del self.buffer[:start]
+        return len(data)
+
+    def write_chunk(self, plaintext, last):
+        if self.executor is None:
+            with self.stage('encrypt'):
+                ciphertext = seal_chunk(self.cipher, self.index, plaintext, last)
+            self.file.write(ciphertext)
+        else:  # the time spent in threads overlaps, so it is not added to the 'encrypt' stage
+            self.in_flight.append(self.executor.submit(seal_chunk, self.cipher, self.index, plaintext, last))
+            while len(self.in_flight) > 2 * self.jobs:
+                self.file.write(self.in_flight.popleft().result())
+        self.index += 1
+
+    def close(self):
+        if not self.closed:
+            try:
+                self.write_chunk(self.buffer, True)  # can be empty, the last chunk is always shorter than a whole one
+                while self.in_flight:
+                    self.file.write(self.in_flight.popleft().result())
+            finally:
+                if self.executor is not None:
+                    self.executor.shutdown()
+        super().close()
+
+
+class DecryptReader(io.RawIOBase):
+    """Readable file object that decrypts data written by EncryptWriter. The first chunk is checked when the reader is
+    created, so a wrong password raises ValueError straight away. With jobs above 1, the chunks after the current one
+    are read ahead and decrypted on a pool of threads. Raises ValueError if any chunk fails authentication or the
+    stream is cut short"""
+    def __init__(self, file, password, progress=None, jobs=1):
+        super().__init__()
+        self.file = file
+        self.stage = stage_timer(progress)
+        self.jobs = jobs
+        self.executor = None
+        self.in_flight = deque()  # futures of chunks being decrypted, oldest first
+        self.pending = memoryview(b'')  # decrypted data that has not been read yet
+        self.finished = False
+        magic = file.read(len(CHUNKED_MAGIC))
+        header = file.read(1 + SALT_SIZE)
+        if magic != CHUNKED_MAGIC or len(header) < 1 + SALT_SIZE or not 10 <= header[0] <= 30:
+            raise ValueError('not an encrypted stream')
+        self.cipher = AESGCM(chunk_key(password, header[1:]))
+        self.chunk_size = (1 << header[0]) + TAG_SIZE
+        self.index = 0
+        self.pending = memoryview(self.read_chunk())  # fails fast on a wrong password
+        if jobs > 1:
+            self.executor = ThreadPoolExecutor(jobs)
+
+    def readable(self):
+        return True
+
+    def read_ciphertext(self):  # returns the index, data and last flag of the next chunk, or None after the last
+        if self.finished:
+            return None
+        ciphertext = bytearray()
+        while len(ciphertext) < self.chunk_size:  # pipes can return less than asked for
+            data = self.file.read(self.chunk_size - len(ciphertext))
+            if not data:
+                break
+            ciphertext += data
+        if len(ciphertext) < TAG_SIZE:
+            raise ValueError('encrypted stream is truncated')
+        last = len(ciphertext) < self.chunk_size
+        self.finished = last
+        self.index += 1
+        return self.index - 1, ciphertext, last
+
+    def read_chunk(self):  # returns the next decrypted chunk, or None at the end of the stream
+        if self.executor is None:
+            chunk = self.read_ciphertext()
+            if chunk is None:
+                return None
+            with self.stage('decrypt'):
+                return open_chunk(self.cipher, *chunk)
+        while len(self.in_flight) < 2 * self.jobs:
+            chunk = self.read_ciphertext()
+            if chunk is None:
+                break
+            self.in_flight.append(self.executor.submit(open_chunk, self.cipher, *chunk))
+        if not self.in_flight:
+            return None
+        return self.in_flight.popleft().result()
+
+    def readinto(self, buffer):
+        while not self.pending:
+            chunk = self.read_chunk()
+            if chunk is None:
+                return 0
+            self.pending = memoryview(chunk)
+        count = min(len(buffer), len(self.pending))
+        buffer[:count] = self.pending[:count]
+        self.pending = self.pending[count:]
+        return count
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+        super().close()
+
+
+def encrypt(plaintext, password, progress=None, jobs=1):
+    output = io.BytesIO()
+    with EncryptWriter(output, password, progress, jobs) as writer:
+        writer.write(plaintext)
+    if progress is not None:
+        progress.advance(len(plaintext))
+    return output.getvalue()
+
+
+def decrypt(ciphertext, password, progress=None, jobs=1):  # raises ValueError for anything DecryptReader can't read
+    with DecryptReader(io.BytesIO(ciphertext), password, progress, jobs) as reader:
+        plaintext = reader.read()
+    if progress is not None:
+        progress.advance(len(ciphertext))
     return plaintext
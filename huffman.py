@@ -1,49 +1,162 @@
-from sys import byteorder
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import functools
+import hashlib
+import heapq
+import io
+import math
+import mmap
+from multiprocessing import shared_memory
+import os
+import struct
+import zlib
+
+from progress import Progress, stage_timer
+
+MAX_CODE_LENGTH = 12  # longest code the encoder produces, so a decoding table has at most 2**12 entries
+MAGIC = b'LPZ\x04'  # start of every compressed stream, the last byte is the format version
+DICTIONARY_MAGIC = b'LPZ\x05'  # version 5 is version 4 compressed with a trained dictionary, whose id follows
+TAR = 0x80  # set in the version byte of streams holding a tar archive of folders, so readers need not guess
+CHECKSUM = struct.Struct('>I')  # CRC32 of the characters of a frame, the last bytes of its data
+DIGEST = struct.Struct('>QI')  # number of characters in the stream and their CRC32, after the end marker
+FRAME_SIZE = 1 << 20  # bytes of input in each frame, which bounds memory while streaming and is the unit of parallelism
+MAX_FRAME_SIZE = 1 << 26  # largest frame_size a writer accepts, so a reader can reject bigger frames before allocating
+MAX_EXPANSION = 8 * 258  # most characters a byte of compressed data can decode to: 1 bit codes for lz77.MAX_MATCH
+FRAME_HEADER = struct.Struct('>II')  # number of characters in the frame, then number of bytes of compressed data
+BLOCK_SIZE = 16384  # characters in each block, every block can switch to a codebook that suits it better
+BLOCK_NEW = 0  # block types: codebook for this block follows
+BLOCK_REUSE = 1  # same codebook as the last block that had one
+BLOCK_RAW = 2  # block is stored uncompressed, starting at the next byte boundary
+BLOCK_LZ = 3  # block is LZ77 matches and characters, with codebooks for the literal/length and distance symbols
+SAMPLE_SIZE = 1 << 16  # characters of each frame counted when compressing from a sample
+SAMPLE_RUN = 256  # the sample is taken as evenly spaced runs of this many characters
+STORE_SAMPLE = 4096  # characters looked at to decide whether data is worth compressing at all
+STORE_ENTROPY = 7.9  # bits per character above which data is stored instead, like already compressed files
+CODECS = ('huffman', 'bwt')  # 'bwt' codes each frame as one Burrows-Wheeler block, see encode_bwt
+BWT_SEGMENT = 16384  # symbols of a BWT frame coded with each codebook
+DICTIONARY_DIR = os.path.join(os.path.expanduser('~'), '.lp-archiver', 'dictionaries')  # trained codebooks, by id
+DICTIONARY_ID_SIZE = 8  # bytes of the sha256 hash of a dictionary used as its id
+DICTIONARY_LIMIT = BLOCK_SIZE  # frames up to this size are coded with the dictionary alone, without building a tree
+
+
+@functools.lru_cache(maxsize=None)
+def load_numpy():
+    """numpy is optional, without it (None is returned) the pure python versions of the hot loops are used. It is
+    imported the first time one of them runs rather than with this module, as are bwt and lz77 in their own code
+    paths, because decompressing plain frames needs none of them and they take most of the start up time. bwt, lz77
+    and chunking get numpy from here too, so importing them does not import it either"""
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
 
 
 class Node:
-    def __init__(self, left, right, character, frequency):
+    __slots__ = ('left', 'right', 'character')
+
+    def __init__(self, left, right, character):
         self.left = left  # node to the left of the node
         self.right = right  # node to the right of the node
-        self.character = character  # what character(s) this node represents
-        self.frequency = frequency  # how many times this character appears
-        self.directionFromParent = ''  # 1 = right, 0 = left
-
-
-def calculate_direction(node, direction,
-                        direction_dict=None):  # recursive function that calculates direction for every node
-    if direction_dict is None:
-        direction_dict = {}
-    total_direction = direction + node.directionFromParent
-    if node.left is not None:
-        direction_dict = calculate_direction(node.left, total_direction, direction_dict)
-    if node.right is not None:
-        direction_dict = calculate_direction(node.right, total_direction, direction_dict)
-    if node.left is None and node.right is None:
-        direction_dict[node.character] = total_direction
-    return direction_dict
-
-
-def merge_sort(lst):
-    if len(lst) == 1:
-        return lst
-    centre = len(lst) // 2
-
-    left = merge_sort(lst[:centre])
-    right = merge_sort(lst[centre:])
-    new = []
-    while len(left) > 0 and len(right) > 0:
-        if left[0].frequency < right[0].frequency:
-            new.append(left[0])
-            left.pop(0)
+        self.character = character  # what character this node represents, None for internal nodes
+
+
+class BitWriter:
+    """Packs variable length values into a bytearray, most significant bit first. Bits are gathered in an integer
+    accumulator and flushed as whole bytes, so memory grows by one byte per 8 bits instead of one character per bit"""
+    def __init__(self):
+        self.buffer = bytearray()
+        self.accumulator = 0  # bits that have not yet been flushed to the buffer
+        self.bit_count = 0  # how many bits are held in the accumulator
+
+    def write(self, value, length):  # appends the lowest 'length' bits of value
+        self.accumulator = (self.accumulator << length) | value
+        self.bit_count += length
+        if self.bit_count >= 256:
+            self.flush()
+
+    def write_symbols(self, data, codes, lengths):  # appends the code of every character in data
+        accumulator = self.accumulator  # local variables are much faster than attributes in the hot loop
+        bit_count = self.bit_count
+        buffer = self.buffer
+        for char in data:
+            length = lengths[char]
+            accumulator = (accumulator << length) | codes[char]
+            bit_count += length
+            if bit_count >= 256:
+                remainder = bit_count & 7
+                buffer += (accumulator >> remainder).to_bytes(bit_count >> 3, 'big')
+                accumulator &= (1 << remainder) - 1
+                bit_count = remainder
+        self.accumulator = accumulator
+        self.bit_count = bit_count
+
+    def write_packed(self, data, bit_count):  # appends the first bit_count bits of already packed data
+        if bit_count:
+            self.accumulator = ((self.accumulator << bit_count)
+                                | (int.from_bytes(data, 'big') >> (len(data) * 8 - bit_count)))
+            self.bit_count += bit_count
+            self.flush()
+
+    def align(self):  # pads with 0s up to the next byte boundary
+        self.write(0, -self.bit_count & 7)
+
+    def write_bytes(self, data):  # appends whole bytes, copying them directly when the output is byte aligned
+        self.flush()
+        if self.bit_count == 0:
+            self.buffer += data
         else:
-            new.append(right[0])
-            right.pop(0)
-    new += left + right
-    return new
+            self.accumulator = (self.accumulator << (len(data) * 8)) | int.from_bytes(data, 'big')
+            self.bit_count += len(data) * 8
+            self.flush()
+
+    def flush(self):  # moves every complete byte from the accumulator to the buffer
+        remainder = self.bit_count & 7
+        self.buffer += (self.accumulator >> remainder).to_bytes(self.bit_count >> 3, 'big')
+        self.accumulator &= (1 << remainder) - 1
+        self.bit_count = remainder
+
+    def getvalue(self):  # returns the packed bits, padding the last byte with 0s
+        self.flush()
+        if self.bit_count:
+            self.buffer.append((self.accumulator << (8 - self.bit_count)) & 0xff)
+            self.accumulator = 0
+            self.bit_count = 0
+        return self.buffer
+
+
+class BitReader:
+    """Reads values written by BitWriter straight out of a bytes-like object without copying it"""
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.position = 0  # position in bits
+
+    def read(self, length):
+        start = self.position >> 3
+        end = (self.position + length + 7) >> 3
+        if end > len(self.data):
+            raise ValueError('unexpected end of compressed data')
+        value = int.from_bytes(self.data[start:end], 'big') >> ((end << 3) - self.position - length)
+        self.position += length
+        return value & ((1 << length) - 1)
+
+    def align(self):  # skips the padding up to the next byte boundary
+        self.position = (self.position + 7) & ~7
+
+    def read_bytes(self, count):
+        if self.position & 7 == 0:  # byte aligned, so the bytes can be sliced out directly
+            start = self.position >> 3
+            if start + count > len(self.data):
+                raise ValueError('unexpected end of compressed data')
+            self.position += count * 8
+            return self.data[start:start + count]
+        return self.read(count * 8).to_bytes(count, 'big')
 
 
 def calculate_frequency(data):
+    np = load_numpy()
+    if np is not None:
+        return dict(enumerate(np.bincount(np.frombuffer(data, dtype=np.uint8), minlength=256).tolist()))
     character_count = {i: 0 for i in range(256)}
     for i in data:  # making a dictionary of every character and how many times they appear
         character_count[i] += 1
@@ -51,20 +164,103 @@ def calculate_frequency(data):
     return character_count
 
 
-def form_tree(unparented_nodes):
-    """Takes a list of unparented nodes and creates parent nodes for the two most frequent ones, and repeats until only one
-     node remains which is the root of a tree"""
-    while len(unparented_nodes) != 1:
-        unparented_nodes = merge_sort(unparented_nodes)
-        left = unparented_nodes[0]
-        right = unparented_nodes[1]
-        left.directionFromParent = "0"
-        right.directionFromParent = "1"
-        parent_node = Node(left, right, left.character + right.character, left.frequency + right.frequency)
-        unparented_nodes.remove(left)
-        unparented_nodes.remove(right)
-        unparented_nodes.append(parent_node)
-    return unparented_nodes
+def form_tree(character_count):
+    """Builds the huffman tree with a heap, storing it as an array of parent indexes instead of Node objects. Leaves are
+    the characters that are used, internal nodes are appended after them, and the depth of each leaf is returned as
+    its code length. character_count holds every symbol of the alphabet from 0 up, which is the 256 characters for
+    normal blocks"""
+    used = [character for character in range(len(character_count)) if character_count[character] > 0]
+    lengths = [0] * len(character_count)
+    if len(used) == 1:  # a single character still needs a 1 bit code
+        lengths[used[0]] = 1
+    if len(used) <= 1:
+        return lengths
+
+    parent = [0] * (2 * len(used) - 1)
+    heap = [(character_count[character], index) for index, character in enumerate(used)]
+    heapq.heapify(heap)
+    next_index = len(used)
+    while len(heap) > 1:  # joins the two least frequent nodes until only the root remains
+        left_frequency, left = heapq.heappop(heap)
+        right_frequency, right = heapq.heappop(heap)
+        parent[left] = next_index
+        parent[right] = next_index
+        heapq.heappush(heap, (left_frequency + right_frequency, next_index))
+        next_index += 1
+
+    depth = [0] * len(parent)
+    for index in range(len(parent) - 2, -1, -1):  # parents always come after their children, so walk backwards
+        depth[index] = depth[parent[index]] + 1
+    for index, character in enumerate(used):
+        lengths[character] = depth[index]
+    return lengths
+
+
+def limit_lengths(lengths, character_count, max_length=MAX_CODE_LENGTH):
+    """Shortens codes longer than max_length while keeping the code complete, so the decoder's lookup table stays small
+    enough to fit in cache. Works on the number of codes of each length, then gives the shortest lengths back to the
+    most frequent characters"""
+    if max(lengths) <= max_length:
+        return lengths
+    length_count = [0] * (max_length + 1)
+    for length in lengths:
+        if length:
+            length_count[min(length, max_length)] += 1
+
+    total = sum(length_count[i] << (max_length - i) for i in range(1, max_length + 1))
+    while total > 1 << max_length:  # too many codes for the available space, so lengthen a shorter one
+        length_count[max_length] -= 1
+        for i in range(max_length - 1, 0, -1):
+            if length_count[i]:
+                length_count[i] -= 1
+                length_count[i + 1] += 2
+                break
+        total -= 1
+
+    by_frequency = sorted((character for character in range(len(lengths)) if lengths[character]),
+                          key=lambda character: -character_count[character])
+    new_lengths = [0] * len(lengths)
+    length = 1
+    for character in by_frequency:
+        while length_count[length] == 0:
+            length += 1
+        new_lengths[character] = length
+        length_count[length] -= 1
+    return new_lengths
+
+
+def canonical_codes(lengths):
+    """Assigns canonical codes, where codes of the same length are consecutive numbers in character order. Only the
+    lengths need to be stored for the decoder to rebuild exactly the same codes. Returns None if the lengths could not
+    have come from a valid code"""
+    character_direction = {character: (0, 0) for character in range(len(lengths))}
+    code = 0
+    previous_length = 0
+    for length, character in sorted((length, character) for character, length in enumerate(lengths) if length):
+        code <<= length - previous_length
+        if code >> length:  # more codes of this length than there is space for
+            return None
+        character_direction[character] = (code, length)
+        code += 1
+        previous_length = length
+    return character_direction
+
+
+def write_codebook(lengths, writer):
+    """Stores which characters are used as a bit map with one bit per symbol (256 for characters), followed by 4 bits
+    for the code length of each used character"""
+    used = 0
+    for length in lengths:
+        used = (used << 1) | (length > 0)
+    writer.write(used, len(lengths))
+    for length in lengths:
+        if length:
+            writer.write(length, 4)
+
+
+def read_codebook(reader, size=256):
+    used = reader.read(size)
+    return [reader.read(4) if (used >> (size - 1 - character)) & 1 else 0 for character in range(size)]
 
 
 def chunks(data, n):  # Yield successive n-sized chunks from data.
@@ -72,146 +268,1401 @@ def chunks(data, n):  # Yield successive n-sized chunks from data.
         yield data[i:i + n]
 
 
-def encode(data, character_direction, block_size):  # replaces each character in data with its direction
-    output = []
+def encoded_size(character_count, lengths):  # bits needed to encode a block, None if a used character has no code
+    size = 0
+    for character, count in character_count.items():
+        if count:
+            if lengths[character] == 0:
+                return None
+            size += count * lengths[character]
+    return size
+
+
+def codebook_size(lengths):  # bits used by write_codebook
+    return len(lengths) + 4 * (len(lengths) - lengths.count(0))
+
+
+def encode(data, block_size, writer, level=0, progress=None, dictionary=None):
+    """Replaces each character in data with its code. Each block starts with a 2 bit type. The encoder works out what
+    every option would cost and picks the cheapest: a new codebook built for the block, reusing the last codebook
+    written, or storing the block raw. With level above 0, LZ77 matches are also found at that level of lz77.LEVELS,
+    and the block is coded as matches if that is cheaper still. With a dictionary, blocks can reuse it before any
+    codebook has been written"""
+    np = load_numpy()
+    stage = stage_timer(progress)
+    writer.write(block_size, 16)       # writes block-size to output in 16 bits
+    previous_lengths = dictionary
+    if dictionary is not None:
+        if np is not None:
+            bit_table = dictionary_tables(dictionary)
+        else:
+            codes = dictionary_tables(dictionary)[0]
+    finder = None
+    if level:
+        import lz77
+        finder = lz77.MatchFinder(data, level)
+    for index, block in enumerate(chunks(data, block_size)):
+        lz_size = None
+        if finder is not None:
+            with stage('match'):
+                tokens = finder.tokens(index * block_size, index * block_size + len(block))
+            with stage('tree'):
+                literal_lengths, distance_lengths, lz_size = lz_tables(tokens)
+        with stage('frequency'):
+            character_count = calculate_frequency(block)
+        with stage('tree'):
+            raw_size = len(block) * 8
+            reuse_size = None
+            if previous_lengths is not None:
+                reuse_size = encoded_size(character_count, previous_lengths)
+            lengths = limit_lengths(form_tree(character_count), character_count)
+            new_size = codebook_size(lengths) + encoded_size(character_count, lengths)
+
+            cheapest = min(size for size in (reuse_size, new_size, raw_size) if size is not None)
+            if lz_size is not None and lz_size < cheapest:
+                writer.write(BLOCK_LZ, 2)
+                with stage('encode'):
+                    write_lz_block(tokens, literal_lengths, distance_lengths, writer)
+                continue
+            if reuse_size is not None and reuse_size <= new_size and reuse_size < raw_size:
+                writer.write(BLOCK_REUSE, 2)
+            elif new_size < raw_size:
+                writer.write(BLOCK_NEW, 2)
+                write_codebook(lengths, writer)   # only the code lengths are stored, the codes are rebuilt from them
+                character_direction = canonical_codes(lengths)
+                codes = [character_direction[char][0] for char in range(256)]
+                previous_lengths = lengths
+                if np is not None:
+                    bit_table = code_bit_table(character_direction)
+            else:  # if the compressed data would be larger than the pure block, don't compress
+                writer.write(BLOCK_RAW, 2)
+                writer.align()  # so the block is copied in one go, on both sides
+                with stage('pack'):
+                    writer.write_bytes(block)
+                continue
+        if np is not None:
+            with stage('encode'):
+                packed = pack_symbols(block, *bit_table)
+            with stage('pack'):
+                writer.write_packed(*packed)
+        else:
+            with stage('encode'):  # the pure python loop encodes and packs in one pass
+                writer.write_symbols(block, codes, previous_lengths)
+
+
+def lz_tables(tokens):
+    """Counts the literal/length and distance symbols of the tokens from lz77.MatchFinder and builds a code for each.
+    Returns both sets of code lengths and the bits the block would take, codebooks included"""
+    import lz77
+    literal_count = {symbol: 0 for symbol in range(lz77.LITERAL_SYMBOLS)}
+    distance_count = {symbol: 0 for symbol in range(lz77.DISTANCE_SYMBOLS)}
+    extra_bits = 0
+    for token in tokens:
+        if type(token) is int:
+            literal_count[token] += 1
+        else:
+            length_code = lz77.LENGTH_CODE[token[0]]
+            distance_code = lz77.DISTANCE_CODE[token[1]]
+            literal_count[256 + length_code] += 1
+            distance_count[distance_code] += 1
+            extra_bits += lz77.LENGTH_EXTRA[length_code] + lz77.DISTANCE_EXTRA[distance_code]
+    literal_lengths = limit_lengths(form_tree(literal_count), literal_count)
+    distance_lengths = limit_lengths(form_tree(distance_count), distance_count)
+    size = (codebook_size(literal_lengths) + encoded_size(literal_count, literal_lengths) +
+            codebook_size(distance_lengths) + encoded_size(distance_count, distance_lengths) + extra_bits)
+    return literal_lengths, distance_lengths, size
+
+
+def write_lz_block(tokens, literal_lengths, distance_lengths, writer):
+    """Writes both codebooks, then each character as its literal code, and each match as its length code, the
+    length's extra bits, its distance code and the distance's extra bits"""
+    import lz77
+    write_codebook(literal_lengths, writer)
+    write_codebook(distance_lengths, writer)
+    literal_direction = canonical_codes(literal_lengths)
+    distance_direction = canonical_codes(distance_lengths)
+    literal_codes = [literal_direction[symbol][0] for symbol in range(lz77.LITERAL_SYMBOLS)]
+    distance_codes = [distance_direction[symbol][0] for symbol in range(lz77.DISTANCE_SYMBOLS)]
+    for token in tokens:
+        if type(token) is int:
+            writer.write(literal_codes[token], literal_lengths[token])
+            continue
+        length, distance = token
+        length_code = lz77.LENGTH_CODE[length]
+        distance_code = lz77.DISTANCE_CODE[distance]
+        length_extra = lz77.LENGTH_EXTRA[length_code]
+        distance_extra = lz77.DISTANCE_EXTRA[distance_code]
+        symbol = 256 + length_code
+        value = (literal_codes[symbol] << length_extra) | (length - lz77.LENGTH_BASE[length_code])
+        value = (value << distance_lengths[distance_code]) | distance_codes[distance_code]
+        value = (value << distance_extra) | (distance - lz77.DISTANCE_BASE[distance_code])
+        writer.write(value, literal_lengths[symbol] + length_extra + distance_lengths[distance_code] + distance_extra)
+
+
+def symbol_table(lengths):
+    """Single symbol lookup table for decode_lz: the symbol and code length for every value of the next table_bits
+    bits, with a length of 0 where no code starts. Raises ValueError if the lengths are not a valid code"""
+    character_direction = canonical_codes(lengths)
+    if character_direction is None:
+        raise ValueError('invalid codebook')
+    table_bits = max(lengths)
+    symbols = [0] * (1 << table_bits)
+    code_lengths = [0] * (1 << table_bits)
+    for symbol, (code, length) in character_direction.items():
+        if length:
+            shift = table_bits - length
+            for index in range(code << shift, (code + 1) << shift):
+                symbols[index] = symbol
+                code_lengths[index] = length
+    return symbols, code_lengths, table_bits
+
+
+def decode_lz(reader, count, output, offset, literal_table, distance_table):
+    """Decodes count characters of an LZ block into output at offset. Matches copy from anywhere earlier in output,
+    which holds the frame decoded so far"""
+    import lz77
+    data = reader.data
+    literal_symbols, literal_lengths, literal_bits = literal_table
+    distance_symbols, distance_lengths, distance_bits = distance_table
+    byte_position = reader.position >> 3
+    bit_count = 8 - (reader.position & 7)  # number of unread bits held in accumulator
+    if byte_position >= len(data):
+        raise ValueError('unexpected end of compressed data')
+    accumulator = data[byte_position] & ((1 << bit_count) - 1)
+    byte_position += 1
+    padding = 0  # zero bits added past the end of the data
+
+    end = offset + count
+    while offset < end:
+        if bit_count < 48:  # enough for the longest match: 12 + 5 bits of length, 12 + 13 bits of distance
+            refill = data[byte_position:byte_position + 8]
+            byte_position += len(refill)
+            accumulator = ((accumulator & ((1 << bit_count) - 1)) << (len(refill) * 8)) | int.from_bytes(refill, 'big')
+            bit_count += len(refill) * 8
+            if bit_count < 48:
+                padding += 48 - bit_count
+                accumulator <<= 48 - bit_count
+                bit_count = 48
+        index = (accumulator >> (bit_count - literal_bits)) & ((1 << literal_bits) - 1)
+        if literal_lengths[index] == 0:
+            raise ValueError('invalid code in compressed data')
+        bit_count -= literal_lengths[index]
+        symbol = literal_symbols[index]
+        if symbol < 256:
+            output[offset] = symbol
+            offset += 1
+            continue
+
+        length_code = symbol - 256
+        extra = lz77.LENGTH_EXTRA[length_code]
+        bit_count -= extra
+        length = lz77.LENGTH_BASE[length_code] + ((accumulator >> bit_count) & ((1 << extra) - 1))
+        index = (accumulator >> (bit_count - distance_bits)) & ((1 << distance_bits) - 1)
+        if distance_lengths[index] == 0:
+            raise ValueError('invalid code in compressed data')
+        bit_count -= distance_lengths[index]
+        distance_code = distance_symbols[index]
+        extra = lz77.DISTANCE_EXTRA[distance_code]
+        bit_count -= extra
+        distance = lz77.DISTANCE_BASE[distance_code] + ((accumulator >> bit_count) & ((1 << extra) - 1))
+        if distance > offset or length > end - offset:
+            raise ValueError('invalid match in compressed data')
+        source = offset - distance
+        if distance >= length:
+            output[offset:offset + length] = output[source:source + length]
+        else:  # the match overlaps itself, so it repeats the last distance characters
+            output[offset:offset + length] = (output[source:offset] * (length // distance + 1))[:length]
+        offset += length
+
+    if bit_count < padding:
+        raise ValueError('unexpected end of compressed data')
+    reader.position = byte_position * 8 + padding - bit_count
+
+
+def sample_frequency(data, sample_size):
+    """Counts the characters in evenly spaced runs adding up to about sample_size characters, instead of the whole of
+    data"""
+    runs = max(sample_size // SAMPLE_RUN, 1)
+    if len(data) <= runs * SAMPLE_RUN:
+        return calculate_frequency(data)
+    step = len(data) // runs
+    return calculate_frequency(b''.join(data[start:start + SAMPLE_RUN] for start in range(0, runs * step, step)))
+
+
+def entropy(character_count):  # average bits per character of the best possible code for character_count
+    total = sum(character_count.values())
+    if total == 0:
+        return 0
+    return sum(count * math.log2(total / count) for count in character_count.values() if count) / total
+
+
+def incompressible(data):
+    """Estimates the entropy of data from a small sample. Huffman coding cannot get already compressed or encrypted
+    data below 8 bits a character, so it is quicker to store it than to find that out block by block"""
+    return entropy(sample_frequency(data, STORE_SAMPLE)) >= STORE_ENTROPY
+
+
+def encode_raw(data, block_size, writer, progress=None):  # stores every block without counting or building codes
+    writer.write(block_size, 16)
+    with stage_timer(progress)('pack'):
+        for block in chunks(data, block_size):
+            writer.write(BLOCK_RAW, 2)
+            writer.align()
+            writer.write_bytes(block)
+
+
+def symbol_tables(lengths):  # what write_symbols or pack_symbols needs to encode with the codes for lengths
+    np = load_numpy()
+    character_direction = canonical_codes(lengths)
+    if np is not None:
+        return code_bit_table(character_direction)
+    return [character_direction[char][0] for char in range(len(lengths))], lengths
+
+
+def dictionary_id(lengths):  # content id of a dictionary: the start of the sha256 hash of its code lengths, as hex
+    return hashlib.sha256(bytes(lengths)).digest()[:DICTIONARY_ID_SIZE].hex()
+
+
+def save_dictionary(lengths, folder=DICTIONARY_DIR):  # returns the id the dictionary is saved under
+    name = dictionary_id(lengths)
+    path = os.path.join(folder, name + '.dict')
+    if not os.path.exists(path):  # the same id always means the same contents, so it is never written twice
+        os.makedirs(folder, exist_ok=True)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(bytes(lengths))
+        os.replace(path + '.tmp', path)  # so another process never reads a half written dictionary
+    return name
+
+
+def train_dictionary(paths, folder=DICTIONARY_DIR, limit=FRAME_SIZE):
+    """Builds a codebook from the characters of a sample corpus, reading up to limit bytes of each file in paths,
+    and saves it in folder. Every character is counted at least once so anything can be coded with it. Returns the
+    id to compress with"""
+    character_count = dict.fromkeys(range(256), 1)
+    for path in paths:
+        with open(path, 'rb') as f:
+            for character, count in calculate_frequency(f.read(limit)).items():
+                character_count[character] += count
+    return save_dictionary(limit_lengths(form_tree(character_count), character_count), folder)
+
+
+@functools.lru_cache(maxsize=16)
+def load_dictionary(name, folder=DICTIONARY_DIR):
+    """Returns the code lengths of the dictionary saved under name, as a tuple so it can be cached and hashed.
+    Raises ValueError if there is no such dictionary or its contents don't match its id"""
+    try:
+        with open(os.path.join(folder, name + '.dict'), 'rb') as f:
+            lengths = tuple(f.read())
+    except OSError:
+        raise ValueError(f'unknown dictionary {name}')
+    if (len(lengths) != 256 or dictionary_id(lengths) != name or max(lengths) > MAX_CODE_LENGTH
+            or canonical_codes(lengths) is None):
+        raise ValueError(f'corrupted dictionary {name}')
+    return lengths
+
+
+@functools.lru_cache(maxsize=16)
+def dictionary_tables(lengths):  # symbol_tables of a dictionary, built once per process instead of once per frame
+    return symbol_tables(lengths)
+
+
+@functools.lru_cache(maxsize=16)
+def dictionary_decoder(lengths, use_table):  # (DecodeTable, None) or (None, tree root) of a dictionary, built once
+    character_direction = canonical_codes(lengths)
+    if use_table:
+        return DecodeTable(character_direction), None
+    return None, build_tree(character_direction)
+
+
+def encode_dictionary(data, block_size, writer, dictionary, progress=None):
+    """Codes every block with a trained dictionary, which the decoder already has, so no tree is built and no
+    codebook is written. Blocks that the dictionary would make larger are stored raw"""
+    np = load_numpy()
+    stage = stage_timer(progress)
+    writer.write(block_size, 16)
+    tables = dictionary_tables(dictionary)
+    for block in chunks(data, block_size):
+        with stage('frequency'):
+            raw = encoded_size(calculate_frequency(block), dictionary) >= len(block) * 8
+        if raw:
+            writer.write(BLOCK_RAW, 2)
+            writer.align()
+            with stage('pack'):
+                writer.write_bytes(block)
+            continue
+        writer.write(BLOCK_REUSE, 2)
+        if np is not None:
+            with stage('encode'):
+                packed = pack_symbols(block, *tables)
+            with stage('pack'):
+                writer.write_packed(*packed)
+        else:
+            with stage('encode'):
+                writer.write_symbols(block, *tables)
+
+
+def encode_sampled(data, block_size, writer, sample_size, progress=None):
+    """Single pass version of encode. One codebook is built from a sample of data and used for every block, so the
+    blocks are not counted before they are encoded. A block holding a character the sample missed escapes to a
+    codebook counted from that block alone. Writes the same block types as encode, so it decodes the same way"""
+    np = load_numpy()
+    stage = stage_timer(progress)
+    writer.write(block_size, 16)
+    with stage('frequency'):
+        sample_count = sample_frequency(data, sample_size)
+    with stage('tree'):
+        sample_lengths = limit_lengths(form_tree(sample_count), sample_count)
+        sampled = bytes(character for character in range(256) if sample_lengths[character])
+        sample_tables = symbol_tables(sample_lengths)
+        # stores everything raw if the sample suggests it would not get any smaller
+        raw = encoded_size(sample_count, sample_lengths) >= 8 * sum(sample_count.values())
+    previous_lengths = None
+    for block in chunks(data, block_size):
+        if raw:
+            writer.write(BLOCK_RAW, 2)
+            writer.align()
+            with stage('pack'):
+                writer.write_bytes(block)
+            continue
+        lengths, tables = sample_lengths, sample_tables
+        with stage('frequency'):
+            escape = len(bytes(block).translate(None, sampled)) > 0  # deletes every sampled character
+        if escape:
+            with stage('frequency'):
+                character_count = calculate_frequency(block)
+            with stage('tree'):
+                lengths = limit_lengths(form_tree(character_count), character_count)
+                if codebook_size(lengths) + encoded_size(character_count, lengths) >= len(block) * 8:
+                    writer.write(BLOCK_RAW, 2)
+                    writer.align()
+                    with stage('pack'):
+                        writer.write_bytes(block)
+                    continue
+                tables = symbol_tables(lengths)
+        if lengths is previous_lengths:
+            writer.write(BLOCK_REUSE, 2)
+        else:
+            writer.write(BLOCK_NEW, 2)
+            write_codebook(lengths, writer)
+            previous_lengths = lengths
+        if np is not None:
+            with stage('encode'):
+                packed = pack_symbols(block, *tables)
+            with stage('pack'):
+                writer.write_packed(*packed)
+        else:
+            with stage('encode'):
+                writer.write_symbols(block, *tables)
+
+
+def code_bit_table(character_direction):
+    """Lookup arrays for pack_symbols: a row of MAX_CODE_LENGTH bits for every character holding its code, a matching
+    row marking which of those bits belong to the code, and the code lengths"""
+    np = load_numpy()
+    size = len(character_direction)
+    bits = np.zeros((size, MAX_CODE_LENGTH), dtype=np.uint8)
+    used = np.zeros((size, MAX_CODE_LENGTH), dtype=bool)
+    lengths = np.zeros(size, dtype=np.int64)
+    for character, (code, length) in character_direction.items():
+        for i in range(length):
+            bits[character, i] = (code >> (length - 1 - i)) & 1
+        used[character, :length] = True
+        lengths[character] = length
+    return bits, used, lengths
+
+
+def pack_symbols(block, bits, used, lengths):
+    """NumPy version of BitWriter.write_symbols. The bit rows of every character are gathered from the lookup arrays,
+    the bits past the end of each code are dropped, and what is left is packed into bytes in one go. Returns the
+    packed bytes and the number of bits used. block can also be an array of symbols from a larger alphabet"""
+    np = load_numpy()
+    characters = block if isinstance(block, np.ndarray) else np.frombuffer(block, dtype=np.uint8)
+    return np.packbits(bits[characters][used[characters]]).tobytes(), int(lengths[characters].sum())
+
+
+def encode_bwt(data, writer, progress=None):
+    """Codes the whole of data as one block: the Burrows-Wheeler transform groups characters by what follows them,
+    move to front turns those groups into runs of small numbers, and the runs of 0s are shortened by bwt.zero_runs.
+    The symbols are Huffman coded in segments of BWT_SEGMENT, each with a new codebook or reusing the last one. A
+    block size of 0 marks the frame, followed by the primary index and the number of symbols in 32 bits each"""
+    import bwt
+    np = load_numpy()
+    stage = stage_timer(progress)
+    writer.write(0, 16)
+    with stage('sort'):
+        last, primary = bwt.transform(data)
+    with stage('move to front'):
+        symbols = bwt.zero_runs(bwt.move_to_front(last))
+    writer.write(primary, 32)
+    writer.write(len(symbols), 32)
+    if np is not None:
+        symbols = np.array(symbols, dtype=np.uint16)
+    previous_lengths = None
+    for segment in chunks(symbols, BWT_SEGMENT):
+        with stage('frequency'):
+            symbol_count = dict.fromkeys(range(bwt.SYMBOLS), 0)
+            if np is not None:
+                symbol_count.update(enumerate(np.bincount(segment, minlength=bwt.SYMBOLS).tolist()))
+            else:
+                for symbol in segment:
+                    symbol_count[symbol] += 1
+        with stage('tree'):
+            lengths = limit_lengths(form_tree(symbol_count), symbol_count)
+            reuse_size = None
+            if previous_lengths is not None:
+                reuse_size = encoded_size(symbol_count, previous_lengths)
+            if reuse_size is not None and reuse_size <= codebook_size(lengths) + encoded_size(symbol_count, lengths):
+                writer.write(BLOCK_REUSE, 2)
+            else:
+                writer.write(BLOCK_NEW, 2)
+                write_codebook(lengths, writer)
+                previous_lengths = lengths
+                tables = symbol_tables(lengths)
+        if np is not None:
+            with stage('encode'):
+                packed = pack_symbols(segment, *tables)
+            with stage('pack'):
+                writer.write_packed(*packed)
+        else:
+            with stage('encode'):
+                writer.write_symbols(segment, *tables)
+
+
+def decode_symbols(reader, count, table, output):  # appends count symbols decoded with a symbol_table to output
+    data = reader.data
+    symbols, code_lengths, table_bits = table
+    mask = (1 << table_bits) - 1
+    byte_position = reader.position >> 3
+    bit_count = 8 - (reader.position & 7)  # number of unread bits held in accumulator
+    if byte_position >= len(data):
+        raise ValueError('unexpected end of compressed data')
+    accumulator = data[byte_position] & ((1 << bit_count) - 1)
+    byte_position += 1
+    padding = 0  # zero bits added past the end of the data
+
+    for _ in range(count):
+        if bit_count < table_bits:
+            refill = data[byte_position:byte_position + 8]
+            byte_position += len(refill)
+            accumulator = ((accumulator & ((1 << bit_count) - 1)) << (len(refill) * 8)) | int.from_bytes(refill, 'big')
+            bit_count += len(refill) * 8
+            if bit_count < table_bits:
+                padding += table_bits - bit_count
+                accumulator <<= table_bits - bit_count
+                bit_count = table_bits
+        index = (accumulator >> (bit_count - table_bits)) & mask
+        if code_lengths[index] == 0:
+            raise ValueError('invalid code in compressed data')
+        output.append(symbols[index])
+        bit_count -= code_lengths[index]
+
+    if bit_count < padding:
+        raise ValueError('unexpected end of compressed data')
+    reader.position = byte_position * 8 + padding - bit_count
+
+
+def decode_bwt(reader, count, progress=None):  # decodes a frame of count characters written by encode_bwt
+    import bwt
+    stage = stage_timer(progress)
+    primary = reader.read(32)
+    symbol_count = reader.read(32)
+    if symbol_count > count:  # a run of 0s never takes more symbols than the characters it stands for
+        raise ValueError('invalid symbol count')
+    symbols = []
+    table = None
+    for start in range(0, symbol_count, BWT_SEGMENT):
+        block_type = reader.read(2)
+        if block_type == BLOCK_NEW:
+            with stage('tree'):
+                table = symbol_table(read_codebook(reader, bwt.SYMBOLS))
+        elif block_type != BLOCK_REUSE or table is None:
+            raise ValueError('invalid block type')
+        with stage('decode'):
+            decode_symbols(reader, min(BWT_SEGMENT, symbol_count - start), table, symbols)
+    with stage('move to front'):
+        last = bwt.inverse_move_to_front(bwt.expand_runs(symbols, count))
+    with stage('sort'):
+        return bwt.inverse(last, primary)
+
+
+def compress_frame(data, block_size, sample_size=0, level=0, codec='huffman', dictionary=None, progress=None):
+    """Compresses one frame. The number of characters is stored in the frame header, not here. With sample_size above
+    0, the codebook is built from a sample of that many characters instead of counting every block. With level above
+    0, blocks can be coded as LZ77 matches, which counts every block anyway so sample_size is ignored. With codec
+    'bwt' the frame is coded by encode_bwt as well, and whichever of the two is smaller is kept, since data without
+    much context such as some binary files does better without the transform. dictionary is the code lengths of a
+    trained dictionary, which small frames are coded with alone (see encode_dictionary) and larger ones can reuse.
+    For plain Huffman coding, frames that look incompressible are stored raw straight away. LZ77 and BWT can still
+    shrink data whose characters look random but repeat, so they always run and the frame is only stored raw if the
+    coded frame turns out no smaller. The CRC32 of data is added to the end"""
+    writer = BitWriter()
+    if codec == 'bwt':
+        encode(data, block_size, writer, 0, progress, dictionary)
+        bwt_writer = BitWriter()
+        encode_bwt(data, bwt_writer, progress)
+        if len(bwt_writer.getvalue()) < len(writer.getvalue()):
+            writer = bwt_writer
+    elif level:
+        encode(data, block_size, writer, level, progress, dictionary)
+    else:
+        with stage_timer(progress)('frequency'):
+            store = incompressible(data)
+        if store:
+            encode_raw(data, block_size, writer, progress)
+        elif dictionary is not None and len(data) <= DICTIONARY_LIMIT:
+            encode_dictionary(data, block_size, writer, dictionary, progress)
+        elif sample_size:
+            encode_sampled(data, block_size, writer, sample_size, progress)
+        else:
+            encode(data, block_size, writer, 0, progress, dictionary)
+    if (codec == 'bwt' or level) and len(writer.getvalue()) >= len(data):  # raw is at least len(data), so only then
+        raw_writer = BitWriter()
+        encode_raw(data, block_size, raw_writer, progress)
+        if len(raw_writer.getvalue()) <= len(writer.getvalue()):
+            writer = raw_writer
+    with stage_timer(progress)('checksum'):
+        return writer.getvalue() + CHECKSUM.pack(zlib.crc32(data))
+
+
+def run_measured(function, *args):  # runs in a worker process, returning the result and the time of each stage
+    progress = Progress()
+    return function(*args, progress), progress.stages
+
+
+def decompress_frame(compressed_data, remaining, use_table=True, dictionary=None, progress=None):
+    """Decodes one frame of remaining characters and compares them with the CRC32 at the end of the frame.
+    dictionary is the code lengths of the dictionary a version 5 stream was compressed with. Raises ValueError if the
+    frame is corrupted"""
+    if len(compressed_data) < CHECKSUM.size:
+        raise ValueError('unexpected end of compressed data')
+    expected = CHECKSUM.unpack_from(compressed_data, len(compressed_data) - CHECKSUM.size)[0]
+    output = decode_frame(compressed_data[:len(compressed_data) - CHECKSUM.size], remaining, use_table, dictionary,
+                          progress)
+    with stage_timer(progress)('checksum'):
+        if zlib.crc32(output) != expected:
+            raise ValueError('frame checksum mismatch')
+    return output
+
+
+def decode_frame(compressed_data, remaining, use_table, dictionary, progress=None):  # see decompress_frame
+    stage = stage_timer(progress)
+    reader = BitReader(compressed_data)
+    block_size = reader.read(16)  # finds block size
+    if block_size == 0:  # the frame is one Burrows-Wheeler block
+        return decode_bwt(reader, remaining, progress)
+
+    table = None
+    root_node = None
+    if dictionary is not None:  # reused by blocks before the first codebook
+        table, root_node = dictionary_decoder(dictionary, use_table)
+    decoded_output = bytearray(remaining)    # output is allocated once and filled in place
+    offset = 0
+
+    try:
+        while remaining > 0:
+            count = min(block_size, remaining)
+            block_type = reader.read(2)
+            if block_type == BLOCK_RAW:           # pure block
+                reader.align()
+                decoded_output[offset:offset + count] = reader.read_bytes(count)
+                offset += count
+                remaining -= count
+                continue
+            if block_type == BLOCK_LZ:      # the codebooks belong to this block alone, the last codebook is kept
+                import lz77
+                with stage('tree'):
+                    literal_table = symbol_table(read_codebook(reader, lz77.LITERAL_SYMBOLS))
+                    distance_table = symbol_table(read_codebook(reader, lz77.DISTANCE_SYMBOLS))
+                with stage('decode'):
+                    decode_lz(reader, count, decoded_output, offset, literal_table, distance_table)
+                offset += count
+                remaining -= count
+                continue
+            if block_type == BLOCK_NEW:
+                with stage('tree'):
+                    character_direction = canonical_codes(read_codebook(reader))
+                    if character_direction is None:
+                        raise ValueError('invalid codebook')
+                    table = None
+                    root_node = None
+                    longest = max(length for code, length in character_direction.values())
+                    if use_table and 0 < longest <= MAX_CODE_LENGTH:
+                        table = DecodeTable(character_direction)
+                    else:
+                        root_node = build_tree(character_direction)
+            elif block_type != BLOCK_REUSE or (table is None and root_node is None):
+                raise ValueError('invalid block type')
+
+            with stage('decode'):
+                if table is not None:            # encoded block
+                    table.decode(reader, count, decoded_output, offset)
+                else:
+                    decode_tree(reader, count, decoded_output, offset, root_node)
+            offset += count
+            remaining -= count
+    except AttributeError:   # the tree walk reached a branch that no code uses
+        raise ValueError('invalid code in compressed data')
+
+    return decoded_output
+
+
+class CompressWriter(io.RawIOBase):
+    """Writable file object that compresses everything written to it into file. Input is split into frames of
+    frame_size bytes, each with its own header and codebook, so memory use does not depend on the size of the input.
+    With jobs above 1, frames are compressed on a pool of processes and written in their original order. With
+    sample_size above 0, each frame is encoded in one pass from a codebook built from a sample of it (see
+    encode_sampled), which is faster but compresses a little worse. With level above 0, blocks can also be coded as
+    LZ77 matches (see encode), which is slower but compresses repetitive data much better. With codec 'bwt', every
+    frame is one Burrows-Wheeler block (see encode_bwt), which compresses text best of all but is slowest. Its memory
+    use grows with frame_size, which can go far beyond the 16 bit block size. dictionary is the id of a trained
+    dictionary (see train_dictionary) written in place of codebooks where it does well enough, which mostly helps
+    small inputs. progress is advanced by the number of characters in each frame written. executor is a pool shared
+    with the caller, used in place of starting one of jobs processes, and left running on close. tar sets the TAR
+    flag in the header, for streams written by archive.write_tar_archive. close() must be called to write the final
+    frame, the end marker and the digest of the whole stream"""
+    def __init__(self, file, block_size=BLOCK_SIZE, frame_size=FRAME_SIZE, jobs=1, progress=None, sample_size=0,
+                 level=0, codec='huffman', dictionary=None, executor=None, tar=False):
+        super().__init__()
+        if codec not in CODECS:
+            raise ValueError(f'unknown codec {codec}')
+        if not 0 < frame_size <= MAX_FRAME_SIZE:
+            raise ValueError(f'frame size must be between 1 and {MAX_FRAME_SIZE}')
+        self.file = file  # any object with a write method: a file, pipe, socket file or BytesIO
+        self.block_size = block_size
+        self.frame_size = frame_size
+        self.sample_size = sample_size
+        self.level = level
+        self.codec = codec
+        self.jobs = jobs
+        self.progress = progress
+        self.shared_executor = executor is not None  # shut down by its owner instead
+        if executor is None and jobs > 1:
+            executor = ProcessPoolExecutor(jobs)
+        self.executor = executor
+        self.in_flight = deque()  # (size, future) of frames being compressed, oldest first
+        self.buffer = bytearray()  # input that does not yet fill a whole frame
+        self.total = 0  # characters written so far, and their CRC32, for the digest
+        self.crc = 0
+        self.dictionary = None
+        flags = TAR if tar else 0
+        if dictionary is None:
+            self.file.write(MAGIC[:-1] + bytes([MAGIC[-1] | flags]))
+        else:
+            self.dictionary = load_dictionary(dictionary)
+            self.file.write(DICTIONARY_MAGIC[:-1] + bytes([DICTIONARY_MAGIC[-1] | flags]) + bytes.fromhex(dictionary))
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = memoryview(data).cast('B')
+        start = 0
+        if self.buffer:  # tops up the partial frame first
+            start = min(len(data), self.frame_size - len(self.buffer))
+            self.buffer += data[:start]
+            if len(self.buffer) < self.frame_size:
+                return len(data)
+            self.write_frame(self.buffer)
+            self.buffer = bytearray()
+        while len(data) - start >= self.frame_size:  # whole frames are compressed without copying them first
+            self.write_frame(data[start:start + self.frame_size])
+            start += self.frame_size
+        self.buffer += data[start:]
+        return len(data)
+
+    def write_frame(self, data):
+        if self.executor is None:
+            self.write_payload(len(data), compress_frame(data, self.block_size, self.sample_size, self.level,
+                                                         self.codec, self.dictionary, self.progress))
+            return
+        self.submit(len(data), run_measured, compress_frame, bytes(data), self.block_size, self.sample_size,
+                    self.level, self.codec, self.dictionary)
+
+    def submit(self, size, function, *args):  # compresses a frame of size characters on the pool with function(*args)
+        self.in_flight.append((size, self.executor.submit(function, *args)))
+        while len(self.in_flight) > 2 * self.jobs:  # keeps every process busy without buffering the whole input
+            self.write_oldest()
+
+    def write_file(self, path, digest=None):
+        """Writes the whole of the file at path from a memory map, so it is read through the page cache instead of
+        being copied into Python objects. With a pool, each process maps the file itself and only the compressed
+        frames are sent back. digest is a hashlib object to update with the contents of each frame as it is handed
+        on, so hashing the file does not read it a second time"""
+        size = os.path.getsize(path)
+        if size == 0:  # empty files can't be mapped
+            return
+        with open(path, 'rb') as f:
+            mapped = map_file(f)
+        view = memoryview(mapped)
+        mapped_frames = self.executor is not None and not self.buffer
+        for start in range(0, size, self.frame_size):
+            frame = view[start:start + self.frame_size]
+            if digest is not None:
+                digest.update(frame)
+            if mapped_frames:
+                self.submit(len(frame), compress_mapped_frame, path, start, start + self.frame_size,
+                            self.block_size, self.sample_size, self.level, self.codec, self.dictionary)
+            else:
+                self.write(frame)
+            frame.release()  # the map can't be closed while any view of it is left
+        view.release()
+        mapped.close()
+
+    def write_oldest(self):
+        size, future = self.in_flight.popleft()
+        payload, stages = future.result()
+        if self.progress is not None:
+            self.progress.add_stages(stages)
+        self.write_payload(size, payload)
+
+    def write_payload(self, size, payload):
+        with stage_timer(self.progress)('write'):
+            self.file.write(FRAME_HEADER.pack(size, len(payload)))
+            self.file.write(payload)
+        self.crc = crc32_combine(self.crc, frame_checksum(payload), size)
+        self.total += size
+        if self.progress is not None:
+            self.progress.advance(size, 1)
+
+    def close(self):
+        if not self.closed:
+            try:
+                if self.buffer:
+                    self.write_frame(self.buffer)
+                    self.buffer = bytearray()
+                while self.in_flight:
+                    self.write_oldest()
+                # end marker, so a truncated stream can be detected, then the digest
+                self.file.write(FRAME_HEADER.pack(0, DIGEST.size) + DIGEST.pack(self.total, self.crc))
+            finally:
+                if self.executor is not None and not self.shared_executor:
+                    self.executor.shutdown()
+        super().close()
+
+
+class DecompressReader(io.RawIOBase):
+    """Readable file object that decompresses a stream written by CompressWriter, one frame at a time. With jobs
+    above 1, the frames after the current one are read ahead and decompressed on a pool of processes. progress is
+    advanced by the number of compressed bytes in each frame decompressed. executor is a pool shared with the caller,
+    as for CompressWriter. Raises ValueError if the stream is corrupted or truncated, which includes any frame
+    decoding to the wrong characters and frames that are missing or out of order"""
+    def __init__(self, file, use_table=True, jobs=1, progress=None, executor=None):
+        super().__init__()
+        self.file = file
+        self.use_table = use_table
+        self.jobs = jobs
+        self.progress = progress
+        self.shared_executor = executor is not None
+        if executor is None and jobs > 1:
+            executor = ProcessPoolExecutor(jobs)
+        self.executor = executor
+        self.in_flight = deque()  # (compressed size, future) of frames being decompressed, oldest first
+        self.pending = memoryview(b'')  # decompressed data that has not been read yet
+        self.finished = False
+        self.dictionary, header_size, self.tar = read_header(self.file)  # tar is True for tar archive streams
+        self.digest = None  # read after the end marker
+        self.total = 0  # characters decompressed so far, and their CRC32, to compare with the digest
+        self.crc = 0
+
+    def readable(self):
+        return True
+
+    def read_payload(self):  # returns the size and compressed data of the next frame, or None at the end of the stream
+        if self.finished:
+            return None
+        with stage_timer(self.progress)('read'):
+            size, payload_size = FRAME_HEADER.unpack(read_exact(self.file, FRAME_HEADER.size))
+            if size == 0:
+                self.finished = True
+                self.digest = read_digest(read_exact(self.file, payload_size))
+                return None
+            payload = read_exact(self.file, payload_size)
+            check_frame_size(size, payload)
+            return size, payload
+
+    def read_frame(self):  # returns the next decompressed frame, or None at the end of the stream
+        output = self.decompress_next()
+        if output is None:
+            check_digest(self.digest, self.total, self.crc)
+            return None
+        with stage_timer(self.progress)('checksum'):
+            self.crc = zlib.crc32(output, self.crc)
+        self.total += len(output)
+        return output
+
+    def decompress_next(self):
+        if self.executor is None:
+            frame = self.read_payload()
+            if frame is None:
+                return None
+            output = decompress_frame(frame[1], frame[0], self.use_table, self.dictionary, self.progress)
+            if self.progress is not None:
+                self.progress.advance(FRAME_HEADER.size + len(frame[1]), 1)
+            return output
+        while len(self.in_flight) < 2 * self.jobs:
+            frame = self.read_payload()
+            if frame is None:
+                break
+            future = self.executor.submit(run_measured, decompress_frame, bytes(frame[1]), frame[0], self.use_table,
+                                          self.dictionary)
+            self.in_flight.append((FRAME_HEADER.size + len(frame[1]), future))
+        if not self.in_flight:
+            return None
+        compressed_size, future = self.in_flight.popleft()
+        output, stages = future.result()
+        if self.progress is not None:
+            self.progress.add_stages(stages)
+            self.progress.advance(compressed_size, 1)
+        return output
+
+    def readinto(self, buffer):
+        while not self.pending:
+            frame = self.read_frame()
+            if frame is None:
+                return 0
+            self.pending = memoryview(frame)
+        count = min(len(buffer), len(self.pending))
+        buffer[:count] = self.pending[:count]
+        self.pending = self.pending[count:]
+        return count
+
+    def readall(self):  # joins whole frames instead of copying them through readinto in small pieces
+        output = bytearray(self.pending)
+        self.pending = memoryview(b'')
+        frame = self.read_frame()
+        while frame is not None:
+            output += frame
+            frame = self.read_frame()
+        return bytes(output)
+
+    def close(self):
+        if self.shared_executor:  # frames read ahead are not needed any more
+            for compressed_size, future in self.in_flight:
+                future.cancel()
+            self.in_flight.clear()
+        elif self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+        super().close()
+
+
+def read_exact(file, size):  # pipes and sockets can return less than asked for, so keeps reading until size is reached
+    data = file.read(size)
+    if data is None or len(data) < size:
+        data = bytearray(data or b'')
+        while len(data) < size:
+            more = file.read(size - len(data))
+            if not more:
+                raise ValueError('unexpected end of compressed data')
+            data += more
+    return data
+
+
+def read_header(file):
+    """Reads the magic number, and the dictionary id of a version 5 stream. Returns the code lengths of the dictionary
+    or None, the size of the header and whether the TAR flag is set"""
+    magic = bytearray(read_exact(file, len(MAGIC)))
+    tar = bool(magic[-1] & TAR)
+    magic[-1] &= ~TAR
+    if magic == DICTIONARY_MAGIC:
+        dictionary = load_dictionary(bytes(read_exact(file, DICTIONARY_ID_SIZE)).hex())
+        return dictionary, len(MAGIC) + DICTIONARY_ID_SIZE, tar
+    if magic != MAGIC:
+        raise ValueError('not a compressed file')
+    return None, len(MAGIC), tar
 
-    output.append(bin(block_size)[2:].zfill(16))       # appends block-size to output in 16 bits
-    data = chunks(data, block_size)
-    for block in data:
-        size = 0
-        for char in block:
-            size += len(character_direction[char])
-        if size/8 >= len(block):  # if the compressed data would be larger than the pure block, don't compress
-            output.append('1')
-            for char in block:
-                output.append(bin(char)[2:].zfill(8))
+
+def stream_format(compressed_data):  # read_header of a stream that is already in memory
+    return read_header(io.BytesIO(compressed_data[:len(MAGIC) + DICTIONARY_ID_SIZE]))
+
+
+def gf2_times(matrix, vector):  # product of a 32x32 matrix over GF(2), stored as its 32 columns, and a 32 bit vector
+    total = 0
+    for column in matrix:
+        if not vector:
+            break
+        if vector & 1:
+            total ^= column
+        vector >>= 1
+    return total
+
+
+@functools.lru_cache(maxsize=16)
+def crc32_shift(length):
+    """Matrix that moves a CRC32 on past length zero bytes, from the matrix for one zero bit squared up to the powers
+    of two in length, like zlib's crc32_combine. Frames are nearly all FRAME_SIZE long, so each length is only worked
+    out once"""
+    power = [0xedb88320] + [1 << bit for bit in range(31)]  # one zero bit
+    for _ in range(3):  # eight zero bits
+        power = [gf2_times(power, column) for column in power]
+    result = [1 << bit for bit in range(32)]
+    while length:
+        if length & 1:
+            result = [gf2_times(power, column) for column in result]
+        power = [gf2_times(power, column) for column in power]
+        length >>= 1
+    return result
+
+
+def crc32_combine(crc, next_crc, next_length):  # CRC32 of two pieces of data joined, from the CRC32 of each piece
+    return gf2_times(crc32_shift(next_length), crc) ^ next_crc
+
+
+def frame_checksum(payload):  # the CRC32 at the end of a frame
+    return CHECKSUM.unpack_from(payload, len(payload) - CHECKSUM.size)[0]
+
+
+def read_digest(data):  # (number of characters, CRC32) of a stream, from the data after its end marker
+    if len(data) != DIGEST.size:
+        raise ValueError('invalid stream digest')
+    return DIGEST.unpack(data)
+
+
+def check_digest(digest, total, crc):  # raises ValueError unless the frames decoded add up to the stream's digest
+    if digest != (total, crc):
+        raise ValueError('stream digest mismatch, frames are missing, repeated or out of order')
+
+
+def stream_checksum(compressed_data, offsets):  # CRC32 of a stream's characters, from its frames' checksums
+    crc = 0
+    for start, size, payload_size in offsets:
+        crc = crc32_combine(crc, frame_checksum(compressed_data[start:start + payload_size]), size)
+    return crc
+
+
+def check_frame_size(size, payload):
+    """Raises ValueError if the number of characters in a frame header is more than a writer puts in a frame, or more
+    than its compressed data could decode to, before anything is allocated for them. Burrows-Wheeler frames can shrink
+    runs far more than that, so only the first limit applies to them"""
+    if size > MAX_FRAME_SIZE:
+        raise ValueError('too many characters in frame')
+    if bytes(payload[:2]) != b'\x00\x00' and size > len(payload) * MAX_EXPANSION:  # a block size of 0 marks BWT
+        raise ValueError('too many characters for the size of the frame')
+
+
+def frame_offsets(compressed_data, origin=0):
+    """Walks the frame headers of a compressed stream without decoding anything, returning (offset of the compressed
+    data, number of characters, size of the compressed data) for every frame, and the digest of the stream. Every
+    frame starts on a byte boundary and is independent of the others, so they can be handed to different
+    processes. Every header is checked with check_frame_size, so their sizes can be added up safely. Errors give the
+    offset of the bad header counted from origin"""
+    position = stream_format(compressed_data)[1]
+    offsets = []
+    while True:
+        if position + FRAME_HEADER.size > len(compressed_data):
+            raise ValueError('unexpected end of compressed data')
+        size, payload_size = FRAME_HEADER.unpack_from(compressed_data, position)
+        position += FRAME_HEADER.size
+        if size == 0:
+            return offsets, read_digest(compressed_data[position:position + payload_size])
+        if position + payload_size > len(compressed_data):
+            raise ValueError('unexpected end of compressed data')
+        try:
+            check_frame_size(size, compressed_data[position:position + payload_size])
+        except ValueError as error:
+            raise ValueError(f'frame {len(offsets)} at byte {origin + position - FRAME_HEADER.size}: {error}') from None
+        offsets.append((position, size, payload_size))
+        position += payload_size
+
+
+def map_file(file, write=False):
+    """Maps the whole of an open file into memory, telling the kernel it will be used in order so it can read ahead.
+    While an exception holds views of a map it can't be closed, so on errors maps are left to close themselves when
+    the exception is dropped"""
+    mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_WRITE if write else mmap.ACCESS_READ)
+    if hasattr(mapped, 'madvise'):  # not available on windows
+        mapped.madvise(mmap.MADV_SEQUENTIAL)
+    return mapped
+
+
+def compress_mapped_frame(path, start, end, block_size, sample_size, level, codec, dictionary):  # runs in a worker
+    with open(path, 'rb') as f:
+        mapped = map_file(f)
+    view = memoryview(mapped)
+    result = run_measured(compress_frame, view[start:end], block_size, sample_size, level, codec, dictionary)
+    view.release()
+    mapped.close()
+    return result
+
+
+def decompress_mapped_frame(input_path, start, payload_size, output_path, output_start, size, use_table, dictionary):
+    """Runs in a worker process, decoding a frame from a map of the compressed file into its place in a map of the
+    output file"""
+    with open(input_path, 'rb') as source, open(output_path, 'r+b') as target:
+        mapped_input = map_file(source)
+        mapped_output = map_file(target, write=True)
+    view = memoryview(mapped_input)
+    frame, stages = run_measured(decompress_frame, view[start:start + payload_size], size, use_table, dictionary)
+    mapped_output[output_start:output_start + size] = frame
+    view.release()
+    mapped_input.close()
+    mapped_output.close()
+    return stages
+
+
+def compress_file(input_path, output_path, block_size=BLOCK_SIZE, jobs=1, progress=None, sample_size=0, level=0,
+                  codec='huffman', frame_size=FRAME_SIZE, dictionary=None):
+    with open(output_path, 'wb') as f:
+        with CompressWriter(f, block_size, frame_size, jobs, progress, sample_size, level, codec,
+                            dictionary) as writer:
+            writer.write_file(input_path)
+
+
+def decompress_file(input_path, output_path, use_table=True, jobs=1, progress=None, offset=0, length=None,
+                    executor=None):
+    """Decompresses the stream in input_path, or the length bytes of it starting at offset, into output_path. The
+    input is memory mapped and the output is allocated at its full size and mapped, so every frame is decoded from
+    the page cache into its place in the output file. executor is a pool shared with the caller, used in place of
+    starting one of jobs processes. The output is written next to output_path and only replaces it once every frame
+    and the digest have checked out, so a corrupted stream leaves nothing behind. Raises ValueError if the stream is
+    corrupted"""
+    with open(input_path, 'rb') as f:
+        mapped_input = map_file(f)
+    view = memoryview(mapped_input)
+    compressed_data = view[offset:len(view) if length is None else offset + length]
+    offsets, digest = frame_offsets(compressed_data)
+    dictionary = stream_format(compressed_data)[0]
+    total = sum(size for start, size, payload_size in offsets)
+    temporary = output_path + '.tmp'
+    mapped_output = None
+    try:
+        with open(temporary, 'w+b') as f:
+            f.truncate(total)
+            mapped_output = map_file(f, write=True) if total else None
+        if jobs <= 1 or len(offsets) <= 1:
+            output_start = 0
+            for start, size, payload_size in offsets:
+                frame = decompress_frame(compressed_data[start:start + payload_size], size, use_table, dictionary,
+                                         progress)
+                mapped_output[output_start:output_start + size] = frame
+                output_start += size
+                if progress is not None:
+                    progress.advance(FRAME_HEADER.size + payload_size, 1)
         else:
-            output.append('0')
-            for char in block:
+            pool = executor or ProcessPoolExecutor(jobs)
+            futures = []
+            try:
+                output_start = 0
+                for start, size, payload_size in offsets:
+                    futures.append(pool.submit(decompress_mapped_frame, input_path, offset + start, payload_size,
+                                               temporary, output_start, size, use_table, dictionary))
+                    output_start += size
+                for (start, size, payload_size), future in zip(offsets, futures):
+                    stages = future.result()
+                    if progress is not None:
+                        progress.add_stages(stages)
+                        progress.advance(FRAME_HEADER.size + payload_size, 1)
+            finally:
+                if executor is None:
+                    pool.shutdown(cancel_futures=True)
+                else:
+                    for future in futures:  # frames after a bad one are not decoded
+                        future.cancel()
+        # every frame matched its own checksum, so the digest can be checked from those alone
+        check_digest(digest, total, stream_checksum(compressed_data, offsets))
+        if mapped_output is not None:
+            mapped_output.close()
+        os.replace(temporary, output_path)
+    finally:
+        if mapped_output is not None:
+            mapped_output.close()  # no view of the output map is ever taken, so it can always be closed
+        if os.path.exists(temporary):  # left by a corrupted stream
+            os.remove(temporary)
+    compressed_data.release()
+    view.release()
+    mapped_input.close()
 
-                output.append(character_direction[char])
 
-    return ''.join(output)
+def verify_mapped_frame(input_path, start, payload_size, size, use_table, dictionary):
+    """Runs in a worker process, decoding a frame from a map of the compressed file and throwing it away, which
+    raises ValueError if it is corrupted"""
+    with open(input_path, 'rb') as source:
+        mapped_input = map_file(source)
+    view = memoryview(mapped_input)
+    stages = run_measured(decompress_frame, view[start:start + payload_size], size, use_table, dictionary)[1]
+    view.release()
+    mapped_input.close()
+    return stages
 
 
-def compress(data, block_size=1000):
-    character_count = calculate_frequency(data)
+def verify_file(input_path, use_table=True, jobs=1, progress=None, offset=0, length=None, executor=None):
+    """Checks the stream in input_path, or the length bytes of it starting at offset, by decoding every frame and
+    comparing it with its checksum without writing anything. With jobs above 1, frames are decoded on a pool of
+    processes that only send back their timings, or on executor if the caller shares one. Stops at the first bad
+    frame, raising ValueError with the offset of its header in the file"""
+    with open(input_path, 'rb') as f:
+        mapped_input = map_file(f)
+    view = memoryview(mapped_input)
+    compressed_data = view[offset:len(view) if length is None else offset + length]
+    offsets, digest = frame_offsets(compressed_data, offset)
+    dictionary = stream_format(compressed_data)[0]
+    pool = None
+    if jobs > 1 and len(offsets) > 1:
+        pool = executor or ProcessPoolExecutor(jobs)
+    futures = [None] * len(offsets)
+    try:
+        if pool is not None:
+            futures = [pool.submit(verify_mapped_frame, input_path, offset + start, payload_size, size, use_table,
+                                   dictionary)
+                       for start, size, payload_size in offsets]
+        for index, ((start, size, payload_size), future) in enumerate(zip(offsets, futures)):
+            try:  # results are taken in order, so a bad frame is only reported once the ones before it pass
+                if future is None:
+                    decompress_frame(compressed_data[start:start + payload_size], size, use_table, dictionary, progress)
+                elif progress is not None:
+                    progress.add_stages(future.result())
+                else:
+                    future.result()
+            except ValueError as error:
+                raise ValueError(f'frame {index} at byte {offset + start - FRAME_HEADER.size}: {error}') from None
+            if progress is not None:
+                progress.advance(FRAME_HEADER.size + payload_size, 1)
+    finally:  # frames after a bad one are not decoded
+        if executor is None:
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)
+        else:
+            for future in futures:
+                if future is not None:
+                    future.cancel()
+    check_digest(digest, sum(size for start, size, payload_size in offsets), stream_checksum(compressed_data, offsets))
+    compressed_data.release()
+    view.release()
+    mapped_input.close()
 
-    unparented_nodes = [Node(None, None, character, character_count[character]) for character in character_count]
 
-    unparented_nodes = form_tree(unparented_nodes)
-    character_direction = calculate_direction(unparented_nodes[0], '')
-    encoded_data = encode(data, character_direction, block_size)
+def compress_shared_frame(name, start, end, block_size, sample_size, level, codec, dictionary):  # runs in a worker
+    shared = shared_memory.SharedMemory(name=name)
+    view = shared.buf[start:end]
+    try:
+        return run_measured(compress_frame, view, block_size, sample_size, level, codec, dictionary)
+    finally:
+        view.release()
+        shared.close()
 
-    for k in character_direction.keys():           # sets all unused characters to 0, instead of really long bitstrings
-        if character_count[k] == 0:
-            character_direction[k] = '0'
 
-    # creates an ordered list of the values, as the keys are no longer needed if it is ordered
-    character_direction = sorted(character_direction.items(), key=lambda kv: kv[0])
+def decompress_shared_frame(input_name, start, payload_size, output_name, output_start, size, use_table, dictionary):
+    """Runs in a worker process, reading the frame from one shared memory block and writing the decompressed
+    characters straight into their place in another"""
+    shared_input = shared_memory.SharedMemory(name=input_name)
+    shared_output = shared_memory.SharedMemory(name=output_name)
+    try:
+        # the compressed data is copied out, so no view of the shared memory outlives it if decoding fails
+        frame, stages = run_measured(decompress_frame, bytes(shared_input.buf[start:start + payload_size]), size,
+                                     use_table, dictionary)
+        shared_output.buf[output_start:output_start + size] = frame
+        return stages
+    finally:
+        shared_input.close()
+        shared_output.close()
 
 
-    codebook = gamma([int('1' + v, 2) for k,v in character_direction])   # encodes codebook with gamma coding
-    finaldata = '1' + codebook + encoded_data       # inserts 1 at beginning so that leading 0s are not stripped
-    finaldata = int(finaldata, 2).to_bytes((len(finaldata) + 7) // 8, byteorder=byteorder)  # converts bits to bytes
-    return finaldata
+def compress(data, block_size=BLOCK_SIZE, jobs=1, progress=None, sample_size=0, level=0, codec='huffman',
+             frame_size=FRAME_SIZE, dictionary=None):
+    if jobs <= 1 or len(data) <= frame_size:
+        output = io.BytesIO()
+        with CompressWriter(output, block_size, frame_size, progress=progress, sample_size=sample_size, level=level,
+                            codec=codec, dictionary=dictionary) as writer:
+            writer.write(data)
+        return output.getvalue()
 
+    if codec not in CODECS:
+        raise ValueError(f'unknown codec {codec}')
+    if frame_size > MAX_FRAME_SIZE:
+        raise ValueError(f'frame size must be between 1 and {MAX_FRAME_SIZE}')
+    lengths = None if dictionary is None else load_dictionary(dictionary)
+    # the input is copied into shared memory once, so workers read their frames without it being pickled
+    data = memoryview(data).cast('B')
+    shared = shared_memory.SharedMemory(create=True, size=len(data))
+    try:
+        shared.buf[:len(data)] = data
+        with ProcessPoolExecutor(jobs) as executor:
+            futures = [(min(frame_size, len(data) - start),
+                        executor.submit(compress_shared_frame, shared.name, start, start + frame_size, block_size,
+                                        sample_size, level, codec, lengths))
+                       for start in range(0, len(data), frame_size)]
+            output = [MAGIC if dictionary is None else DICTIONARY_MAGIC + bytes.fromhex(dictionary)]
+            crc = 0
+            for size, future in futures:  # results are collected in submission order, so the output is deterministic
+                payload, stages = future.result()
+                output += [FRAME_HEADER.pack(size, len(payload)), payload]
+                crc = crc32_combine(crc, frame_checksum(payload), size)
+                if progress is not None:
+                    progress.add_stages(stages)
+                    progress.advance(size, 1)
+        output.append(FRAME_HEADER.pack(0, DIGEST.size) + DIGEST.pack(len(data), crc))
+        return b''.join(output)
+    finally:
+        shared.close()
+        shared.unlink()
 
-def decompress(compressed_data):
+
+def decompress(compressed_data, use_table=True, jobs=1, progress=None):  # returns 0 if the data is corrupted
     if len(compressed_data) == 0:
         return 0
-    compressed_data = bin(int.from_bytes(compressed_data, byteorder=byteorder))[2:]
-    compressed_data = compressed_data[1:]     # removes 1 that was inserted so that leading zeros wouldn't be stripped
+    try:
+        if jobs <= 1:
+            with DecompressReader(io.BytesIO(compressed_data), use_table, progress=progress) as reader:
+                return reader.readall()
+        return decompress_parallel(compressed_data, use_table, jobs, progress)
+    except ValueError:
+        return 0
 
-    character_direction, data = gammadecode(compressed_data)
 
-    block_size = int(data[0:16], 2)  # finds block size
-    data = data[16:]
+def decompress_parallel(compressed_data, use_table, jobs, progress=None):
+    offsets, digest = frame_offsets(compressed_data)
+    dictionary = stream_format(compressed_data)[0]
+    total = sum(size for start, size, payload_size in offsets)
+    check_digest(digest, total, stream_checksum(compressed_data, offsets))  # each frame is checked as it decodes
+    if total == 0:
+        return b''
+    shared_input = shared_memory.SharedMemory(create=True, size=len(compressed_data))
+    shared_output = shared_memory.SharedMemory(create=True, size=total)
+    try:
+        shared_input.buf[:len(compressed_data)] = compressed_data
+        with ProcessPoolExecutor(jobs) as executor:
+            futures = []
+            output_start = 0
+            for start, size, payload_size in offsets:
+                futures.append(executor.submit(decompress_shared_frame, shared_input.name, start, payload_size,
+                                               shared_output.name, output_start, size, use_table, dictionary))
+                output_start += size
+            for (start, size, payload_size), future in zip(offsets, futures):
+                stages = future.result()  # raises the ValueError of a corrupted frame
+                if progress is not None:
+                    progress.add_stages(stages)
+                    progress.advance(FRAME_HEADER.size + payload_size, 1)
+        return bytes(shared_output.buf[:total])
+    finally:
+        for shared in (shared_input, shared_output):
+            shared.close()
+            shared.unlink()
 
-    root_node = Node(None, None, None, None)
-    for code in character_direction.items():    # rebuilding huffman tree from codebook
-        if code[1] == '0':     # character is never used, no need to be inserted into tree
+
+def build_tree(character_direction):
+    """Rebuilds the huffman tree from the codebook, used by decode_tree when no lookup table can be built"""
+    root_node = Node(None, None, None)
+    for character, (code, length) in character_direction.items():
+        if length == 0:     # character is never used, no need to be inserted into tree
             continue
         current_node = root_node
-        for i in code[1]:
-            if i == '0':     # it is left of its parent
+        for shift in range(length - 1, -1, -1):
+            if (code >> shift) & 1 == 0:     # it is left of its parent
                 if current_node.left is not None:   # if child on the left already exists
                     current_node = current_node.left
                 else:
-                    current_node.left = Node(None, None, None, None)
+                    current_node.left = Node(None, None, None)
                     current_node = current_node.left
-                    current_node.directionFromParent = '0'
-            elif i == '1':        # it is right of its parent
+            else:        # it is right of its parent
                 if current_node.right is not None:   # if child on the right already exists
                     current_node = current_node.right
                 else:
-                    current_node.right = Node(None, None, None, None)
+                    current_node.right = Node(None, None, None)
                     current_node = current_node.right
-                    current_node.directionFromParent = '1'
-        current_node.character = code[0]
-    decoded_output = []
+        current_node.character = character
+    return root_node
+
+
+def decode_tree(reader, count, output, offset, root_node):  # decodes count characters by walking the tree bit by bit
+    data = reader.data
+    total_bits = len(data) * 8
+    i = reader.position
     current_node = root_node
-    i = 0
-
-    while i < len(data):
-        if data[i] == '1':           # pure block
-            i += 1
-            block = data[i:i + (block_size * 8)]
-
-            block = chunks(block, 8)
-            for char in block:
-                decoded_output.append(int(char, 2))
-
-            i += (block_size * 8)
-
-        elif data[i] == '0':            # encoded block
-            i += 1
-
-            char_count = 0
-            while char_count < block_size and i < len(data):
-                try:
-                    if data[i] == '1':
-                        current_node = current_node.right
-                        i += 1
-                    elif data[i] == '0':
-                        current_node = current_node.left
-                        i += 1
-                    if current_node.character is not None:
-                        decoded_output.append(current_node.character)
-
-                        current_node = root_node
-                        char_count += 1
-                except AttributeError:
-                    return 0
-
-    return bytes(decoded_output)
-
-
-def gamma(data):
-    """gamma coding allows variable length encoding, so numbers can be stored without a predefined number of bits for
-     each value"""
-    output = []
-    for n in data:
-        nbin = bin(n)[2:]
-        length = len(nbin)
-        output.append(((length-1) * '0') + nbin)
-    return ''.join(output)
-
-
-def gammadecode(data):
-    output = []
-    n = 0
-    i = 0
-    while len(output) < 256:
-        if data[i] == '0':
-            n += 1
-            i += 1
+    end = offset + count
+    while offset < end:
+        if i >= total_bits:
+            raise ValueError('unexpected end of compressed data')
+        if (data[i >> 3] >> (7 - (i & 7))) & 1:
+            current_node = current_node.right
         else:
-            num = 2**n
-            num += int(data[i+1:i+n+1], 2)
-            output.append(num)
-            i += n + 1
-            n = 0
-    output = [bin(i)[3:] for i in output]
-    output = {i: output[i] for i in range(256)}
-    return output, data[i:]
+            current_node = current_node.left
+        i += 1
+        if current_node.character is not None:
+            output[offset] = current_node.character
+            offset += 1
+            current_node = root_node
+    reader.position = i
+
+
+class DecodeTable:
+    """Lookup table indexed by the next table_bits bits of the stream. Each entry holds every character whose code fits
+    completely in those bits, so one lookup can decode several characters at once"""
+    def __init__(self, character_direction):
+        self.table_bits = max(length for code, length in character_direction.values())
+        size = 1 << self.table_bits
+
+        first_character = [0] * size
+        first_length = [0] * size  # 0 marks a prefix that no code starts with
+        for character, (code, length) in character_direction.items():
+            if length == 0:
+                continue
+            shift = self.table_bits - length
+            for index in range(code << shift, (code + 1) << shift):  # every index that starts with this code
+                first_character[index] = character
+                first_length[index] = length
+
+        self.characters = []  # bytes of the characters decoded from each index
+        self.lengths = []     # total bits used by those characters
+        self.first_character = first_character
+        self.first_length = first_length
+        mask = size - 1
+        for index in range(size):
+            characters = bytearray()
+            used = 0
+            while True:
+                next_index = (index << used) & mask
+                length = first_length[next_index]
+                if length == 0 or used + length > self.table_bits:  # the next code does not fit in what is left
+                    break
+                characters.append(first_character[next_index])
+                used += length
+            self.characters.append(bytes(characters))
+            self.lengths.append(used)
+
+    def decode(self, reader, count, output, offset):  # decodes count characters into output starting at offset
+        data = reader.data
+        table_bits = self.table_bits
+        mask = (1 << table_bits) - 1
+        characters = self.characters
+        lengths = self.lengths
+        first_character = self.first_character
+        first_length = self.first_length
+
+        byte_position = reader.position >> 3
+        bit_count = 8 - (reader.position & 7)  # number of unread bits held in accumulator
+        if byte_position >= len(data):
+            raise ValueError('unexpected end of compressed data')
+        accumulator = data[byte_position] & ((1 << bit_count) - 1)
+        byte_position += 1
+        padding = 0  # zero bits added past the end of the data
+
+        end = offset + count
+        multi_end = end - table_bits  # one entry never holds more than table_bits characters
+        while offset < end:
+            if bit_count < table_bits:  # refills the accumulator with up to 8 more bytes
+                refill = data[byte_position:byte_position + 8]
+                byte_position += len(refill)
+                accumulator = (((accumulator & ((1 << bit_count) - 1)) << (len(refill) * 8))
+                               | int.from_bytes(refill, 'big'))
+                bit_count += len(refill) * 8
+                if bit_count < table_bits:
+                    padding += table_bits - bit_count
+                    accumulator <<= table_bits - bit_count
+                    bit_count = table_bits
+            index = (accumulator >> (bit_count - table_bits)) & mask
+            if offset < multi_end:
+                decoded = characters[index]
+                if not decoded:
+                    raise ValueError('invalid code in compressed data')
+                output[offset:offset + len(decoded)] = decoded
+                offset += len(decoded)
+                bit_count -= lengths[index]
+            else:  # close to the end of the block, so characters are taken one at a time
+                if first_length[index] == 0:
+                    raise ValueError('invalid code in compressed data')
+                output[offset] = first_character[index]
+                offset += 1
+                bit_count -= first_length[index]
+
+        if bit_count < padding:
+            raise ValueError('unexpected end of compressed data')
+        reader.position = byte_position * 8 + padding - bit_count
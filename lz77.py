@@ -0,0 +1,126 @@
+import huffman  # for load_numpy, numpy is optional and without it the hash chains are built with a dictionary
+
+WINDOW_SIZE = 1 << 15  # furthest back a match can start
+MIN_MATCH = 3  # shorter repeats cost more to describe than the characters themselves
+MAX_MATCH = 258
+# compression level: (candidates checked at each position, lazy matching, match length that ends the search early)
+LEVELS = {1: (4, False, 16), 2: (16, True, 64), 3: (64, True, MAX_MATCH)}
+
+# the same length and distance codes as deflate. Each code covers a range of values starting at its base, and the
+# position inside the range is sent as that many extra bits after the code
+LENGTH_BASE = [3, 4, 5, 6, 7, 8, 9, 10, 11, 13, 15, 17, 19, 23, 27, 31, 35, 43, 51, 59, 67, 83, 99, 115, 131, 163, 195,
+               227, 258]
+LENGTH_EXTRA = [0, 0, 0, 0, 0, 0, 0, 0, 1, 1, 1, 1, 2, 2, 2, 2, 3, 3, 3, 3, 4, 4, 4, 4, 5, 5, 5, 5, 0]
+DISTANCE_BASE = [1, 2, 3, 4, 5, 7, 9, 13, 17, 25, 33, 49, 65, 97, 129, 193, 257, 385, 513, 769, 1025, 1537, 2049, 3073,
+                 4097, 6145, 8193, 12289, 16385, 24577]
+DISTANCE_EXTRA = [0, 0, 0, 0, 1, 1, 2, 2, 3, 3, 4, 4, 5, 5, 6, 6, 7, 7, 8, 8, 9, 9, 10, 10, 11, 11, 12, 12, 13, 13]
+LITERAL_SYMBOLS = 256 + len(LENGTH_BASE)  # characters 0-255, then one symbol for each length code
+DISTANCE_SYMBOLS = len(DISTANCE_BASE)
+
+
+def code_lookup(base, extra, largest):  # list giving the code of every value up to largest
+    lookup = [0] * (largest + 1)
+    for code in range(len(base)):
+        for value in range(base[code], min(base[code] + (1 << extra[code]), largest + 1)):
+            lookup[value] = code
+    return lookup
+
+
+LENGTH_CODE = code_lookup(LENGTH_BASE, LENGTH_EXTRA, MAX_MATCH)
+LENGTH_CODE[MAX_MATCH] = len(LENGTH_BASE) - 1  # 258 has a code of its own instead of being 227 + 31
+DISTANCE_CODE = code_lookup(DISTANCE_BASE, DISTANCE_EXTRA, WINDOW_SIZE)
+
+
+def match_length(data, earlier, position, limit):  # how many characters at position repeat those at earlier
+    length = 0
+    while (length + 16 <= limit
+           and data[earlier + length:earlier + length + 16] == data[position + length:position + length + 16]):
+        length += 16
+    while length < limit and data[earlier + length] == data[position + length]:
+        length += 1
+    return length
+
+
+class MatchFinder:
+    """Finds repeated strings in data with hash chains. previous links every position to the last position before it
+    starting with the same 3 characters, so the candidates for a match are checked newest first. The chains cover the
+    whole of data, so a block's matches can reach back into the blocks before it"""
+    def __init__(self, data, level):
+        self.data = bytes(data)
+        self.max_chain, self.lazy, self.nice_length = LEVELS[level]
+        self.previous = hash_chains(self.data)
+
+    def find(self, position, end):
+        """Returns (length, distance) of the longest match for the characters at position that stays before end,
+        length is 0 if there is none"""
+        data = self.data
+        limit = min(MAX_MATCH, end - position)
+        if limit < MIN_MATCH:
+            return 0, 0
+        previous = self.previous
+        best_length = 0
+        best_distance = 0
+        candidate = previous[position]
+        chain = self.max_chain
+        while candidate >= 0 and position - candidate <= WINDOW_SIZE and chain:
+            # a candidate can only be longer if it matches the character just past the best so far
+            if data[candidate + best_length] == data[position + best_length]:
+                length = match_length(data, candidate, position, limit)
+                if length > best_length:
+                    best_length = length
+                    best_distance = position - candidate
+                    if length >= self.nice_length or length == limit:
+                        break
+            candidate = previous[candidate]
+            chain -= 1
+        if best_length < MIN_MATCH:
+            return 0, 0
+        return best_length, best_distance
+
+    def tokens(self, start, end):
+        """Splits data[start:end] into characters (ints) and (length, distance) matches. With lazy matching, a match
+        is put off by a character if the next position has a longer one"""
+        data = self.data
+        output = []
+        position = start
+        match = self.find(position, end)
+        while position < end:
+            length, distance = match
+            if length == 0:
+                output.append(data[position])
+                position += 1
+                match = self.find(position, end)
+                continue
+            if self.lazy and length < self.nice_length:
+                next_match = self.find(position + 1, end)
+                if next_match[0] > length:
+                    output.append(data[position])
+                    position += 1
+                    match = next_match
+                    continue
+            output.append((length, distance))
+            position += length
+            match = self.find(position, end)
+        return output
+
+
+def hash_chains(data):
+    """Returns a list holding, for every position, the last position before it starting with the same 3 characters,
+    or -1. The chains do not depend on which matches are chosen, so they are built in one pass up front"""
+    previous = [-1] * len(data)
+    if len(data) < MIN_MATCH:
+        return previous
+    np = huffman.load_numpy()
+    if np is not None:  # stable sorting groups positions by their 3 characters, each group in order
+        characters = np.frombuffer(data, dtype=np.uint8).astype(np.int32)
+        keys = (characters[:-2] << 16) | (characters[1:-1] << 8) | characters[2:]
+        order = np.argsort(keys, kind='stable')
+        same = keys[order[1:]] == keys[order[:-1]]
+        chains = np.full(len(data), -1, dtype=np.int64)
+        chains[order[1:][same]] = order[:-1][same]
+        return chains.tolist()
+    head = {}
+    for position, key in enumerate(zip(data, data[1:], data[2:])):
+        previous[position] = head.get(key, -1)
+        head[key] = position
+    return previous
@@ -1,17 +1,21 @@
-from glob import glob
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import json
 import os
+import queue
 from string import ascii_uppercase
 import threading
 import tkinter
 from datetime import datetime
 from time import time
-from tkinter import colorchooser, ttk, messagebox
+from tkinter import colorchooser, ttk, messagebox, simpledialog
 from PIL import ImageTk, Image
 import tarfile
 
+import archive
 import huffman
-import encrypt
+import lz77
+from progress import Progress
 
 
 class Icon:
@@ -22,30 +26,144 @@ class Icon:
         self.tk = ImageTk.PhotoImage(self.icon)
 
 
+IMAGE_FORMATS = ['.png', '.jpg', '.jpeg', '.gif']
+TEXT_FORMATS = ['.txt', '.doc', '.docx', '.pdf']
+ROW_HEIGHT = 36  # pixels taken by each row of the explorer pane, which sets how many rows it makes
+CACHE_SIZE = 64  # directory listings kept by the scanner, the least recently used is dropped first
+POLL_INTERVAL = 50  # milliseconds between checks for results from the scanner thread
+CONFIG_DELAY = 500  # milliseconds a change to the settings waits before being written, so a burst is written once
+SORT_KEYS = {'name': lambda entry: entry.name.lower(), 'size': lambda entry: entry.size,
+             'date': lambda entry: entry.mtime}
+
+
+class Entry:    # one file or folder of the current directory, holding only what scandir found out about it
+    __slots__ = ('path', 'name', 'file_type', 'size', 'mtime', 'selected')
+
+    def __init__(self, dir_entry):
+        self.path = dir_entry.path
+        self.name = dir_entry.name
+        self.file_type = 'file'
+        self.size = 0
+        self.mtime = 0.0
+        self.selected = False
+        try:
+            if dir_entry.is_dir():
+                self.file_type = 'dir'
+            stat = dir_entry.stat()     # comes with the directory listing on windows, one call elsewhere
+            self.size = stat.st_size
+            self.mtime = stat.st_mtime
+        except OSError:
+            print(f'error finding metadata for {self.path}')
+
+    def toggle_select(self, result=None):   # like Item.toggle_select, the row showing it is recoloured on refresh
+        self.selected = not self.selected if result is None else result == 1
+
+
+def scan_directory(path):  # entries of path from a single os.scandir pass, leaving out hidden ones like glob did
+    try:
+        with os.scandir(path) as dir_entries:
+            return [Entry(dir_entry) for dir_entry in dir_entries if not dir_entry.name.startswith('.')]
+    except OSError:
+        return []
+
+
+def find_shortcuts(shortcuts):  # (path, file type) of each shortcut then each drive letter, which probes every drive
+    drive_letters = [letter + ':' for letter in ascii_uppercase if os.path.exists(letter + ':')]
+    return [(path, 'dir' if os.path.isdir(path) else 'file') for path in shortcuts + drive_letters]
+
+
+def save_configs(configs, path='configs.json'):  # written to a temporary file first so a crash can't leave half of it
+    with open(path + '.tmp', 'w') as f:
+        json.dump(configs, f, indent=4)
+    os.replace(path + '.tmp', path)
+
+
+class DirectoryScanner(threading.Thread):
+    """Lists directories and probes shortcuts on a background thread, so a slow network mount never blocks the event
+    loop. Requests are queued with scan() and find_shortcuts(), and results are put on the results queue for the main
+    thread to poll. Listings are kept in an LRU cache with the directory's mtime, and a directory is only listed again
+    once its mtime changes, or when force is set"""
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.requests = queue.Queue()
+        self.results = queue.Queue()  # ('directory', path, entries or None if the cached ones are current), or
+        #                               ('shortcuts', None, find_shortcuts result)
+        self.cache = OrderedDict()  # path: (mtime, entries), most recently used last
+        self.lock = threading.Lock()  # the cache is also read by the main thread
+        self.latest = None  # only the directory asked for last is listed, older requests are skipped
+
+    def scan(self, path, force=False):
+        self.latest = path
+        self.requests.put(('directory', path, force))
+
+    def find_shortcuts(self, shortcuts):
+        self.requests.put(('shortcuts', list(shortcuts), False))
+
+    def cached(self, path):  # entries of path from its last listing, or None, without touching the disk
+        with self.lock:
+            if path not in self.cache:
+                return None
+            self.cache.move_to_end(path)
+            return self.cache[path][1]
+
+    def run(self):
+        while True:
+            kind, argument, force = self.requests.get()
+            if kind == 'shortcuts':
+                self.results.put(('shortcuts', None, find_shortcuts(argument)))
+            elif argument == self.latest:
+                self.results.put(('directory', argument, self.list_directory(argument, force)))
+
+    def list_directory(self, path, force):
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            mtime = None  # missing or unreadable, so there is nothing to cache
+        with self.lock:
+            cached = self.cache.get(path)
+        if cached is not None and cached[0] == mtime and mtime is not None and not force:
+            return None
+        entries = scan_directory(path)
+        with self.lock:
+            if mtime is None:
+                self.cache.pop(path, None)
+            else:
+                self.cache[path] = (mtime, entries)
+                self.cache.move_to_end(path)
+                while len(self.cache) > CACHE_SIZE:
+                    self.cache.popitem(last=False)
+        return entries
+
+
+def sort_entries(entries, column, reverse=False):
+    return sorted(entries, key=SORT_KEYS[column], reverse=reverse)
+
+
+def format_size(size):
+    if size > 1e9:         # depending on the file size, change to display in KB or MB or GB or just B
+        return str(float('%.3g' % (size / 1e9))) + " GB"
+    elif size > 1e6:
+        return str(float('%.3g' % (size / 1e6))) + " MB"
+    elif size > 1e3:
+        return str(float('%.3g' % (size / 1e3))) + " KB"
+    return str(size) + " B"
+
+
+def format_time(mtime):
+    try:
+        return str(datetime.fromtimestamp(mtime).replace(microsecond=0))
+    except (OverflowError, OSError, ValueError):
+        return ''
+
+
 class Item(tkinter.Button):
-    def __init__(self, parent, path, index, frame):
+    def __init__(self, parent, frame):
         super().__init__(frame, compound='left', justify='left', anchor='w', relief='flat',
                          bg=parent.primary_colour, foreground=parent.text_colour)
 
         self.parent = parent   # keeps a pointer to the explorer frame
-        self.path = path     # path that the Item represents
-        self.selected = False
         self.rightclick_menu = tkinter.Menu(parent, tearoff=0)
-        self.rightclick_menu.add_command(label='Open externally', command=lambda x=self.path: os.startfile(x))
-
-        image_formats = ['.png', '.jpg', '.jpeg', '.gif']
-        text_formats = ['.txt', '.doc', '.docx', '.pdf']
-        self.icon = parent.file_icon.tk
-        self.file_type = 'file'
-        if os.path.isdir(self.path):               # sets what icon should be shown next to the file
-            self.file_type = 'dir'
-            self.icon = self.parent.folder_icon.tk
-        elif os.path.splitext(self.path)[1] in image_formats:
-            self.icon = self.parent.image_icon.tk
-        elif os.path.splitext(self.path)[1] in text_formats:
-            self.icon = self.parent.text_icon.tk
-
-        self.configure(image=self.icon)
+        self.rightclick_menu.add_command(label='Open externally', command=lambda: os.startfile(self.path))
 
         self.bind('<Shift-Button-1>', lambda event, item=self, click_type='shift': self.parent.click(self, click_type))
         self.bind('<Button-1>', lambda event, item=self, click_type='single': self.parent.click(self, click_type))
@@ -55,6 +173,15 @@ class Item(tkinter.Button):
         self.bind('<Shift-Button-3>',
                   lambda event, item=self, click_type='right_shift': self.parent.click(self, click_type))
 
+    def icon_for(self, path, file_type):   # sets what icon should be shown next to the file
+        if file_type == 'dir':
+            return self.parent.folder_icon.tk
+        elif os.path.splitext(path)[1] in IMAGE_FORMATS:
+            return self.parent.image_icon.tk
+        elif os.path.splitext(path)[1] in TEXT_FORMATS:
+            return self.parent.text_icon.tk
+        return self.parent.file_icon.tk
+
     def toggle_select(self, result=None):
         if result == 0:
             self.selected = False
@@ -72,8 +199,12 @@ class Item(tkinter.Button):
 
 
 class ShortcutButton(Item):             # class for Items that appear in the shortcut window on the left
-    def __init__(self, parent, path, index):
-        super().__init__(parent, path, index, parent.shortcuts_frame.interior_frame)
+    def __init__(self, parent, path, file_type, index):
+        super().__init__(parent, parent.shortcuts_frame.interior_frame)
+        self.path = path     # path that the Item represents
+        self.selected = False
+        self.file_type = file_type     # found by the scanner thread, as the path may be on a slow drive
+        self.configure(image=self.icon_for(self.path, self.file_type))
         self.rightclick_menu.add_command(label='Remove Shortcut', command=self.remove_shortcut)
         self.text = os.path.normpath(self.path)
         self.grid(sticky='ew', column=0, row=index)
@@ -83,7 +214,7 @@ class ShortcutButton(Item):             # class for Items that appear in the sho
 
     def remove_shortcut(self):
         self.parent.shortcuts.remove(self.path)
-        self.parent.update_items()
+        self.parent.update_shortcuts()
         self.parent.update_configs()
 
     def delete(self):
@@ -91,51 +222,64 @@ class ShortcutButton(Item):             # class for Items that appear in the sho
 
 
 class ExplorerButton(Item):
-    def __init__(self, parent, path, index):
-        super().__init__(parent, path, index, parent.explorer_frame.interior_frame)
-        self.grid(sticky='ew', column=0, row=index, ipadx=60)
+    """A row of the explorer pane. Rows are only made for what fits on screen and are reused as the list scrolls, so
+    the path, type and selection of a row are those of whichever Entry it is showing"""
+    def __init__(self, parent, frame, index):
+        super().__init__(parent, frame.interior_frame)
+        self.entry = None
+        self.index = index     # grid row, 0 is the column headings
 
         self.rightclick_menu.add_command(label='Add to Archive', command=parent.create_archive_window)
         self.rightclick_menu.add_command(label='Decompress Archive', command=parent.decompress_archive_window)
+        self.rightclick_menu.add_command(label='Compact Archive', command=parent.compact_archive)
         self.rightclick_menu.add_command(label='Add to Shortcuts', command=self.add_shortcut)
-        self.selected = False
-        self.file_size = os.stat(self.path).st_size
 
-        try:
-            self.last_modified = datetime.fromtimestamp(os.stat(self.path).st_mtime)
-            self.last_modified = str(self.last_modified.replace(microsecond=0))
-        except OSError:
-            print(f'error finding metadata for {self.path}')
-            self.last_modified = ''
-
-        if self.file_size > 1e9:         # depending on the file size, change to display in KB or MB or GB or just B
-            self.file_size = str(float('%.3g' % (self.file_size / 1e9))) + " GB"
-        elif self.file_size > 1e6:
-            self.file_size = str(float('%.3g' % (self.file_size / 1e6))) + " MB"
-        elif self.file_size > 1e3:
-            self.file_size = str(float('%.3g' % (self.file_size / 1e3))) + " KB"
-        else:
-            self.file_size = str(self.file_size) + " B"
-
-        self.size_label = tkinter.Label(parent.explorer_frame.interior_frame, text=self.file_size,
-                                        foreground=parent.text_colour, background=parent.primary_colour, pady=9,
-                                        padx=20,
-                                        justify='left')
-        self.size_label.grid(row=index, column=1, sticky='we')
-
-        self.last_modified_label = tkinter.Label(parent.explorer_frame.interior_frame, text=self.last_modified,
-                                                 foreground=parent.text_colour, background=parent.primary_colour,
-                                                 pady=9,
-                                                 justify='left', padx=40)
-        self.last_modified_label.grid(row=index, column=2, sticky='we')
-        self.text = os.path.split(self.path)[-1]         # returns only the filename from the whole filepath
-        if len(self.text) > 60:       # if path is too long, don't display all of it
-            self.text = self.text[:57] + "..."
-        self.configure(text=self.text, image=self.icon)
+        self.size_label = tkinter.Label(frame.interior_frame, foreground=parent.text_colour,
+                                        background=parent.primary_colour, pady=9, padx=20, justify='left')
+        self.last_modified_label = tkinter.Label(frame.interior_frame, foreground=parent.text_colour,
+                                                 background=parent.primary_colour, pady=9, justify='left', padx=40)
+        for widget in (self, self.size_label, self.last_modified_label):
+            frame.bind_wheel(widget)
+
+    @property
+    def path(self):
+        return self.entry.path
+
+    @property
+    def file_type(self):
+        return self.entry.file_type
+
+    @property
+    def selected(self):
+        return self.entry.selected
+
+    @selected.setter
+    def selected(self, value):
+        self.entry.selected = value
+
+    def show(self, entry):  # fills the row in with entry, or hides it if entry is None
+        self.entry = entry
+        if entry is None:
+            self.grid_remove()
+            self.size_label.grid_remove()
+            self.last_modified_label.grid_remove()
+            return
+        text = entry.name
+        if len(text) > 60:       # if path is too long, don't display all of it
+            text = text[:57] + "..."
+        self.configure(text=text, image=self.icon_for(entry.path, entry.file_type), foreground=self.parent.text_colour,
+                       bg=self.parent.secondary_colour if entry.selected else self.parent.primary_colour)
+        self.size_label.configure(text=format_size(entry.size), foreground=self.parent.text_colour,
+                                  background=self.parent.primary_colour)
+        self.last_modified_label.configure(text=format_time(entry.mtime), foreground=self.parent.text_colour,
+                                           background=self.parent.primary_colour)
+        self.grid(sticky='ew', column=0, row=self.index, ipadx=60)
+        self.size_label.grid(row=self.index, column=1, sticky='we')
+        self.last_modified_label.grid(row=self.index, column=2, sticky='we')
 
     def add_shortcut(self):
         self.parent.shortcuts.append(self.path)
-        self.parent.update_items()
+        self.parent.update_shortcuts()
         self.parent.update_configs()
 
     def delete(self):
@@ -144,6 +288,73 @@ class ExplorerButton(Item):
         self.destroy()
 
 
+class VirtualList(tkinter.Frame):
+    """Explorer pane that only has widgets for the rows that fit in it. Scrolling changes which entries the rows show
+    rather than moving the rows, so opening a folder of 50,000 files makes as many widgets as opening one of 5"""
+    def __init__(self, padx, width, height, parent):
+        super().__init__()
+        self.parent = parent    # keeps pointer to parent frame
+        self.grid(row=1, column=0, sticky='w', padx=padx)
+        self.entries = []
+        self.first = 0     # index of the entry shown in the top row
+        self.interior_frame = tkinter.Frame(self, width=width, height=height)
+        self.interior_frame.grid_propagate(False)   # stays the same size whatever the rows hold
+        self.scrollbar = ttk.Scrollbar(self, command=self.yview)
+        self.scrollbar.pack(side='right', fill='y')
+        self.interior_frame.pack(anchor='w')
+        self.bind_wheel(self.interior_frame)
+
+        self.name_column = tkinter.Label(self.interior_frame, text='Name')
+        self.name_column.grid(column=0, row=0, sticky='w')
+        self.date_column = tkinter.Label(self.interior_frame, text='File Size', padx=22)
+        self.date_column.grid(column=1, row=0, sticky='w')
+        self.time_column = tkinter.Label(self.interior_frame, text='Date modified', padx=54)
+        self.time_column.grid(column=2, row=0, sticky='w')
+        for label, column in ((self.name_column, 'name'), (self.date_column, 'size'), (self.time_column, 'date')):
+            label.bind('<Button-1>', lambda event, column=column: self.parent.sort_items(column))
+
+        self.rows = [ExplorerButton(parent, self, index + 1) for index in range(height // ROW_HEIGHT - 1)]
+
+    def bind_wheel(self, widget):
+        widget.bind('<MouseWheel>', self.wheel)       # windows and mac
+        widget.bind('<Button-4>', self.wheel)         # linux
+        widget.bind('<Button-5>', self.wheel)
+
+    def wheel(self, event):
+        if event.num == 4 or event.delta > 0:
+            self.scroll_to(self.first - 3)
+        elif event.num == 5 or event.delta < 0:
+            self.scroll_to(self.first + 3)
+
+    def yview(self, *args):  # called by the scrollbar with ('moveto', fraction) or ('scroll', amount, 'units'/'pages')
+        if args[0] == 'moveto':
+            self.scroll_to(round(float(args[1]) * len(self.entries)))
+        elif args[0] == 'scroll':
+            self.scroll_to(self.first + int(args[1]) * (len(self.rows) if args[2] == 'pages' else 1))
+
+    def scroll_to(self, first):
+        self.first = max(0, min(first, len(self.entries) - len(self.rows)))
+        self.refresh()
+
+    def show(self, entries, first=0):  # replaces the list with entries, scrolled to first
+        self.entries = entries
+        self.scroll_to(first)
+
+    def refresh(self):  # fills the rows in from the entries scrolled to, after scrolling or a change of selection
+        for index, row in enumerate(self.rows):
+            position = self.first + index
+            row.show(self.entries[position] if position < len(self.entries) else None)
+        if self.entries:
+            self.scrollbar.set(self.first / len(self.entries),
+                               min(1.0, (self.first + len(self.rows)) / len(self.entries)))
+        else:
+            self.scrollbar.set(0.0, 1.0)
+
+    def change_colour(self):
+        self.interior_frame.configure(bg=self.parent.primary_colour)
+        self.refresh()
+
+
 class ScrollableFrame(tkinter.Frame):  # Custom tkinter widget, tkinter does not allow frames to scroll normally
     def __init__(self, padx, width, height, parent):
         super().__init__()
@@ -204,8 +415,15 @@ class Main(tkinter.Tk):
 
         self.items = []
         self.shortcut_items = []
-
-        self.explorer_frame = ScrollableFrame(padx=235, width=800, height=700, parent=self)
+        self.shortcut_types = []    # (path, file type) of the shortcuts and drives, from the scanner
+        self.config_job = None      # after() id of a settings write waiting for CONFIG_DELAY
+        self.config_writer = ThreadPoolExecutor(1)   # writes the settings in order, off the main thread
+        self.scanner = DirectoryScanner()
+        self.scanner.start()
+
+        self.sort_column = 'name'     # what the explorer is sorted by, changed by clicking the column headings
+        self.sort_reverse = False
+        self.explorer_frame = VirtualList(padx=235, width=800, height=700, parent=self)
         self.shortcuts_frame = ScrollableFrame(padx=0, width=200, height=700, parent=self)
 
         self.textbar_frame = tkinter.Frame(self)
@@ -220,27 +438,29 @@ class Main(tkinter.Tk):
 
         self.menu = tkinter.Menu(self)
         self.menu_file = tkinter.Menu(self.menu, tearoff=0)
-        self.menu_file.add_command(label='Refresh', command=self.update_items)
+        self.menu_file.add_command(label='Refresh', command=self.refresh)
         self.menu.add_cascade(label='File', menu=self.menu_file)
         self.menu_options = tkinter.Menu(self.menu, tearoff=0)
         self.menu_options.add_command(label='Settings', command=lambda: self.settings_window())
 
         self.menu.add_cascade(label='Options', menu=self.menu_options)
         self.config(menu=self.menu)
+        self.protocol('WM_DELETE_WINDOW', self.close)
+        self.update_shortcuts()
         self.update_items()
-
-        self.name_column = tkinter.Label(self.explorer_frame.interior_frame, text='Name')
-        self.name_column.grid(column=0, row=0, sticky='w')
-        self.date_column = tkinter.Label(self.explorer_frame.interior_frame, text='File Size', padx=22)
-        self.date_column.grid(column=1, row=0, sticky='w')
-        self.time_column = tkinter.Label(self.explorer_frame.interior_frame, text='Date modified', padx=54)
-        self.time_column.grid(column=2, row=0, sticky='w')
+        self.poll_scanner()
 
         self.change_colour('primary', self.primary_colour)
         self.change_colour('secondary', self.secondary_colour)
         self.change_colour('text', self.text_colour)
 
-    def update_configs(self):
+    def update_configs(self):  # the write happens CONFIG_DELAY ms after the last change, so a burst is written once
+        if self.config_job is not None:
+            self.after_cancel(self.config_job)
+        self.config_job = self.after(CONFIG_DELAY, self.write_configs)
+
+    def write_configs(self):
+        self.config_job = None
         configs = {'PrimaryColour': self.primary_colour,
                    'SecondaryColour': self.secondary_colour,
                    'TextColour': self.text_colour,
@@ -250,29 +470,19 @@ class Main(tkinter.Tk):
                    "LastDirectory": self.last_directory
                    }
 
-        with open('configs.json', 'w') as f:
-            json.dump(configs, f, indent=4)
-
-    def update_items(self):  # Refreshes UI
-
-        for item in self.items + self.shortcut_items:  # Clears current items
-            item.delete()
-
-        self.items = []
-        self.shortcut_items = []
-
-        input_files = glob(self.current_dir + "/*")  # gets list of files from the selected directory
+        self.config_writer.submit(save_configs, configs)
 
-        for index, input_file in enumerate(input_files):  # Creates items in the explorer window
-            self.items.append(ExplorerButton(path=input_file, parent=self, index=index + 1))
-
-        drive_letters = []
-        for i in ascii_uppercase:       # finds all drive letters in the computer
-            if os.path.exists(i + ':'):
-                drive_letters.append(i + ':')
+    def close(self):  # writes any settings still waiting before the window goes
+        if self.config_job is not None:
+            self.after_cancel(self.config_job)
+            self.write_configs()
+        self.config_writer.shutdown()
+        self.destroy()
 
-        for index, shortcut in enumerate(self.shortcuts + drive_letters):  # Creates items in the shortcuts window
-            self.shortcut_items.append(ShortcutButton(path=shortcut, parent=self, index=index))
+    def update_items(self, force=False):  # Refreshes UI
+        # a directory seen before is shown from the cache straight away, and the scanner lists it again if it changed
+        self.show_entries(self.scanner.cached(self.current_dir) or [])
+        self.scanner.scan(self.current_dir, force)
 
         self.textbar_entry.delete(0, tkinter.END)
         self.textbar_entry.insert(0, os.path.normpath(self.current_dir))  # alter textbar to display current directory
@@ -280,6 +490,47 @@ class Main(tkinter.Tk):
         self.last_directory = self.current_dir
         self.update_configs()
 
+    def refresh(self):  # lists the directory and probes the drives again, even if nothing seems to have changed
+        self.update_shortcuts()
+        self.update_items(force=True)
+
+    def update_shortcuts(self):  # the drives and shortcuts are probed on the scanner thread, see show_shortcuts
+        self.scanner.find_shortcuts(self.shortcuts)
+
+    def poll_scanner(self):  # tkinter is not thread safe, so the main thread collects the scanner's results
+        while True:
+            try:
+                kind, path, result = self.scanner.results.get_nowait()
+            except queue.Empty:
+                break
+            if kind == 'shortcuts':
+                self.shortcut_types = result
+                self.show_shortcuts()
+            elif path == self.current_dir and result is not None:   # older directories and unchanged ones are skipped
+                self.show_entries(result, self.explorer_frame.first)
+        self.after(POLL_INTERVAL, self.poll_scanner)
+
+    def show_entries(self, entries, first=0):  # entries still in the listing stay selected, the rest are unselected
+        selected = {item.path for item in self.items if item.selected}
+        for entry in entries:
+            entry.selected = entry.path in selected
+        # the explorer rows are reused, so only the entries of the selected directory are replaced
+        self.items = sort_entries(entries, self.sort_column, self.sort_reverse)
+        self.explorer_frame.show(self.items, first)
+
+    def show_shortcuts(self):
+        for item in self.shortcut_items:  # Clears current items
+            item.delete()
+        self.shortcut_items = []
+        for index, (shortcut, file_type) in enumerate(self.shortcut_types):  # Creates items in the shortcuts window
+            self.shortcut_items.append(ShortcutButton(path=shortcut, file_type=file_type, parent=self, index=index))
+
+    def sort_items(self, column):  # sorts by column, or reverses the order if it is already sorted by it
+        self.sort_reverse = not self.sort_reverse if column == self.sort_column else False
+        self.sort_column = column
+        self.items = sort_entries(self.items, self.sort_column, self.sort_reverse)
+        self.explorer_frame.show(self.items)
+
     def motion(self, event):  # Keeps track of mouse position
         self.mouse_x = event.x_root
         self.mouse_y = event.y_root
@@ -303,6 +554,50 @@ class Main(tkinter.Tk):
             if item.selected:
                 DecompressArchive(self, item)
 
+    def compact_archive(self):  # rewrites selected archives without the space left by updates, on another thread
+        jobs = []  # (path, password)
+        for item in self.items:
+            if not item.selected or not os.path.isfile(item.path) or not archive.is_archive(item.path):
+                continue
+            password = ''
+            if archive.is_encrypted(item.path):   # only encrypted archives need a password to rewrite the directory
+                password = simpledialog.askstring('Compact Archive', f'Enter Password for {item.name}', show='*',
+                                                  parent=self)
+                if password is None:
+                    return
+            jobs.append((item.path, password))
+        if not jobs:
+            return
+        results = queue.Queue()  # ('done', bytes reclaimed) or ('error', message), then ('finished', None)
+        threading.Thread(target=self.compact_archives, args=(jobs, results), daemon=True).start()
+        self.after(POLL_INTERVAL, self.poll_compaction, results)
+
+    @staticmethod
+    def compact_archives(jobs, results):  # runs on the worker thread, so it must not touch tkinter
+        for path, password in jobs:
+            try:
+                results.put(('done', archive.compact_archive(path, password)))
+            except ValueError:
+                results.put(('error', f'{os.path.basename(path)}: Incorrect password or corrupted archive'))
+            except OSError as e:
+                results.put(('error', f'{os.path.basename(path)}: {e}'))
+        results.put(('finished', None))
+
+    def poll_compaction(self, results):  # the main thread shows the worker's results as they arrive
+        while True:
+            try:
+                kind, result = results.get_nowait()
+            except queue.Empty:
+                self.after(POLL_INTERVAL, self.poll_compaction, results)
+                return
+            if kind == 'done':
+                tkinter.messagebox.showinfo(title='Compaction successful', message=f'Reclaimed {result / 1e6:.2f} MB')
+            elif kind == 'error':
+                tkinter.messagebox.showerror(title='Compaction failed', message=result)
+            else:
+                break
+        self.update_items(force=True)     # sizes changed, which the directory's mtime does not show
+
     def click(self, clicked_item, click_type):    # called when a file is clicked on
 
         if click_type == 'single':
@@ -314,6 +609,7 @@ class Main(tkinter.Tk):
                     item.toggle_select(0)
 
                 clicked_item.toggle_select(1)
+                self.explorer_frame.refresh()     # recolours the rows of the entries that were unselected
 
         elif click_type == 'double':
             if clicked_item.file_type == 'dir':
@@ -327,6 +623,7 @@ class Main(tkinter.Tk):
             for item in self.items:
                 item.toggle_select(0)
             clicked_item.toggle_select(1)
+            self.explorer_frame.refresh()
             clicked_item.rightclick_menu.tk_popup(self.mouse_x, self.mouse_y)
 
         elif click_type == 'right_shift':
@@ -342,7 +639,7 @@ class Main(tkinter.Tk):
             self.secondary_colour = colour
         elif colour_type == 'text':
             self.text_colour = colour
-            self.update_items()
+            self.show_shortcuts()
 
         self.configure(bg=self.secondary_colour)
         self.shortcuts_frame.change_colour()
@@ -407,6 +704,21 @@ class Settings(tkinter.Toplevel):
         self.destroy()
 
 
+def progress_text(progress):     # percent, throughput and time left of a job, shown under its progress bar
+    snapshot = progress.snapshot()
+    text = f'{snapshot["mb_per_s"]:.1f} MB/s'
+    if snapshot['percent'] is not None:
+        text = f'{snapshot["percent"]:.0f}%   ' + text
+    if snapshot['eta_s'] is not None:
+        text += f'   {snapshot["eta_s"]:.0f} s left'
+    return text
+
+
+def stages_text(progress):      # time spent in each stage, slowest first, for the completion message
+    stages = sorted(progress.stage_times().items(), key=lambda stage: stage[1], reverse=True)
+    return '\n'.join(f'{name}: {"%.2f" % seconds} s' for name, seconds in stages)
+
+
 class CreateArchive(tkinter.Toplevel):
     def __init__(self, parent):
         super().__init__()
@@ -435,43 +747,83 @@ class CreateArchive(tkinter.Toplevel):
         self.password_entry.grid(column=0, row=4)
         self.confirm_button = tkinter.Button(self, text="Confirm", command=self.task_thread.start)
         self.confirm_button.grid(row=1, column=0, columnspan=2)
-
-        self.progress_bar = ttk.Progressbar(self, mode='indeterminate', length=250)
+        self.random_access_var = tkinter.BooleanVar()      # archive with a central directory instead of a tar stream
+        self.random_access_checkbutton = tkinter.Checkbutton(self, text='Random access archive',
+                                                             variable=self.random_access_var)
+        self.random_access_checkbutton.grid(column=1, row=3)
+        self.level_label = tkinter.Label(self, text='Compression level (0 fastest, 3 smallest)')
+        self.level_label.grid(column=0, row=6)
+        self.level_spinbox = tkinter.Spinbox(self, from_=0, to=max(lz77.LEVELS), width=5, state='readonly')
+        self.level_spinbox.grid(column=1, row=6)
+        self.bwt_var = tkinter.BooleanVar()      # sorts each frame with the Burrows-Wheeler transform before coding it
+        self.bwt_checkbutton = tkinter.Checkbutton(self, text='Best for text (slower)', variable=self.bwt_var)
+        self.bwt_checkbutton.grid(column=1, row=7)
+        self.dedup_var = tkinter.BooleanVar()      # repeated data is only stored once, needs a random access archive
+        self.dedup_checkbutton = tkinter.Checkbutton(self, text='Skip repeated data', variable=self.dedup_var)
+        self.dedup_checkbutton.grid(column=1, row=8)
+
+        self.progress_bar = ttk.Progressbar(self, mode='determinate', maximum=100, length=250)
         self.progress_label = tkinter.Label(self, text='')
-        self.progress_label.grid(column=0, row=4, columnspan=2)
+        self.progress_label.grid(column=0, row=5, columnspan=2)
+        self.job_progress = None      # set by the compression thread, read by update_progress
+        self.update_progress()
+
+    def update_progress(self):    # tkinter is not thread safe, so the main thread polls the job instead
+        if self.job_progress is not None:
+            fraction = self.job_progress.fraction()
+            self.progress_bar['value'] = 0 if fraction is None else fraction * 100
+            self.progress_label['text'] = progress_text(self.job_progress)
+        self.after(200, self.update_progress)
 
     def confirm_archive(self):
         archive_path = self.archive_entry.get()
-        if os.path.exists(archive_path) is True:
-            overwrite_warning = tkinter.messagebox.askokcancel(title='Compression Warning', message='Path already exists. Overwrite file?', parent=self)
+        append = False
+        if os.path.exists(archive_path) and archive.is_archive(archive_path):   # only changed files need adding
+            append = tkinter.messagebox.askyesnocancel(title='Compression Warning', parent=self,
+                                                       message='Archive already exists. Update it with only the files '
+                                                               'that changed?\n\nNo overwrites it instead.')
+            if append is None:
+                return 0
+        elif os.path.exists(archive_path) is True:
+            overwrite_warning = tkinter.messagebox.askokcancel(title='Compression Warning', parent=self,
+                                                               message='Path already exists. Overwrite file?')
             if overwrite_warning is False:
                 return 0
 
         password = self.password_entry.get()
 
 
-        block_size = 1000
+        block_size = huffman.BLOCK_SIZE
+        jobs = os.cpu_count() or 1     # compresses frames on every core
+        level = int(self.level_spinbox.get())     # above 0 also looks for repeated strings, which is slower
+        codec = 'bwt' if self.bwt_var.get() else 'huffman'
         self.confirm_button['state'] = 'disabled'
         start = time()
         self.progress_bar.grid(column=0, row=2, columnspan=2)
-        self.progress_bar.start()
+        progress = Progress()     # the total is filled in below or by write_tar_archive, in the units each one counts
+        self.job_progress = progress
 
         archive_path = self.archive_entry.get()
-        archive = tarfile.open('temp', 'w:')
-        for i in self.input_files:
-            archive.add(i)
-        archive.close()
-
-        with open('temp', 'rb') as f:
-            data = huffman.compress(f.read(), block_size)
-        with open(archive_path, 'wb') as f:
-            if password != '':
-                data = encrypt.encrypt(data, password)
-
-            f.write(data)
-        os.remove('temp')
-        self.parent.update_items()
-        tkinter.messagebox.showinfo(title='Compression successful', message=f'Completed in {"%.2f" % float(time() - start)} seconds')
+        if self.random_access_var.get() or self.dedup_var.get() or append:      # each file can be extracted on its own
+            progress.total = archive.total_size(self.input_files)
+            try:
+                with archive.ArchiveWriter(archive_path, password, block_size, jobs, progress, level=level,
+                                           codec=codec, dedup=self.dedup_var.get(), append=append) as writer:
+                    for i in self.input_files:
+                        writer.add(i)
+            except ValueError:
+                tkinter.messagebox.showerror(title='Compression error', parent=self,
+                                             message='Incorrect password or corrupted archive')
+                self.confirm_button['state'] = 'normal'
+                return 0
+        else:
+            archive.write_tar_archive(self.input_files, archive_path, password, block_size, jobs, progress, level=level,
+                                      codec=codec)
+        progress.finish()
+        self.parent.update_items(force=True)   # an updated or overwritten archive leaves the directory's mtime alone
+        tkinter.messagebox.showinfo(title='Compression successful',
+                                    message=f'Completed in {"%.2f" % float(time() - start)} seconds\n\n'
+                                            f'{stages_text(progress)}')
         self.destroy()
 
 
@@ -482,8 +834,11 @@ class DecompressArchive(tkinter.Toplevel):
         self.task_thread = threading.Thread(target=self.confirm_decompress) # runs decompression on another thread
 
         self.parent = parent
-        self.progress_bar = ttk.Progressbar(self, mode='indeterminate', length=250)
+        self.progress_bar = ttk.Progressbar(self, mode='determinate', maximum=100, length=250)
         self.progress_bar.grid(column=0, row=2, columnspan=2)
+        self.progress_label = tkinter.Label(self, text='')
+        self.progress_label.grid(column=0, row=6, columnspan=2)
+        self.job_progress = None      # set by the decompression thread, read by update_progress
         initial_dir = item.path.split(".")[0]
         self.geometry("500x500")
         archive_label = tkinter.Label(self, text="Output:")
@@ -499,10 +854,36 @@ class DecompressArchive(tkinter.Toplevel):
         self.password_entry = tkinter.Entry(self, foreground=self.parent.text_colour)
         self.password_entry.grid(column=0, row=4)
 
+        self.members_listbox = None
+        if os.path.isfile(item.path) and archive.is_archive(item.path):   # random access archives can be browsed
+            self.archive_path = item.path
+            self.list_button = tkinter.Button(self, text='List Contents', command=self.list_members)
+            self.list_button.grid(column=1, row=4)
+            self.members_listbox = tkinter.Listbox(self, selectmode='extended', width=70, height=20)
+            self.members_listbox.grid(column=0, row=5, columnspan=2)
+        self.update_progress()
+
+    def update_progress(self):    # tkinter is not thread safe, so the main thread polls the job instead
+        if self.job_progress is not None:
+            fraction = self.job_progress.fraction()
+            self.progress_bar['value'] = 0 if fraction is None else fraction * 100
+            self.progress_label['text'] = progress_text(self.job_progress)
+        self.after(200, self.update_progress)
+
+    def list_members(self):   # reads only the central directory, leave the selection empty to extract everything
+        try:
+            with archive.ArchiveReader(self.archive_path, self.password_entry.get()) as reader:
+                names = reader.names()
+        except ValueError:
+            tkinter.messagebox.showerror(title='Decompression error', message='Incorrect password or corrupted file')
+            return
+        self.members_listbox.delete(0, tkinter.END)
+        for name in names:
+            self.members_listbox.insert(tkinter.END, name)
+
     def confirm_decompress(self):
         self.confirm_button['state'] = 'disabled'
         archive_path = self.archive_entry.get()
-        self.progress_bar.start()
         password = self.password_entry.get()
         selected_items = []
         for item in self.parent.items:
@@ -510,21 +891,26 @@ class DecompressArchive(tkinter.Toplevel):
                 selected_items.append(item)
 
         for item in selected_items:
-            with open(item.path, 'rb') as f:
-                data = f.read()
-                if password != '':
-                    data = encrypt.decrypt(data, password)
-                decompressed_data = huffman.decompress(data)
-                if decompressed_data == 0:
-                    tkinter.messagebox.showerror(title='Decompression error', message='Incorrect password or corrupted file')
+            progress = Progress()     # the total is filled in from the archive size or the selected members
+            self.job_progress = progress
+            if archive.is_archive(item.path):
+                names = None
+                if self.members_listbox is not None and self.members_listbox.curselection():
+                    names = [self.members_listbox.get(i) for i in self.members_listbox.curselection()]
+                try:
+                    with archive.ArchiveReader(item.path, password, os.cpu_count() or 1, progress) as reader:
+                        reader.extractall(archive_path, names)
+                except ValueError:
+                    tkinter.messagebox.showerror(title='Decompression error',
+                                                 message='Incorrect password or corrupted file')
                     return 0
-            with open('temp', 'wb') as f:
-                f.write(decompressed_data)
-        archive = tarfile.open('temp', 'r:')
-
-        archive.extractall(path=archive_path)
-        archive.close()
-        os.remove('temp')
+                continue
+            try:      # the archive is decrypted, decompressed and extracted as it is read, with no temporary file
+                archive.extract_tar_archive(item.path, archive_path, password, os.cpu_count() or 1, progress)
+            except (ValueError, tarfile.TarError):
+                tkinter.messagebox.showerror(title='Decompression error',
+                                             message='Incorrect password or corrupted file')
+                return 0
         self.destroy()
 
 
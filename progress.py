@@ -0,0 +1,140 @@
+from contextlib import contextmanager, nullcontext
+import io
+import json
+import threading
+from time import perf_counter
+
+
+class Progress:
+    """Collects metrics for one job: units done out of total (bytes, in whatever unit the caller chose), frames done and
+    the wall time spent in each stage. Stages can be nested, and the time of a stage leaves out the stages inside it,
+    so on a single process the stage times add up to the elapsed time. callback is called with this object after every
+    update. With profile=True, cProfile and tracemalloc run until finish() is called. They are only imported then, like
+    logging by ProgressLogger, so jobs that measure nothing don't pay for them at start up"""
+    def __init__(self, total=0, callback=None, profile=False):
+        self.total = total
+        self.done = 0
+        self.frames = 0
+        self.callback = callback
+        self.stages = {}  # stage name: seconds
+        self.lock = threading.Lock()  # stages gain keys on the worker while the GUI thread takes snapshots
+        self.stack = []  # [name, time the stage last resumed] of the stages being timed, innermost last
+        self.start_time = perf_counter()
+        self.end_time = None
+        self.profiler = None
+        self.profile_report = None  # text of the slowest functions, filled in by finish()
+        self.peak_memory = None  # largest amount of memory traced by tracemalloc, in bytes
+        if profile:
+            import cProfile
+            import tracemalloc
+            tracemalloc.start()
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    @contextmanager
+    def stage(self, name):
+        now = perf_counter()
+        if self.stack:  # pauses the outer stage
+            outer = self.stack[-1]
+            self.add_stages({outer[0]: now - outer[1]})
+        self.stack.append([name, now])
+        try:
+            yield
+        finally:
+            now = perf_counter()
+            name, start = self.stack.pop()
+            self.add_stages({name: now - start})
+            if self.stack:  # resumes the outer stage
+                self.stack[-1][1] = now
+
+    def add_stages(self, stages):  # adds times measured somewhere else, such as in a worker process
+        with self.lock:
+            for name, seconds in stages.items():
+                self.stages[name] = self.stages.get(name, 0) + seconds
+
+    def stage_times(self):  # a copy of stages, safe to go through while another thread is still adding to it
+        with self.lock:
+            return dict(self.stages)
+
+    def advance(self, count, frames=0):
+        self.done += count
+        self.frames += frames
+        if self.callback is not None:
+            self.callback(self)
+
+    def elapsed(self):
+        return (self.end_time or perf_counter()) - self.start_time
+
+    def fraction(self):  # between 0 and 1, None if the total is not known
+        if not self.total:
+            return None
+        return min(self.done / self.total, 1)
+
+    def throughput(self):  # units per second
+        elapsed = self.elapsed()
+        return self.done / elapsed if elapsed > 0 else 0
+
+    def eta(self):  # seconds left, None if it can't be estimated yet
+        throughput = self.throughput()
+        if not self.total or throughput == 0:
+            return None
+        return max(self.total - self.done, 0) / throughput
+
+    def snapshot(self):  # everything measured so far, as a dictionary that can be written as json
+        fraction = self.fraction()
+        eta = self.eta()
+        report = {'done': self.done, 'total': self.total, 'frames': self.frames,
+                  'percent': None if fraction is None else round(fraction * 100, 1),
+                  'elapsed_s': round(self.elapsed(), 3), 'mb_per_s': round(self.throughput() / 1e6, 3),
+                  'eta_s': None if eta is None else round(eta, 1),
+                  'stages_s': {name: round(seconds, 3) for name, seconds in self.stage_times().items()},
+                  'finished': self.end_time is not None}
+        if self.peak_memory is not None:
+            report['peak_traced_mb'] = round(self.peak_memory / 1e6, 3)
+        return report
+
+    def finish(self):
+        self.end_time = perf_counter()
+        if self.profiler is not None:
+            import pstats
+            import tracemalloc
+            self.profiler.disable()
+            self.peak_memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            report = io.StringIO()
+            pstats.Stats(self.profiler, stream=report).sort_stats('cumulative').print_stats(20)
+            self.profile_report = report.getvalue()
+            self.profiler = None
+        if self.callback is not None:
+            self.callback(self)
+
+
+def no_stage(name):  # stands in for Progress.stage when nothing is being measured
+    return nullcontext()
+
+
+def stage_timer(progress):  # returns the stage context manager of progress, or one that does nothing
+    return no_stage if progress is None else progress.stage
+
+
+class ProgressLogger:
+    """Callback for headless use that writes Progress snapshots to the 'lp-archiver' logger as json, at most once
+    every interval seconds and once more when the job finishes"""
+    def __init__(self, interval=1.0, job=''):
+        import logging
+        self.logger = logging.getLogger('lp-archiver')
+        self.interval = interval
+        self.job = job
+        self.last_report = None
+
+    def __call__(self, progress):
+        now = perf_counter()
+        finished = progress.end_time is not None
+        if not finished and self.last_report is not None and now - self.last_report < self.interval:
+            return
+        self.last_report = now
+        report = progress.snapshot()
+        report['job'] = self.job
+        self.logger.info(json.dumps(report))
+        if finished and progress.profile_report:
+            self.logger.info(progress.profile_report)
@@ -0,0 +1,29 @@
+import os
+import random
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # the modules live at the top level
+
+import huffman
+
+
+@pytest.fixture(params=['numpy', 'python'])
+def numpy_mode(request, monkeypatch):  # runs a test with numpy, and again with the pure python hot loops
+    if request.param == 'numpy':
+        if huffman.load_numpy() is None:
+            pytest.skip('numpy is not installed')
+    else:
+        monkeypatch.setattr(huffman, 'load_numpy', lambda: None)
+    return request.param
+
+
+def sample_data(size, seed=0):  # text with some repeats and a stretch of random bytes, so every block type is used
+    generator = random.Random(seed)
+    words = [b'huffman ', b'archive ', b'frame ', b'the ', b'of ', b'block\n', b'checksum ']
+    output = bytearray()
+    while len(output) < size * 3 // 4:
+        output += generator.choice(words)
+    output += generator.randbytes(size - len(output))
+    return bytes(output[:size])
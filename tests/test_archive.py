@@ -0,0 +1,144 @@
+import os
+
+import pytest
+
+import archive
+from conftest import sample_data
+
+
+def make_tree(root):  # a folder with text, an already compressed file, an empty file and a subfolder
+    os.makedirs(os.path.join(root, 'sub'))
+    files = {'a.txt': sample_data(50000, 1), 'photo.jpg': b'\xff\xd8\xff' + os.urandom(20000), 'empty': b'',
+             'sub/b.txt': sample_data(3000, 2), 'sub/copy.txt': sample_data(50000, 1)}
+    for name, data in files.items():
+        with open(os.path.join(root, *name.split('/')), 'wb') as f:
+            f.write(data)
+    return files
+
+
+def assert_extracted(output, files):
+    for name, data in files.items():
+        with open(os.path.join(output, *name.split('/')), 'rb') as f:
+            assert f.read() == data, name
+
+
+@pytest.mark.parametrize('password', ['', 'password'])
+@pytest.mark.parametrize('dedup', [False, True])
+def test_create_and_extract(tmp_path, password, dedup):
+    files = make_tree(tmp_path / 'src')
+    path = str(tmp_path / 'a.lpa')
+    with archive.ArchiveWriter(path, password, dedup=dedup) as writer:
+        writer.add(str(tmp_path / 'src'))
+    assert archive.is_archive(path)
+    assert archive.is_encrypted(path) == (password != '')
+    with archive.ArchiveReader(path, password) as reader:
+        assert sorted(reader.names()) == sorted(['src'] + ['src/' + name for name in files] + ['src/sub'])
+        reader.verify()
+        reader.extractall(str(tmp_path / 'out'))
+    assert_extracted(tmp_path / 'out' / 'src', files)
+
+
+def test_wrong_password_raises(tmp_path):
+    make_tree(tmp_path / 'src')
+    path = str(tmp_path / 'a.lpa')
+    with archive.ArchiveWriter(path, 'password') as writer:
+        writer.add(str(tmp_path / 'src'))
+    with pytest.raises(ValueError):
+        archive.ArchiveReader(path, 'wrong')
+
+
+def test_dedup_output_does_not_depend_on_jobs(tmp_path):
+    make_tree(tmp_path / 'src')
+    outputs = []
+    for jobs in (1, 3):
+        path = tmp_path / f'{jobs}.lpa'
+        with archive.ArchiveWriter(str(path), dedup=True, jobs=jobs) as writer:
+            writer.add(str(tmp_path / 'src'))
+        outputs.append(path.read_bytes())
+    assert outputs[0] == outputs[1]
+
+
+@pytest.mark.parametrize('password', ['', 'password'])
+def test_update_and_compact(tmp_path, password):
+    files = make_tree(tmp_path / 'src')
+    path = str(tmp_path / 'a.lpa')
+    with archive.ArchiveWriter(path, password) as writer:
+        writer.add(str(tmp_path / 'src'))
+    files['a.txt'] = sample_data(50000, 3)
+    (tmp_path / 'src' / 'a.txt').write_bytes(files['a.txt'])
+    os.remove(tmp_path / 'src' / 'sub' / 'b.txt')
+    del files['sub/b.txt']
+    with archive.ArchiveWriter(path, password, append=True) as writer:
+        writer.add(str(tmp_path / 'src'))
+    with archive.ArchiveReader(path, password) as reader:
+        assert 'src/sub/b.txt' not in reader.names()
+        reader.extractall(str(tmp_path / 'updated'))
+    assert_extracted(tmp_path / 'updated' / 'src', files)
+
+    size = os.path.getsize(path)
+    assert archive.compact_archive(path, password) > 0
+    assert os.path.getsize(path) < size and not os.path.exists(path + '.tmp')
+    with archive.ArchiveReader(path, password) as reader:
+        reader.verify()
+        reader.extractall(str(tmp_path / 'compacted'))
+    assert_extracted(tmp_path / 'compacted' / 'src', files)
+
+
+def test_compact_with_wrong_password_leaves_archive(tmp_path):
+    make_tree(tmp_path / 'src')
+    path = str(tmp_path / 'a.lpa')
+    with archive.ArchiveWriter(path, 'password') as writer:
+        writer.add(str(tmp_path / 'src'))
+    contents = open(path, 'rb').read()
+    with pytest.raises(ValueError):
+        archive.compact_archive(path, 'wrong')
+    assert open(path, 'rb').read() == contents and not os.path.exists(path + '.tmp')
+
+
+def test_interrupted_update_is_ignored(tmp_path):
+    files = make_tree(tmp_path / 'src')
+    path = str(tmp_path / 'a.lpa')
+    with archive.ArchiveWriter(path) as writer:
+        writer.add(str(tmp_path / 'src'))
+    with open(path, 'ab') as f:  # data of an update that never wrote its directory
+        f.write(os.urandom(5000))
+    with archive.ArchiveReader(path) as reader:
+        reader.extractall(str(tmp_path / 'out'))
+    assert_extracted(tmp_path / 'out' / 'src', files)
+
+
+def test_current_folder_is_named_after_it(tmp_path, monkeypatch):
+    files = make_tree(tmp_path / 'src')
+    monkeypatch.chdir(tmp_path / 'src')
+    path = str(tmp_path / 'a.lpa')
+    with archive.ArchiveWriter(path) as writer:
+        writer.add('.')
+    with archive.ArchiveReader(path) as reader:
+        assert all(name == 'src' or name.startswith('src/') for name in reader.names())
+        reader.verify()
+        reader.extractall(str(tmp_path / 'out'))
+    assert_extracted(tmp_path / 'out' / 'src', files)
+
+
+def test_unsafe_names_fail_verify_and_extract(tmp_path):
+    (tmp_path / 'a.txt').write_bytes(b'contents')
+    path = str(tmp_path / 'a.lpa')
+    writer = archive.ArchiveWriter(path)
+    writer.add(str(tmp_path / 'a.txt'))
+    writer.members[0]['name'] = '../a.txt'
+    writer.close()
+    with archive.ArchiveReader(path) as reader:
+        with pytest.raises(ValueError):
+            reader.verify()
+        with pytest.raises(ValueError):
+            reader.extractall(str(tmp_path / 'out'))
+
+
+@pytest.mark.parametrize('password', ['', 'password'])
+def test_tar_archive(tmp_path, password):
+    files = make_tree(tmp_path / 'src')
+    path = str(tmp_path / 'a.z')
+    archive.write_tar_archive([str(tmp_path / 'src')], path, password)
+    archive.extract_tar_archive(path, str(tmp_path / 'out'), password)
+    source = os.path.splitdrive(str(tmp_path / 'src'))[1].lstrip(os.sep)  # tarfile keeps the whole path
+    assert_extracted(tmp_path / 'out' / source, files)
@@ -0,0 +1,67 @@
+import os
+import tarfile
+
+import pytest
+
+import cli
+from conftest import sample_data
+
+
+def run(*arguments):
+    return cli.main(list(arguments) + ['--jobs', '1'])
+
+
+@pytest.fixture(params=[[], ['--password-env', 'TEST_PASSWORD']], ids=['plain', 'encrypted'])
+def password_options(request, monkeypatch):
+    monkeypatch.setenv('TEST_PASSWORD', 'password')
+    return request.param
+
+
+def test_file_round_trip(tmp_path, password_options):
+    data = sample_data(100000)
+    (tmp_path / 'data.bin').write_bytes(data)
+    assert run('compress', str(tmp_path / 'data.bin'), *password_options) == 0
+    assert run('test', str(tmp_path / 'data.bin.z'), *password_options) == 0
+    assert run('decompress', str(tmp_path / 'data.bin.z'), '-o', str(tmp_path / 'out.bin'), *password_options) == 0
+    assert (tmp_path / 'out.bin').read_bytes() == data
+
+
+def test_tar_file_comes_back_as_a_file(tmp_path, password_options, capsys):
+    (tmp_path / 'f.txt').write_bytes(b'contents')
+    with tarfile.open(tmp_path / 'backup.tar', 'w') as tar:
+        tar.add(tmp_path / 'f.txt', 'd/f.txt')
+    data = (tmp_path / 'backup.tar').read_bytes()
+    assert run('compress', str(tmp_path / 'backup.tar'), *password_options) == 0
+    os.remove(tmp_path / 'backup.tar')
+    assert run('list', str(tmp_path / 'backup.tar.z'), *password_options) == 0
+    assert 'backup.tar' in capsys.readouterr().out.splitlines()[-1]
+    assert run('decompress', str(tmp_path / 'backup.tar.z'), *password_options) == 0
+    assert (tmp_path / 'backup.tar').read_bytes() == data
+
+
+@pytest.mark.parametrize('random_access', [[], ['--random-access']], ids=['tar', 'random access'])
+def test_current_folder_round_trip(tmp_path, monkeypatch, password_options, random_access):
+    (tmp_path / 'project' / 'sub').mkdir(parents=True)
+    (tmp_path / 'project' / 'a.txt').write_bytes(sample_data(5000))
+    (tmp_path / 'project' / 'sub' / 'b.txt').write_bytes(b'b')
+    monkeypatch.chdir(tmp_path / 'project')
+    archive_path = str(tmp_path / 'project.z')
+    assert run('compress', '.', '-o', archive_path, *random_access, *password_options) == 0
+    assert run('test', archive_path, *password_options) == 0
+    assert run('decompress', archive_path, '-o', str(tmp_path / 'out'), *password_options) == 0
+    # random access archives name members after the folder, tar streams keep the paths as they were given like tar
+    output = tmp_path / 'out' / 'project' if random_access else tmp_path / 'out'
+    assert (output / 'a.txt').read_bytes() == sample_data(5000)
+    assert (output / 'sub' / 'b.txt').read_bytes() == b'b'
+
+
+def test_corrupted_input_fails(tmp_path, capsys):
+    (tmp_path / 'data.bin').write_bytes(sample_data(100000))
+    assert run('compress', str(tmp_path / 'data.bin')) == 0
+    compressed = bytearray((tmp_path / 'data.bin.z').read_bytes())
+    compressed[len(compressed) // 2] ^= 1
+    (tmp_path / 'data.bin.z').write_bytes(compressed)
+    assert run('test', str(tmp_path / 'data.bin.z')) == 1
+    assert run('decompress', str(tmp_path / 'data.bin.z'), '-o', str(tmp_path / 'out.bin')) == 1
+    assert not (tmp_path / 'out.bin').exists()
+    assert 'ValueError' in capsys.readouterr().err
@@ -0,0 +1,34 @@
+import pytest
+
+import encrypt
+from conftest import sample_data
+
+
+@pytest.mark.parametrize('size', [0, 1, 1000, 300000])
+def test_round_trip(size):
+    data = sample_data(size)
+    ciphertext = encrypt.encrypt(data, 'password')
+    assert ciphertext.startswith(encrypt.CHUNKED_MAGIC)
+    assert encrypt.decrypt(ciphertext, 'password') == data
+
+
+def test_wrong_password_raises():
+    ciphertext = encrypt.encrypt(sample_data(1000), 'password')
+    with pytest.raises(ValueError):
+        encrypt.decrypt(ciphertext, 'wrong')
+
+
+def test_corruption_raises():
+    ciphertext = encrypt.encrypt(sample_data(300000), 'password')
+    for position in (len(encrypt.CHUNKED_MAGIC) + 1, len(ciphertext) // 2, len(ciphertext) - 1):
+        corrupted = bytearray(ciphertext)
+        corrupted[position] ^= 1
+        with pytest.raises(ValueError):
+            encrypt.decrypt(bytes(corrupted), 'password')
+
+
+def test_truncation_raises():
+    ciphertext = encrypt.encrypt(sample_data(300000), 'password')
+    for length in (0, 10, len(ciphertext) // 2, len(ciphertext) - 1):
+        with pytest.raises(ValueError):
+            encrypt.decrypt(ciphertext[:length], 'password')
@@ -0,0 +1,129 @@
+import io
+import os
+import random
+
+import pytest
+
+import huffman
+from conftest import sample_data
+
+
+def decode(compressed_data):  # like huffman.decompress, but lets the ValueError of a corrupted stream through
+    with huffman.DecompressReader(io.BytesIO(compressed_data)) as reader:
+        return reader.readall()
+
+
+@pytest.mark.parametrize('codec, level', [('huffman', 0), ('huffman', 1), ('huffman', 2), ('huffman', 3),
+                                          ('bwt', 0)])
+def test_round_trip(numpy_mode, codec, level):
+    data = sample_data(40000)
+    compressed = huffman.compress(data, codec=codec, level=level, frame_size=1 << 14)
+    assert compressed.startswith(huffman.MAGIC)
+    assert huffman.decompress(compressed) == data
+    assert huffman.decompress(compressed, use_table=False) == data
+
+
+def test_round_trip_sampled(numpy_mode):
+    data = sample_data(40000)
+    assert huffman.decompress(huffman.compress(data, sample_size=1000)) == data
+
+
+@pytest.mark.parametrize('data', [b'', b'a', b'ab' * 3, bytes(range(256)), bytes(70000)])
+def test_round_trip_edge_cases(data):
+    for codec in huffman.CODECS:
+        assert decode(huffman.compress(data, codec=codec)) == data
+
+
+def test_round_trip_jobs():
+    data = sample_data(200000)
+    compressed = huffman.compress(data, jobs=2, frame_size=1 << 15)
+    assert compressed == huffman.compress(data, frame_size=1 << 15)  # the pool does not change the output
+    assert huffman.decompress(compressed, jobs=2) == data
+
+
+def test_repeated_random_data_uses_lz77():
+    data = random.Random(1).randbytes(16000) * 20
+    assert len(huffman.compress(data, level=1)) < len(data) // 10
+    assert len(huffman.compress(data, codec='bwt')) < len(data) // 10
+
+
+def test_dictionary_stream(tmp_path):
+    sample = tmp_path / 'sample'
+    sample.write_bytes(sample_data(20000, seed=1))
+    name = huffman.train_dictionary([str(sample)])
+    data = sample_data(2000, seed=2)
+    compressed = huffman.compress(data, dictionary=name)
+    assert compressed.startswith(huffman.DICTIONARY_MAGIC + bytes.fromhex(name))
+    assert decode(compressed) == data
+
+
+def test_tar_flag():
+    output = io.BytesIO()
+    with huffman.CompressWriter(output, tar=True) as writer:
+        writer.write(b'contents')
+    with huffman.DecompressReader(io.BytesIO(output.getvalue())) as reader:
+        assert reader.tar and reader.readall() == b'contents'
+    with huffman.DecompressReader(io.BytesIO(huffman.compress(b'contents'))) as reader:
+        assert not reader.tar
+
+
+@pytest.mark.parametrize('version', [0, 1, 2, 3, 6])
+def test_other_versions_are_refused(version):
+    compressed = bytearray(huffman.compress(sample_data(5000)))
+    compressed[3] = version  # version 2 had no checksums, so it must not be a way to turn them off
+    with pytest.raises(ValueError):
+        decode(bytes(compressed))
+
+
+def test_bit_flips_never_decode_to_wrong_data():
+    data = sample_data(6000)
+    compressed = huffman.compress(data, level=1, frame_size=2000)
+    generator = random.Random(2)
+    for _ in range(300):
+        corrupted = bytearray(compressed)
+        corrupted[generator.randrange(len(corrupted))] ^= 1 << generator.randrange(8)
+        try:
+            output = decode(bytes(corrupted))
+        except ValueError:
+            continue
+        assert output == data  # only padding bits can change without being noticed
+
+
+def test_truncation_raises():
+    compressed = huffman.compress(sample_data(6000), frame_size=2000)
+    for length in range(0, len(compressed), 7):
+        with pytest.raises(ValueError):
+            decode(compressed[:length])
+
+
+def test_huge_frame_size_raises():
+    compressed = bytearray(huffman.compress(sample_data(1000)))
+    compressed[len(huffman.MAGIC):len(huffman.MAGIC) + 4] = (1 << 31).to_bytes(4, 'big')
+    with pytest.raises(ValueError):
+        decode(bytes(compressed))
+
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_decompress_file(tmp_path, jobs):
+    data = sample_data(100000)
+    source = tmp_path / 'data.z'
+    source.write_bytes(huffman.compress(data, frame_size=1 << 14))
+    huffman.verify_file(str(source), jobs=jobs)
+    huffman.decompress_file(str(source), str(tmp_path / 'data'), jobs=jobs)
+    assert (tmp_path / 'data').read_bytes() == data
+
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_corrupted_file_leaves_no_output(tmp_path, jobs):
+    compressed = bytearray(huffman.compress(sample_data(100000), frame_size=1 << 14))
+    compressed[len(compressed) // 2] ^= 0x10
+    source = tmp_path / 'data.z'
+    source.write_bytes(compressed)
+    with pytest.raises(ValueError):
+        huffman.verify_file(str(source), jobs=jobs)
+    (tmp_path / 'existing').write_bytes(b'old')
+    for name in ('new', 'existing'):
+        with pytest.raises(ValueError):
+            huffman.decompress_file(str(source), str(tmp_path / name), jobs=jobs)
+    assert sorted(os.listdir(tmp_path)) == ['data.z', 'existing']
+    assert (tmp_path / 'existing').read_bytes() == b'old'